@@ -1,14 +1,55 @@
+import os
+
 import gradio as gr
 from src.rag import RAG
-from src.data.data_processing import load_and_preprocess_data
+from src.data.data_processing import LazyChunkedData
 from src.interface import create_interface
+from src.metrics import PipelineMetrics, start_metrics_server
+from src.profiler import SlowRequestProfiler
 
 DATA_DIR = "data"
 LLM_NAME = "GigaChat"
+# Memory-mapped stores load fast and are shared between several app processes
+RETRIEVER_KWARGS = {"store_format": "mmap"}
+# Number of requests answered at the same time and number of requests waiting in the queue
+CONCURRENCY_LIMIT = int(os.getenv("CONCURRENCY_LIMIT", 8))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", 64))
+# Chunks this similar to an earlier one, e.g. the same text in Wikipedia and Wikivoyage, are indexed once
+DEDUP_THRESHOLD = 0.8
+# Prometheus scrapes latency histograms of the pipeline stages from http://<host>:METRICS_PORT/metrics
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+# Stacks of requests slower than this many seconds are saved to PROFILES_DIR, not sampled if unset
+SLOW_REQUEST_SECONDS = os.getenv("SLOW_REQUEST_SECONDS")
+PROFILES_DIR = "profiles"
+
+
+# The corpus is read and chunked only if the vectorstores have to be (re)built
+chunked_data = LazyChunkedData(datadir=DATA_DIR, dedup_threshold=DEDUP_THRESHOLD)
+
+metrics = PipelineMetrics()
+start_metrics_server(metrics.registry, port=METRICS_PORT)
+profiler = None
+if SLOW_REQUEST_SECONDS:
+    profiler = SlowRequestProfiler(
+        threshold=float(SLOW_REQUEST_SECONDS), output_dir=PROFILES_DIR
+    )
+
+rag = RAG(
+    chunked_data,
+    model_name=LLM_NAME,
+    retriever_kwargs=RETRIEVER_KWARGS,
+    retrieval_workers=CONCURRENCY_LIMIT,
+    metrics=metrics,
+    profiler=profiler,
+)
+
 
+async def respond(query):
+    # Gradio updates the answer on every yielded value
+    async for answer in rag.astream(query):
+        yield answer
 
-chunked_data = load_and_preprocess_data(datadir=DATA_DIR)
 
-rag = RAG(chunked_data, model_name=LLM_NAME)
-interface = create_interface(lambda query: rag.run(query)["response"])
+interface = create_interface(respond)
+interface.queue(default_concurrency_limit=CONCURRENCY_LIMIT, max_size=MAX_QUEUE_SIZE)
 interface.launch(share=True)
@@ -0,0 +1,80 @@
+"""
+Throughput of `retrieve_many` against calling `retrieve` query by query.
+
+Questions are read from a json file: a list of strings, a list of objects with
+a "question" / "user_input" field or an object with a list in one of these fields
+(e.g. validation_data.json). Without `--questions` random questions are generated.
+
+Usage:
+    python benchmarks/batch_retrieval.py --questions validation_data/validation_data.json
+    python benchmarks/batch_retrieval.py --synthetic 10000 --limit 1000
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+sys.path.append("./")
+
+from src.data.data_processing import LazyChunkedData
+from src.retriever import HierarchicalRetriever
+
+QUESTION_FIELDS = ("question", "user_input")
+WORDS = "что посмотреть в москве казани шанхае музей театр парк собор кремль".split()
+
+
+def get_question(item):
+    return next(item[field] for field in QUESTION_FIELDS if field in item)
+
+
+def load_questions(path):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = get_question(data)
+    return [item if isinstance(item, str) else get_question(item) for item in data]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions")
+    parser.add_argument("--synthetic", type=int, default=10000)
+    parser.add_argument("--limit", type=int, help="Questions for the one by one loop")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.questions:
+        questions = load_questions(args.questions)
+    else:
+        rng = random.Random(0)
+        questions = [
+            " ".join(rng.choices(WORDS, k=rng.randint(3, 8)))
+            for _ in range(args.synthetic)
+        ]
+    # caches would hide the difference between the two paths
+    retriever = HierarchicalRetriever(
+        LazyChunkedData(datadir=args.data_dir), cache_size=0
+    )
+    loop_questions = questions[: args.limit]
+
+    start = time.perf_counter()
+    one_by_one = [retriever.retrieve(question) for question in loop_questions]
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = retriever.retrieve_many(questions, batch_size=args.batch_size)
+    batch_time = time.perf_counter() - start
+    print(f"Stages of retrieve_many: {retriever.last_timings}")
+
+    loop_qps = len(loop_questions) / loop_time
+    batch_qps = len(questions) / batch_time
+    print(f"retrieve:      {len(loop_questions):>6} questions, {loop_qps:>8.1f} q/s")
+    print(f"retrieve_many: {len(questions):>6} questions, {batch_qps:>8.1f} q/s")
+    print(f"Speedup: {batch_qps / loop_qps:.1f}x")
+    print(f"Same results: {batched[: len(loop_questions)] == one_by_one}")
+
+
+if __name__ == "__main__":
+    main()
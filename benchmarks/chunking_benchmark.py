@@ -0,0 +1,87 @@
+"""
+Chunking throughput: LangChain `RecursiveCharacterTextSplitter` vs `FastTextSplitter`,
+serial and in several processes. Every mode must give exactly the same chunks in the
+same order as the LangChain splitter.
+
+Usage:
+    python benchmarks/chunking_benchmark.py --data-dir data --workers 1 2 4
+"""
+import argparse
+import random
+import sys
+import time
+
+sys.path.append("./")
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from src.data.data_processing import (
+    iter_chunks,
+    iter_records,
+    iter_sections,
+    list_data_files,
+)
+
+WORDS = "город музей театр парк река собор улица площадь кремль мост".split()
+
+
+def load_sections(args):
+    if args.data_dir:
+        records = (
+            record
+            for path in list_data_files(args.data_dir)
+            for record in iter_records(path)
+        )
+        return list(iter_sections(records))
+    rng = random.Random(0)
+    sections = []
+    for i in range(args.sections):
+        paragraphs = [
+            " ".join(rng.choices(WORDS, k=rng.randint(5, 200)))
+            for _ in range(rng.randint(1, 8))
+        ]
+        sections.append((f"Город {i}", "\n".join(paragraphs)))
+    return sections
+
+
+def langchain_chunks(sections):
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    for title, text in sections:
+        chunks = text_splitter.split_text(text)
+        if chunks:
+            yield title, chunks
+
+
+def report(name, sections, chunks, elapsed):
+    print(f"{name:<28}{elapsed:>8.2f} s{len(sections) / elapsed:>14.1f} sections/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-dir", help="Take sections from the real dumps")
+    parser.add_argument("--sections", type=int, default=20000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    sections = load_sections(args)
+    print(f"{len(sections)} sections\n")
+
+    start = time.perf_counter()
+    expected = list(langchain_chunks(sections))
+    report(
+        "RecursiveCharacterTextSplitter",
+        sections,
+        expected,
+        time.perf_counter() - start,
+    )
+    for num_workers in args.workers:
+        start = time.perf_counter()
+        chunks = list(iter_chunks(sections, num_workers=num_workers))
+        elapsed = time.perf_counter() - start
+        report(f"FastTextSplitter, {num_workers} workers", sections, chunks, elapsed)
+        assert chunks == expected, f"Chunks differ with {num_workers} workers"
+    print(f"\nSame chunks in all modes: {sum(len(c) for _, c in expected)} chunks")
+
+
+if __name__ == "__main__":
+    main()
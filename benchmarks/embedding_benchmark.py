@@ -0,0 +1,76 @@
+"""
+Index build throughput: `FAISS.from_texts` vs batched multi-process embedding.
+
+Usage:
+    python benchmarks/embedding_benchmark.py --data-dir data --limit 20000 --workers 1 2 4
+"""
+import argparse
+import random
+import sys
+import time
+
+sys.path.append("./")
+
+from langchain_community.vectorstores import FAISS
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from src.data.data_processing import load_and_preprocess_data
+from src.embeddings import BatchEmbedder
+from src.index import build_vectorstore
+
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+
+def load_texts(args):
+    if args.data_dir:
+        data = load_and_preprocess_data(datadir=args.data_dir)
+        texts = [chunk for chunks in data.values() for chunk in chunks]
+    else:
+        words = "город музей театр парк река собор улица площадь кремль мост".split()
+        rng = random.Random(0)
+        texts = [
+            " ".join(rng.choices(words, k=rng.randint(10, 160)))
+            for _ in range(args.limit)
+        ]
+    random.Random(0).shuffle(texts)
+    return texts[: args.limit]
+
+
+def report(name, num_texts, elapsed):
+    print(f"{name:<28}{elapsed:>10.1f} s{num_texts / elapsed:>12.1f} chunks/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-dir", help="Take chunks from the real dumps")
+    parser.add_argument("--limit", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    texts = load_texts(args)
+    embeddings = HuggingFaceEmbeddings(
+        model_name=MODEL_NAME,
+        model_kwargs={"device": "cpu"},
+        encode_kwargs={"normalize_embeddings": True},
+    )
+    print(f"{len(texts)} chunks")
+
+    start = time.perf_counter()
+    FAISS.from_texts(texts, embeddings)
+    report("FAISS.from_texts", len(texts), time.perf_counter() - start)
+
+    for num_workers in args.workers:
+        embedder = BatchEmbedder(
+            embeddings,
+            model_name=MODEL_NAME,
+            batch_size=args.batch_size,
+            num_workers=num_workers,
+        )
+        start = time.perf_counter()
+        build_vectorstore(texts, embeddings, embedder=embedder)
+        report(f"BatchEmbedder x{num_workers}", len(texts), time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+HTML parsing throughput of `WikiParser`: the single-pass lxml extraction vs the
+BeautifulSoup parsers it replaced, which are kept here as the reference. Every
+page must give exactly the same result with both, the benchmark fails otherwise.
+
+Pages are the fixtures in benchmarks/fixtures: Wikivoyage pages (*.html with
+"wikivoyage" in the name), city tables (other *.html) and Wikipedia pages with
+HTML extracts of the sections (*.json). Saved pages of the same kinds can be added
+with --pages-dir.
+
+Usage:
+    python benchmarks/html_parsing_benchmark.py --repeat 200 --pages-dir saved_pages
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.append("./")
+
+from bs4 import BeautifulSoup
+
+from src.data.data_parsing import WikiParser
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+TABLE_COLUMN = "Город"
+
+
+class LegacyWikiParser:
+    """The BeautifulSoup parsers of `WikiParser` before the lxml extraction"""
+
+    def get_name_link(self, div):
+        a = div.find("a")
+        if a:
+            return a.get_text().strip(), a.get("href")
+        return None, None
+
+    def parse_table(self, html, target_column):
+        soup = BeautifulSoup(html, "html.parser")
+
+        pages = {}
+        # Find tables with city lists
+        tables = soup.find_all("table")
+        for table in tables:
+            rows = table.find_all("tr")
+            all_cols = [col.get_text().strip() for col in rows[0].find_all("th")]
+            if target_column in all_cols:
+                target_col_num = all_cols.index(target_column)
+                for row in rows[1:]:
+                    cols = row.find_all("td")
+                    if cols:
+                        name, link = self.get_name_link(cols[target_col_num])
+                        if name and link:
+                            pages[name] = link
+        return pages
+
+    def validate_section_title(self, section_title):
+        if section_title.get("class") in ["mw-toc-heading", "vector-menu-heading"]:
+            return False
+        if section_title.get("id") in [
+            "mw-toc-heading",
+            "Ссылки",
+            "Литература",
+            "Примечания",
+            "См. также",
+            "Навигация",
+            "Прочее",
+        ]:
+            return False
+        if re.match(r"p(-.*)*", section_title.get("id")):
+            return False
+        return True
+
+    def validate_content(self, content):
+        if content.name not in ["p", "ul", "ol", "section", "div"]:
+            return False
+        if content.name == "div" and ("vcard" not in content.get("class")):
+            return False
+        if content.get("class") in ["reference"]:
+            return False
+        return True
+
+    def parse_sections_wikipedia(self, sections):
+        page_info = {}
+        for section in sections:
+            title = section.title
+            page_info.update({title: []})
+            soup = BeautifulSoup(section.text, "html.parser")
+            for current in soup.find_all(["p", "ol", "ul"]):
+                page_info[title].append(current.text)
+
+            for subsection in section.sections:
+                subtitle = f"{title}: {subsection.title}"
+                page_info.update({subtitle: []})
+                soup = BeautifulSoup(subsection.text, "html.parser")
+                for current in soup.find_all(["p", "ol", "ul"]):
+                    page_info[subtitle].append(current.text)
+        return {k: " ".join(v) for k, v in page_info.items() if v}
+
+    def parse_html_wikivoyage(self, html, name):
+        try:
+            soup = BeautifulSoup(html, "html.parser")
+            # Initialize city data dictionary
+            page_info = {}
+            section_divs = soup.find_all("div", class_="mw-heading mw-heading2")
+            if not section_divs:
+                # the old parser followed the wikidata link of stub pages with a
+                # call of the wrong arity, which raised, so stub pages were empty
+                return {}
+
+            for section_div in section_divs:
+                section = section_div.find("h2")
+                title = section.get("id")
+                if self.validate_section_title(section) and title:
+                    section_content = {title: []}
+                    current = section_div.find_next_sibling()
+                    while (
+                        current
+                        and current.name not in ["h2"]
+                        and set(current.get("class", [])) & {"mw-heading2"} == set()
+                    ):
+                        if self.validate_content(current):
+                            if current.name in ["p", "ul", "ol"]:
+                                section_content[title].append(
+                                    current.get_text().strip()
+                                )
+                            if current.name == "div":
+                                section_content[title].append(
+                                    current.get_text().strip()
+                                )
+                            if current.name == "section":
+                                current_div = current.find("div")
+                                if "mw-heading3" in current_div.get("class", []):
+                                    subtitle = current_div.find("h3").get("id")
+                                    if (
+                                        self.validate_section_title(current_div)
+                                        and subtitle
+                                    ):
+                                        section_content[f"{title}: {subtitle}"] = []
+                                        current_div = current_div.find_next_sibling()
+                                        while (
+                                            current_div
+                                            and current_div.name not in ["h2", "h3"]
+                                            and set(current_div.get("class", []))
+                                            & {"mw-heading2", "mw-heading3"}
+                                            == set()
+                                        ):
+                                            if current_div.name in ["p", "ul", "ol"]:
+                                                section_content[
+                                                    f"{title}: {subtitle}"
+                                                ].append(current_div.get_text().strip())
+                                            else:
+                                                current_div_div = current_div.find_all(
+                                                    "div"
+                                                )
+                                                for d in current_div_div:
+                                                    section_content[
+                                                        f"{title}: {subtitle}"
+                                                    ].append(d.get_text().strip())
+                                            if current_div.find_next_sibling():
+                                                current_div = (
+                                                    current_div.find_next_sibling()
+                                                )
+                                            else:
+                                                current_div = current_div.parent
+                                                if current_div:
+                                                    current_div = (
+                                                        current_div.parent.parent
+                                                    )
+                                                break
+
+                        current = current.find_next_sibling()
+                    # Combine content if there's any
+                    section_content = {
+                        k: " ".join(v) for k, v in section_content.items()
+                    }
+                    page_info.update(section_content)
+
+            return page_info
+
+        except Exception as e:
+            print(f"Error parsing {name}: {e}")
+            return {}
+
+
+def to_sections(sections):
+    """Sections of a JSON page as the `wikipediaapi` section objects"""
+    return [
+        SimpleNamespace(
+            title=section["title"],
+            text=section["text"],
+            sections=to_sections(section.get("sections", [])),
+        )
+        for section in sections
+    ]
+
+
+def load_pages(dirs):
+    """:return: {kind: [(name, page)]} with "wikivoyage", "table" and "wikipedia" kinds"""
+    pages = {"wikivoyage": [], "table": [], "wikipedia": []}
+    for directory in dirs:
+        for path in sorted(glob.glob(os.path.join(directory, "*"))):
+            name = os.path.basename(path)
+            with open(path, encoding="utf-8") as f:
+                if name.endswith(".json"):
+                    sections = to_sections(json.load(f)["sections"])
+                    pages["wikipedia"].append((name, sections))
+                elif name.endswith(".html"):
+                    kind = "wikivoyage" if "wikivoyage" in name else "table"
+                    pages[kind].append((name, f.read()))
+    return pages
+
+
+def parse(parser, kind, name, page):
+    if kind == "wikivoyage":
+        return parser.parse_html_wikivoyage(page, name)
+    if kind == "table":
+        return parser.parse_table(page, TABLE_COLUMN)
+    return parser.parse_sections_wikipedia(page)
+
+
+def check_parity(pages, legacy, parser):
+    mismatches = 0
+    for kind, kind_pages in pages.items():
+        for name, page in kind_pages:
+            expected = parse(legacy, kind, name, page)
+            result = parse(parser, kind, name, page)
+            if result != expected:
+                mismatches += 1
+                print(f"MISMATCH {name}")
+                for key in sorted(set(expected) | set(result)):
+                    if expected.get(key) != result.get(key):
+                        print(f"  {key!r}:\n    legacy {expected.get(key)!r}")
+                        print(f"    lxml   {result.get(key)!r}")
+    return mismatches
+
+
+def measure(parser, kind, kind_pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for name, page in kind_pages:
+            parse(parser, kind, name, page)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=100, help="Passes over the pages")
+    parser.add_argument(
+        "--pages-dir", nargs="*", default=[], help="Saved pages besides the fixtures"
+    )
+    args = parser.parse_args()
+
+    pages = load_pages([FIXTURES_DIR] + args.pages_dir)
+    legacy = LegacyWikiParser()
+    wiki_parser = WikiParser()
+    print("Checking that both parsers give the same pages (parse errors are expected)")
+    mismatches = check_parity(pages, legacy, wiki_parser)
+    num_pages = sum(len(kind_pages) for kind_pages in pages.values())
+    print(f"{num_pages - mismatches}/{num_pages} pages are the same")
+
+    print(f"{'pages':<12}{'parser':<16}{'time':>10}{'pages/sec':>14}{'speedup':>10}")
+    for kind, kind_pages in pages.items():
+        if not kind_pages:
+            continue
+        # the parse errors of the broken fixtures are printed only in the check
+        sys.stdout = open(os.devnull, "w")
+        try:
+            legacy_time = measure(legacy, kind, kind_pages, args.repeat)
+            lxml_time = measure(wiki_parser, kind, kind_pages, args.repeat)
+        finally:
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+        count = len(kind_pages) * args.repeat
+        for name, elapsed in [("BeautifulSoup", legacy_time), ("lxml", lxml_time)]:
+            print(
+                f"{kind:<12}{name:<16}{elapsed:>8.2f} s{count / elapsed:>14.1f}"
+                f"{legacy_time / elapsed:>9.1f}x"
+            )
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Recall and latency of dense vs hybrid (dense + BM25) retrieval on place-name queries.
+
+For a sample of pages, the query asks about the page name ("Что посмотреть в Казань?")
+and counts as a hit if any retrieved chunk belongs to a section of that page.
+
+Usage:
+    python benchmarks/hybrid_retrieval.py --data-dir data --queries 500
+"""
+import argparse
+import random
+import sys
+import time
+
+sys.path.append("./")
+
+import numpy as np
+
+from src.data.data_processing import LazyChunkedData
+from src.retriever import HierarchicalRetriever
+
+QUERY_TEMPLATES = [
+    "Что посмотреть в {}?",
+    "{}",
+    "Достопримечательности {}",
+    "Куда сходить в {}",
+]
+# (title_top_n, lexical_top_n)
+CONFIGS = [(10, 0), (5, 0), (3, 0), (5, 5), (3, 3), (2, 2)]
+
+
+def make_queries(data, num_queries, rng):
+    pages = {}
+    for title, chunks in data.items():
+        pages.setdefault(title.split(":")[0], set()).update(chunks)
+    names = rng.sample(sorted(pages), min(num_queries, len(pages)))
+    queries = [rng.choice(QUERY_TEMPLATES).format(name) for name in names]
+    return queries, [pages[name] for name in names]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    data = LazyChunkedData(datadir=args.data_dir)
+    queries, relevant = make_queries(data.load(), args.queries, random.Random(0))
+    # caches would hide the search latency
+    retriever = HierarchicalRetriever(
+        data, cache_size=0, lexical_top_n=max(n for _, n in CONFIGS)
+    )
+
+    print(f"{'title_top_n':>12}{'lexical_top_n':>15}{'hit rate':>10}{'p50, ms':>10}")
+    for title_top_n, lexical_top_n in CONFIGS:
+        retriever.title_top_n = title_top_n
+        retriever.lexical_top_n = lexical_top_n
+        hits, latencies = 0, []
+        for query, chunks in zip(queries, relevant):
+            start = time.perf_counter()
+            results = retriever.retrieve(query)
+            latencies.append(time.perf_counter() - start)
+            hits += any(result in chunks for result in results)
+        print(
+            f"{title_top_n:>12}{lexical_top_n:>15}{hits / len(queries):>10.3f}"
+            f"{np.percentile(latencies, 50) * 1000:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Recall vs latency of the FAISS index types against the exact flat index.
+
+The title index is searched, so all types are compared for titles. The chunk index
+is never searched: chunks of the selected titles are scored exactly from their
+decoded vectors, and chunk stores get only the codec of the index type (see
+`src.index.get_chunk_index_type`). With `--store chunk` only the codecs are
+compared, their recall is the loss of scoring decoded vectors.
+
+Usage:
+    python benchmarks/index_report.py --index-path vectorstores/title_index
+    python benchmarks/index_report.py --index-path vectorstores/chunk_index --store chunk
+    python benchmarks/index_report.py --synthetic 100000 --dim 384
+"""
+import argparse
+import json
+import sys
+import time
+
+sys.path.append("./")
+
+import faiss
+import numpy as np
+
+from src.index import (
+    CHUNK_INDEX_TYPES,
+    configure_index,
+    get_factory_string,
+    make_index,
+)
+
+CONFIGS = [
+    ("flat", {}),
+    ("ivf", {"nprobe": 1}),
+    ("ivf", {"nprobe": 4}),
+    ("ivf", {"nprobe": 16}),
+    ("ivf", {"nprobe": 64}),
+    ("hnsw", {"ef_search": 16}),
+    ("hnsw", {"ef_search": 64}),
+    ("hnsw", {"ef_search": 256}),
+    ("sq8", {}),
+    ("pq", {}),
+]
+
+
+def load_vectors(args):
+    if args.index_path:
+        index = faiss.read_index(f"{args.index_path}/index.faiss")
+        return index.reconstruct_n(0, index.ntotal)
+    rng = np.random.default_rng(0)
+    # clustered data is closer to real embeddings than uniform noise
+    centers = rng.standard_normal((max(1, args.synthetic // 100), args.dim))
+    vectors = centers[rng.integers(len(centers), size=args.synthetic)]
+    vectors += 0.5 * rng.standard_normal(vectors.shape)
+    vectors = vectors.astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def make_queries(vectors, num_queries, noise=0.3):
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(len(vectors), size=num_queries, replace=False)]
+    queries = queries + noise * rng.standard_normal(queries.shape) / np.sqrt(
+        vectors.shape[1]
+    )
+    queries = queries.astype(np.float32)
+    faiss.normalize_L2(queries)
+    return queries
+
+
+def measure(index, queries, k):
+    """Single-query search, as in serving"""
+    latencies = []
+    labels = []
+    for query in queries:
+        start = time.perf_counter()
+        _, found = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+        labels.append(found[0])
+    return np.array(labels), np.array(latencies) * 1000
+
+
+def recall_at_k(labels, true_labels):
+    return np.mean(
+        [
+            len(set(found) & set(true)) / len(true)
+            for found, true in zip(labels, true_labels)
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--index-path", help="Saved vectorstore to take vectors from")
+    parser.add_argument("--synthetic", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument(
+        "--store",
+        choices=["title", "chunk"],
+        default="title",
+        help="Compare the index types used for titles or for chunks",
+    )
+    parser.add_argument("--output", help="Save the report as json")
+    args = parser.parse_args()
+    configs = CONFIGS
+    if args.store == "chunk":
+        configs = [config for config in CONFIGS if config[0] in CHUNK_INDEX_TYPES]
+
+    vectors = load_vectors(args)
+    queries = make_queries(vectors, min(args.queries, len(vectors)))
+    print(f"{len(vectors)} vectors of dim {vectors.shape[1]}, {len(queries)} queries")
+
+    true_labels = None
+    report = []
+    built = {}
+    for index_type, search_params in configs:
+        if index_type not in built:
+            start = time.perf_counter()
+            index = make_index(index_type, vectors)
+            index.add(vectors)
+            build_time = time.perf_counter() - start
+            built[index_type] = (index, build_time)
+        index, build_time = built[index_type]
+        configure_index(index, search_params)
+
+        labels, latencies = measure(index, queries, args.k)
+        if true_labels is None:
+            true_labels = labels
+        report.append(
+            {
+                "store": args.store,
+                "index": get_factory_string(index_type, *vectors.shape[::-1]),
+                "params": search_params,
+                f"recall@{args.k}": float(recall_at_k(labels, true_labels)),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+                "build_s": build_time,
+                "size_mb": faiss.serialize_index(index).nbytes / 2**20,
+            }
+        )
+
+    print(
+        f"{'index':<16}{'params':<20}{'recall@' + str(args.k):>10}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'build s':>9}{'size MB':>9}"
+    )
+    for row in report:
+        params = ", ".join(f"{k}={v}" for k, v in row["params"].items())
+        print(
+            f"{row['index']:<16}{params:<20}{row[f'recall@{args.k}']:>10.3f}"
+            f"{row['p50_ms']:>9.3f}{row['p95_ms']:>9.3f}"
+            f"{row['build_s']:>9.1f}{row['size_mb']:>9.1f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
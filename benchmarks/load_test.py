@@ -0,0 +1,125 @@
+"""
+Throughput of `RAG.arun` with concurrent users against a local stub LLM.
+
+The stub answers after a fixed delay, like a remote LLM, so the numbers show how
+well requests overlap. Without `--data-dir` a small synthetic corpus is indexed.
+
+Usage:
+    python benchmarks/load_test.py --users 1 4 16 --llm-delay 1.0
+    python benchmarks/load_test.py --data-dir data --index-dir vectorstores
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append("./")
+
+import numpy as np
+from langchain_core.messages import AIMessage
+
+from src.data.data_processing import LazyChunkedData
+from src.rag import RAG
+
+WORDS = (
+    "город музей театр парк река собор улица площадь кремль мост вокзал рынок".split()
+)
+
+
+class StubLLM:
+    """Answers every prompt after `delay` seconds without blocking the event loop"""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def invoke(self, prompt):
+        time.sleep(self.delay)
+        return AIMessage(content="Ответ", response_metadata={"finish_reason": "stop"})
+
+    async def ainvoke(self, prompt):
+        await asyncio.sleep(self.delay)
+        return AIMessage(content="Ответ", response_metadata={"finish_reason": "stop"})
+
+
+def synthetic_data(num_titles, rng):
+    return {
+        f"Город {i}": [
+            " ".join(rng.choices(WORDS, k=rng.randint(10, 60))) for _ in range(5)
+        ]
+        for i in range(num_titles)
+    }
+
+
+async def simulate_user(rag, queries, latencies):
+    for query in queries:
+        start = time.perf_counter()
+        await rag.arun(query, use_cache=False)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_load(rag, num_users, requests_per_user, rng):
+    latencies = []
+    users = [
+        simulate_user(
+            rag,
+            [" ".join(rng.choices(WORDS, k=4)) for _ in range(requests_per_user)],
+            latencies,
+        )
+        for _ in range(num_users)
+    ]
+    start = time.perf_counter()
+    await asyncio.gather(*users)
+    return time.perf_counter() - start, np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-dir", help="Index the real dumps")
+    parser.add_argument("--index-dir", help="Directory of the vectorstores")
+    parser.add_argument("--titles", type=int, default=200)
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests-per-user", type=int, default=5)
+    parser.add_argument("--llm-delay", type=float, default=0.5)
+    parser.add_argument("--retrieval-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    index_dir = args.index_dir or tempfile.mkdtemp()
+    if args.data_dir:
+        data = LazyChunkedData(datadir=args.data_dir)
+    else:
+        data = synthetic_data(args.titles, rng)
+    rag = RAG(
+        data,
+        retriever_kwargs={
+            "title_index_path": os.path.join(index_dir, "title_index"),
+            "chunk_index_path": os.path.join(index_dir, "chunk_index"),
+            "manifest_path": os.path.join(index_dir, "manifest.json"),
+            "cache_size": 0,
+        },
+        answer_cache_size=0,
+        retrieval_workers=args.retrieval_workers,
+    )
+    rag.llm = StubLLM(args.llm_delay)
+
+    query = " ".join(rng.choices(WORDS, k=4))
+    start = time.perf_counter()
+    rag.run(query, use_cache=False)
+    print(f"Sequential run: {time.perf_counter() - start:.3f} s per request\n")
+
+    print(f"{'users':>6}{'requests':>10}{'req/sec':>10}{'p50, s':>10}{'p95, s':>10}")
+    for num_users in args.users:
+        elapsed, latencies = asyncio.run(
+            run_load(rag, num_users, args.requests_per_user, rng)
+        )
+        print(
+            f"{num_users:>6}{len(latencies):>10}{len(latencies) / elapsed:>10.2f}"
+            f"{np.percentile(latencies, 50):>10.3f}{np.percentile(latencies, 95):>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Parity and speed of the int8 ONNX embedding backend against the torch one.
+
+Parity: cosine similarity of the vectors of both backends for the same texts and
+overlap of the top-k chunks found with ONNX query vectors in an index of torch
+chunk vectors (how the backend is used after switching without re-indexing), and
+in an index built with ONNX too. Speed: model load time, single query latency
+and batch throughput.
+
+Usage:
+    python benchmarks/onnx_embeddings.py --data-dir data --limit 2000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append("./")
+
+import faiss
+import numpy as np
+
+from src.data.data_processing import load_and_preprocess_data
+from src.embeddings import export_onnx_model, load_embeddings
+
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+ONNX_PATH = "models/paraphrase-multilingual-MiniLM-L12-v2-onnx"
+WORDS = "город музей театр парк река собор улица площадь кремль мост".split()
+
+
+def load_texts(args, rng):
+    if args.data_dir:
+        data = load_and_preprocess_data(datadir=args.data_dir)
+        texts = [chunk for chunks in data.values() for chunk in chunks]
+        rng.shuffle(texts)
+    else:
+        texts = [
+            " ".join(rng.choices(WORDS, k=rng.randint(10, 160)))
+            for _ in range(args.limit)
+        ]
+    texts = texts[: args.limit]
+    # queries are short like user questions: the beginning of some chunks
+    queries = [" ".join(text.split()[:8]) for text in rng.sample(texts, args.queries)]
+    return texts, queries
+
+
+def top_k(chunk_vectors, query_vectors, k):
+    index = faiss.IndexFlatIP(chunk_vectors.shape[1])
+    index.add(chunk_vectors)
+    return index.search(query_vectors, k)[1]
+
+
+def overlap(found, expected):
+    return np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found, expected)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-dir", help="Take chunks from the real dumps")
+    parser.add_argument("--onnx-path", default=ONNX_PATH)
+    parser.add_argument("--limit", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.onnx_path):
+        export_onnx_model(MODEL_NAME, args.onnx_path)
+    texts, queries = load_texts(args, random.Random(0))
+
+    backends = {}
+    for backend in ["onnx", "torch"]:
+        start = time.perf_counter()
+        backends[backend] = load_embeddings(
+            MODEL_NAME, backend=backend, onnx_path=args.onnx_path
+        )
+        print(f"{backend} model loaded in {time.perf_counter() - start:.2f} s")
+
+    chunk_vectors, query_vectors = {}, {}
+    print(f"\n{'backend':<8}{'query p50, ms':>15}{'chunks/sec':>12}")
+    for backend, embeddings in backends.items():
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            embeddings.embed_query(query)
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        throughput = len(texts) / (time.perf_counter() - start)
+        chunk_vectors[backend] = vectors
+        query_vectors[backend] = np.asarray(
+            embeddings.embed_documents(queries), dtype=np.float32
+        )
+        print(
+            f"{backend:<8}{np.percentile(latencies, 50) * 1000:>15.2f}{throughput:>12.1f}"
+        )
+
+    cosines = (chunk_vectors["onnx"] * chunk_vectors["torch"]).sum(axis=1)
+    print(f"\nCosine onnx vs torch: mean {cosines.mean():.4f}, min {cosines.min():.4f}")
+    expected = top_k(chunk_vectors["torch"], query_vectors["torch"], args.k)
+    mixed = top_k(chunk_vectors["torch"], query_vectors["onnx"], args.k)
+    onnx_only = top_k(chunk_vectors["onnx"], query_vectors["onnx"], args.k)
+    print(
+        f"Top-{args.k} overlap, onnx queries, torch index: {overlap(mixed, expected):.3f}"
+    )
+    print(
+        f"Top-{args.k} overlap, onnx queries, onnx index: {overlap(onnx_only, expected):.3f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+Offline benchmark of `HierarchicalRetriever`: index build time, index size on disk
+and in memory, cold-load time, p50/p95/p99 latency of `retrieve` and recall@k of
+every index type against the exact flat index, at several corpus sizes.
+
+The synthetic corpus is {title: chunks} with a few topic words per title, so that
+queries have relevant titles. With `--data-dir` the real dumps are indexed instead.
+Cold loads run in a fresh process, as on a restart. The report is saved as JSON
+with the commit and settings it was measured with; `--compare` prints the changes
+against an earlier report. Embedding the chunks takes most of the build time of
+large corpora, `index_report.py` compares the indexes alone.
+
+Usage:
+    python benchmarks/retrieval_benchmark.py --chunks 1000 10000 --index-types flat hnsw ivf
+    python benchmarks/retrieval_benchmark.py --data-dir data --output report.json --compare old.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append("./")
+
+import faiss
+import numpy as np
+
+from src.data.data_processing import load_and_preprocess_data
+from src.retriever import HierarchicalRetriever
+
+SYLLABLES = "ка ро ма ли не то ва ры су де мо ги ла пе зу ско ток вер град".split()
+SECTIONS = ["История", "Достопримечательности", "Транспорт", "Климат", "Кухня"]
+
+
+def synthetic_data(num_chunks, rng, vocabulary_size=5000):
+    vocabulary = sorted(
+        {
+            "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4)))
+            for _ in range(vocabulary_size)
+        }
+    )
+    data = {}
+    total = 0
+    while total < num_chunks:
+        title = (
+            f"Город {len(data) // len(SECTIONS)}: {SECTIONS[len(data) % len(SECTIONS)]}"
+        )
+        topic = rng.sample(vocabulary, 5)
+        chunks = [
+            " ".join(
+                rng.choices(topic, k=10)
+                + rng.choices(vocabulary, k=rng.randint(20, 120))
+            )
+            for _ in range(min(rng.randint(1, 8), num_chunks - total))
+        ]
+        rng.shuffle(chunks)
+        data[title] = chunks
+        total += len(chunks)
+    return data
+
+
+def make_queries(data, num_queries, rng):
+    """A few words of a random chunk, as short as user questions"""
+    titles = list(data)
+    queries = []
+    for _ in range(num_queries):
+        words = rng.choice(data[rng.choice(titles)]).split()
+        start = rng.randrange(max(1, len(words) - 5))
+        queries.append(" ".join(words[start : start + 5]))
+    return queries
+
+
+def rss_mb():
+    """Resident memory of the process, None if /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+def directory_size_mb(path):
+    return (
+        sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(path)
+            for name in names
+        )
+        / 2**20
+    )
+
+
+def retriever_kwargs(args, index_dir, index_type):
+    return {
+        "embedding_model": args.embedding_model,
+        "embedding_backend": args.embedding_backend,
+        "index_type": index_type,
+        "store_format": args.store_format,
+        "chunk_shards": args.chunk_shards,
+        "title_index_path": os.path.join(index_dir, "title_index"),
+        "chunk_index_path": os.path.join(index_dir, "chunk_index"),
+        "manifest_path": os.path.join(index_dir, "manifest.json"),
+        "mmap_path": os.path.join(index_dir, "mmap"),
+        "title_top_n": args.title_top_n,
+        "chunks_per_title": args.chunks_per_title,
+        "total_chunks": args.k,
+        "max_distance": args.max_distance,
+        # every query is measured without caches
+        "cache_size": 0,
+    }
+
+
+def index_memory_mb(retriever):
+    """Size of the FAISS indexes the retriever searches"""
+    indexes = [retriever.title_store.index]
+    if retriever.chunk_vectorstore is not None:
+        shards = getattr(retriever.chunk_vectorstore, "shards", [])
+        indexes += [shard.index for shard in shards or [retriever.chunk_vectorstore]]
+    return sum(faiss.serialize_index(index).nbytes for index in indexes) / 2**20
+
+
+def cold_load(kwargs):
+    """Runs in a fresh process: load the saved stores without the data"""
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    retriever = HierarchicalRetriever(**kwargs)
+    elapsed = time.perf_counter() - start
+    rss_after = rss_mb()
+    return {
+        "cold_load_s": elapsed,
+        "cold_load_stages_s": dict(retriever.startup_timer.timings),
+        "rss_mb": rss_after - rss_before if rss_before is not None else None,
+    }
+
+
+def percentiles(latencies, prefix):
+    return {
+        f"{prefix}_p{q}_ms": float(np.percentile(latencies, q) * 1000)
+        for q in (50, 95, 99)
+    }
+
+
+def measure(retriever, queries, vectors):
+    """Latency of `retrieve` and of the search alone, without the query embedding"""
+    for query in queries[:5]:
+        retriever.retrieve(query)
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(retriever.retrieve(query))
+        latencies.append(time.perf_counter() - start)
+    search_latencies = []
+    for query, vector in zip(queries, vectors):
+        start = time.perf_counter()
+        retriever.retrieve_by_vector(vector, query=query)
+        search_latencies.append(time.perf_counter() - start)
+    return (
+        results,
+        {
+            **percentiles(latencies, "retrieve"),
+            **percentiles(search_latencies, "search"),
+        },
+    )
+
+
+def recall_at_k(results, true_results):
+    return float(
+        np.mean(
+            [
+                len(set(found) & set(true)) / len(true) if true else 1.0
+                for found, true in zip(results, true_results)
+            ]
+        )
+    )
+
+
+def benchmark(args, data, name, pool):
+    num_chunks = sum(len(chunks) for chunks in data.values())
+    print(f"\n{name}: {len(data)} titles, {num_chunks} chunks")
+    print(HEADER)
+    queries = make_queries(data, args.queries, random.Random(1))
+    rows = []
+    true_results = None
+    # flat goes first, it is the baseline of recall
+    index_types = ["flat"] + [t for t in args.index_types if t != "flat"]
+    for index_type in index_types:
+        index_dir = tempfile.mkdtemp(dir=args.work_dir)
+        kwargs = retriever_kwargs(args, index_dir, index_type)
+        start = time.perf_counter()
+        retriever = HierarchicalRetriever(data, **kwargs)
+        build_time = time.perf_counter() - start
+
+        vectors = retriever.embed_queries(queries)
+        results, latencies = measure(retriever, queries, vectors)
+        if true_results is None:
+            true_results = results
+        row = {
+            "corpus": name,
+            "titles": len(data),
+            "chunks": num_chunks,
+            "index_type": index_type,
+            "store_format": args.store_format,
+            "chunk_shards": args.chunk_shards,
+            "build_s": build_time,
+            "build_stages_s": dict(retriever.startup_timer.timings),
+            "disk_mb": directory_size_mb(index_dir),
+            "index_memory_mb": index_memory_mb(retriever),
+            f"recall@{args.k}": recall_at_k(results, true_results),
+            **latencies,
+        }
+        del retriever
+        row.update(pool.apply(cold_load, (kwargs,)))
+        rows.append(row)
+        print_row(row, args.k)
+        if not args.keep_indexes:
+            shutil.rmtree(index_dir, ignore_errors=True)
+    return rows
+
+
+HEADER = (
+    f"{'index':<8}{'build s':>9}{'load s':>9}{'disk MB':>9}{'RSS MB':>9}"
+    f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'recall':>8}"
+)
+
+
+def print_row(row, k):
+    rss = f"{row['rss_mb']:>9.1f}" if row["rss_mb"] is not None else f"{'-':>9}"
+    print(
+        f"{row['index_type']:<8}{row['build_s']:>9.2f}{row['cold_load_s']:>9.2f}"
+        f"{row['disk_mb']:>9.1f}{rss}{row['retrieve_p50_ms']:>9.2f}"
+        f"{row['retrieve_p95_ms']:>9.2f}{row['retrieve_p99_ms']:>9.2f}"
+        f"{row[f'recall@{k}']:>8.3f}"
+    )
+
+
+def compare(report, previous_path):
+    """Print the relative change of every metric against an earlier report"""
+    with open(previous_path) as f:
+        previous = json.load(f)
+
+    def key(row):
+        return (
+            row["corpus"],
+            row["index_type"],
+            row["store_format"],
+            row.get("chunk_shards", 1),
+        )
+
+    previous_rows = {key(row): row for row in previous["results"]}
+    print(f"\nChanges against {previous_path} ({previous['meta'].get('commit')}):")
+    for row in report["results"]:
+        old = previous_rows.get(key(row))
+        if old is None:
+            continue
+        changes = [
+            f"{metric} {old[metric]:.3g} -> {value:.3g} ({value / old[metric] - 1:+.0%})"
+            for metric, value in row.items()
+            if isinstance(value, float)
+            and isinstance(old.get(metric), float)
+            and old[metric]
+            and abs(value / old[metric] - 1) > change_threshold(metric)
+        ]
+        print(
+            f"  {row['corpus']}, {row['index_type']}: "
+            + ("; ".join(changes) or "no changes")
+        )
+
+
+def change_threshold(metric):
+    """Smaller changes are not shown: latencies are noisy, recall is not"""
+    return 0.0 if metric.startswith("recall") else 0.1
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-dir", help="Index the real dumps instead")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument(
+        "--index-types", nargs="+", default=["flat", "ivf", "hnsw", "sq8"]
+    )
+    parser.add_argument("--store-format", default="langchain")
+    parser.add_argument(
+        "--chunk-shards", type=int, default=1, help="Shards of the chunk index"
+    )
+    parser.add_argument(
+        "--embedding-model",
+        default="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+    )
+    parser.add_argument("--embedding-backend", default="torch")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5, help="`total_chunks` of retrieve")
+    parser.add_argument("--title-top-n", type=int, default=10)
+    parser.add_argument("--chunks-per-title", type=int, default=2)
+    parser.add_argument("--max-distance", type=float, default=10)
+    parser.add_argument(
+        "--work-dir", help="Directory for the indexes, temporary by default"
+    )
+    parser.add_argument("--keep-indexes", action="store_true")
+    parser.add_argument("--output", default="retrieval_benchmark.json")
+    parser.add_argument("--compare", help="Earlier report to compare with")
+    args = parser.parse_args()
+
+    if args.data_dir:
+        corpora = [("dumps", lambda: load_and_preprocess_data(datadir=args.data_dir))]
+    else:
+        corpora = [
+            (
+                f"synthetic_{num_chunks}",
+                lambda num_chunks=num_chunks: synthetic_data(
+                    num_chunks, random.Random(0)
+                ),
+            )
+            for num_chunks in args.chunks
+        ]
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for name, load in corpora:
+            results.extend(benchmark(args, load(), name, pool))
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "faiss": faiss.__version__,
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nReport saved to {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
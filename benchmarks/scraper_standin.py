@@ -0,0 +1,153 @@
+"""
+Scraper against a local HTTP stand-in that serves canned Wikivoyage-like pages.
+
+The stand-in answers after `--latency` seconds and fails the first request of every
+`--fail-every`-th page with 503, so retries are exercised. The script compares
+sequential and concurrent scraping, then interrupts a checkpointed run halfway
+and checks that resuming fetches only the remaining pages. Last, it crawls through an
+`HttpCache` twice, changing `--changed` of the pages in between: the stand-in sends
+ETags and answers 304 to pages that did not change, so the refresh crawl downloads
+only the changed ones.
+
+Usage:
+    python benchmarks/scraper_standin.py --pages 200 --workers 1 8 --latency 0.05
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+sys.path.append("./")
+
+from src.data.data_parsing import WikiParser
+from src.data.fetching import Fetcher, HttpCache
+
+PAGE_TEMPLATE = """<html><body>
+<div class="mw-heading mw-heading2"><h2 id="Достопримечательности">Достопримечательности</h2></div>
+<p>В городе {name} есть музей, театр и собор.</p>
+<ul><li>Музей {name}</li><li>Театр {name}</li></ul>
+<div class="mw-heading mw-heading2"><h2 id="Транспорт">Транспорт</h2></div>
+<p>До города {name} можно добраться поездом.</p>
+</body></html>"""
+
+
+class StandinServer(ThreadingHTTPServer):
+    def __init__(self, latency, fail_every):
+        super().__init__(("127.0.0.1", 0), StandinHandler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        self.failed = set()
+        self.revisions = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        name = unquote(self.path.rsplit("/", 1)[-1]).replace("_", " ")
+        number = int(name.rsplit(" ", 1)[-1])
+        time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            fail = number % server.fail_every == 0 and name not in server.failed
+            server.failed.add(name)
+        etag = f'"{server.revisions.get(name, 0)}"'
+        if fail:
+            body, status = b"", 503
+        elif self.headers.get("If-None-Match") == etag:
+            body, status = b"", 304
+        else:
+            text = PAGE_TEMPLATE.format(name=name)
+            text += f"<!-- revision {server.revisions.get(name, 0)} -->"
+            body, status = text.encode(), 200
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        if fail:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_parser(server, workers, cache=None):
+    fetcher = Fetcher(max_workers=workers, requests_per_second=None, backoff=0.01)
+    return WikiParser(
+        base_url=server.url, fetcher=fetcher, source="wikivoyage", cache=cache
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--fail-every", type=int, default=10)
+    parser.add_argument("--changed", type=float, default=0.1)
+    args = parser.parse_args()
+
+    server = StandinServer(args.latency, args.fail_every)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pages = {f"Город {i}": f"/wiki/Город_{i}" for i in range(1, args.pages + 1)}
+
+    results = []
+    for workers in args.workers:
+        server.failed.clear()
+        start = time.perf_counter()
+        data = make_parser(server, workers).scrape_pages(pages)
+        elapsed = time.perf_counter() - start
+        results.append(data)
+        print(
+            f"{workers} workers: {len(data)} pages in {elapsed:.2f} s "
+            f"({len(data) / elapsed:.1f} pages/sec)"
+        )
+    print(f"Same data: {all(data == results[0] for data in results)}")
+
+    checkpoint_path = os.path.join(tempfile.mkdtemp(), "checkpoint.jsonl")
+    wiki_parser = make_parser(server, max(args.workers))
+    half = dict(list(pages.items())[: args.pages // 2])
+    wiki_parser.scrape_pages(half, checkpoint_path=checkpoint_path)
+    server.requests = 0
+    data = wiki_parser.scrape_pages(pages, checkpoint_path=checkpoint_path)
+    print(
+        f"Resumed run: {server.requests} requests for the remaining "
+        f"{len(pages) - len(half)} pages, same data: {data == results[0]}"
+    )
+
+    cache = HttpCache(tempfile.mkdtemp())
+    wiki_parser = make_parser(server, max(args.workers), cache)
+    wiki_parser.scrape_pages(pages)
+    first_bytes = cache.downloaded_bytes
+    changed = random.Random(0).sample(sorted(pages), int(len(pages) * args.changed))
+    for name in changed:
+        server.revisions[name] = 1
+    cache.hits = cache.misses = cache.downloaded_bytes = 0
+    start = time.perf_counter()
+    data = wiki_parser.scrape_pages(pages)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Refresh crawl with {len(changed)} changed pages: {cache.misses} pages "
+        f"parsed in {elapsed:.2f} s, {cache.downloaded_bytes} bytes downloaded "
+        f"vs {first_bytes} in the first crawl, "
+        f"same unchanged data: {all(data[n] == results[0][n] for n in pages if n not in changed)}"
+    )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Peak memory and time of corpus ingestion: legacy JSON loading vs streaming JSONL.
+
+The legacy path loads whole JSON files, then `flatten_data` and `make_chunks` copy
+everything again. The streaming path reads JSONL records one page at a time through
+`stream_chunks`, either collected into {title: chunks} like `load_and_preprocess_data`
+or only consumed, as an indexer that writes chunks out would do. Peak memory is
+measured with tracemalloc. A synthetic corpus is written in both formats unless
+`--data-dir` with legacy JSON files is given.
+
+Usage:
+    python benchmarks/streaming_ingestion.py --pages 2000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append("./")
+
+from src.data.data_processing import (
+    flatten_data,
+    iter_records,
+    list_data_files,
+    load_and_preprocess_data,
+    make_chunks,
+    stream_chunks,
+)
+
+WORDS = "город музей театр парк река собор улица площадь кремль мост".split()
+SECTIONS = ["История", "Достопримечательности", "Транспорт", "Климат", "Ссылки"]
+
+
+def make_corpus(datadir, num_pages, rng):
+    """Two legacy JSON files with overlapping pages, like the scraped city lists"""
+    pages = {
+        f"Город {i}": {
+            section: " ".join(rng.choices(WORDS, k=rng.randint(50, 600)))
+            for section in SECTIONS
+        }
+        for i in range(num_pages)
+    }
+    names = list(pages)
+    for file_name, file_pages in [
+        ("cities_data.json", names),
+        ("big_cities_data.json", names[: num_pages // 4]),
+    ]:
+        with open(os.path.join(datadir, file_name), "w", encoding="utf-8") as f:
+            json.dump(
+                {name: pages[name] for name in file_pages},
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+
+def convert_to_jsonl(paths, datadir):
+    for path in paths:
+        jsonl_path = os.path.join(datadir, os.path.basename(path) + "l")
+        with open(jsonl_path, "w", encoding="utf-8") as f:
+            for name, data in iter_records(path):
+                record = {"name": name, "data": data}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def legacy_load(paths):
+    data = []
+    for path in paths:
+        with open(path) as f:
+            data.append(json.load(f))
+    return make_chunks(flatten_data(data))
+
+
+def consume(paths):
+    return sum(len(chunks) for _, chunks in stream_chunks(paths=paths))
+
+
+def measure(name, function, paths):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(paths)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<24}{elapsed:>8.2f} s{peak / 2**20:>12.1f} MB")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-dir", help="Directory with legacy JSON data files")
+    parser.add_argument("--pages", type=int, default=2000)
+    args = parser.parse_args()
+
+    json_dir, jsonl_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    if args.data_dir:
+        json_dir = args.data_dir
+    else:
+        make_corpus(json_dir, args.pages, random.Random(0))
+    json_paths = [path for path in list_data_files(json_dir) if path.endswith(".json")]
+    convert_to_jsonl(json_paths, jsonl_dir)
+    jsonl_paths = list_data_files(jsonl_dir)
+    size = sum(os.path.getsize(path) for path in json_paths)
+    print(f"Corpus: {size / 2**20:.1f} MB of JSON in {len(json_paths)} files\n")
+
+    print(f"{'':<24}{'time':>10}{'peak memory':>14}")
+    legacy = measure("legacy JSON", legacy_load, json_paths)
+    legacy_json = measure(
+        "streamed JSON", lambda paths: load_and_preprocess_data(paths=paths), json_paths
+    )
+    streamed = measure(
+        "streamed JSONL",
+        lambda paths: load_and_preprocess_data(paths=paths),
+        jsonl_paths,
+    )
+    count = measure("streamed JSONL, consumed", consume, jsonl_paths)
+
+    same = all(
+        data.keys() == legacy.keys()
+        and all(set(data[title]) == set(legacy[title]) for title in legacy)
+        for data in [legacy_json, streamed]
+    )
+    print(
+        f"\nSame chunks: {same}, {count} chunks streamed, "
+        f"{sum(len(chunks) for chunks in legacy.values())} chunks loaded"
+    )
+
+
+if __name__ == "__main__":
+    main()
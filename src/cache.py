@@ -0,0 +1,182 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+
+def normalize_query(query):
+    """Cache key of a query: case, "ё", extra spaces and final punctuation are ignored"""
+    query = query.lower().replace("ё", "е")
+    query = re.sub(r"\s+", " ", query).strip()
+    return query.rstrip("?!. ")
+
+
+class LRUCache:
+    """Thread-safe LRU cache with a size bound, optional TTL and hit/miss counters"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """
+        :param maxsize: Number of items after which the least recently used are evicted
+        :param ttl: Seconds after which an item expires, never if None
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] is not None and item[0] < time.time():
+                del self._items[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._items[key] = (expires_at, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def to_json(self):
+        with self._lock:
+            return [
+                [key, expires_at, value]
+                for key, (expires_at, value) in self._items.items()
+            ]
+
+    def load_json(self, items):
+        now = time.time()
+        for key, expires_at, value in items:
+            if expires_at is None or expires_at > now:
+                with self._lock:
+                    self._items[key] = (expires_at, value)
+        with self._lock:
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+class SemanticCache:
+    """
+    Values of earlier queries, found by cosine similarity of normalized query
+    embeddings in an in-process FAISS index. A cached value is returned only if
+    it was stored with the same `context_key`, e.g. the same retrieved chunks.
+    """
+
+    def __init__(self, threshold=0.95, maxsize=1024, search_k=8):
+        """
+        :param threshold: Minimal cosine similarity between queries for a hit
+        :param maxsize: Number of entries after which the least recently used are evicted
+        :param search_k: Number of nearest cached queries checked for the context key
+        """
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.search_k = search_k
+        self.hits = 0
+        self.misses = 0
+        self.index = None
+        self._entries = OrderedDict()  # id -> (context_key, value)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def get(self, query_vector, context_key):
+        with self._lock:
+            if self.index is not None and self.index.ntotal:
+                similarities, ids = self.index.search(
+                    np.asarray(query_vector, dtype=np.float32)[None, :],
+                    min(self.search_k, self.index.ntotal),
+                )
+                for similarity, entry_id in zip(similarities[0], ids[0]):
+                    if similarity < self.threshold:
+                        break
+                    entry_key, value = self._entries[entry_id]
+                    if entry_key == context_key:
+                        self._entries.move_to_end(entry_id)
+                        self.hits += 1
+                        return value
+            self.misses += 1
+            return None
+
+    def put(self, query_vector, context_key, value):
+        query_vector = np.asarray(query_vector, dtype=np.float32)[None, :]
+        with self._lock:
+            if self.index is None:
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(query_vector.shape[1]))
+            self.index.add_with_ids(query_vector, np.array([self._next_id]))
+            self._entries[self._next_id] = (context_key, value)
+            self._next_id += 1
+            while len(self._entries) > self.maxsize:
+                evicted_id, _ = self._entries.popitem(last=False)
+                self.index.remove_ids(np.array([evicted_id], dtype=np.int64))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self.index is not None:
+                self.index.reset()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def save_caches(path, caches, **meta):
+    """Save several named `LRUCache`s with json-serializable values or numpy arrays"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "meta": meta,
+                "caches": {name: cache.to_json() for name, cache in caches.items()},
+            },
+            f,
+            ensure_ascii=False,
+            default=lambda value: value.tolist(),
+        )
+
+
+def load_caches(path):
+    """:return: meta and {name: items} saved by `save_caches` or None"""
+    if not os.path.exists(path):
+        return None, {}
+    with open(path, encoding="utf-8") as f:
+        saved = json.load(f)
+    return saved["meta"], saved["caches"]
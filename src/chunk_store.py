@@ -0,0 +1,303 @@
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+
+
+class StringTable:
+    """Strings stored back to back in one utf-8 buffer, `offsets` has len(strings) + 1 items"""
+
+    def __init__(self, buffer: np.ndarray, offsets: np.ndarray):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(buffer, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.buffer[start:end].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class TitleStore:
+    """Title index. Title ids are rows of the index"""
+
+    def __init__(self, index, titles: Sequence[str]):
+        self.index = index
+        self.titles = titles
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore):
+        titles = [
+            vectorstore.docstore.search(
+                vectorstore.index_to_docstore_id[row]
+            ).page_content
+            for row in range(len(vectorstore.index_to_docstore_id))
+        ]
+        return cls(vectorstore.index, titles)
+
+    def search(
+        self, query_vectors: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: title ids and squared L2 distances, (num_queries, k) each.
+            Missing results have id -1
+        """
+        distances, title_ids = self.index.search(query_vectors, k)
+        return title_ids, distances
+
+
+class ChunkStore:
+    """
+    Chunk embeddings grouped by title.
+
+    Rows of the chunk index that belong to the title with id `t` are
+    `rows[offsets[t]:offsets[t + 1]]`. When chunks were indexed title by title
+    these are contiguous ranges of the index, but the map does not rely on it.
+    """
+
+    def __init__(
+        self,
+        titles: Sequence[str],
+        offsets: np.ndarray,
+        rows: np.ndarray,
+        get_vectors: Callable[[np.ndarray], np.ndarray],
+        get_text: Callable[[int], str],
+    ):
+        """
+        :param titles: Title of every title id
+        :param offsets: Start of every title in `rows`, with the total number of rows at the end
+        :param rows: Rows of the chunk index sorted by title id
+        :param get_vectors: Returns embeddings for an array of rows
+        :param get_text: Returns chunk text for a row
+        """
+        self.titles = titles
+        self.offsets = offsets
+        self.rows = rows
+        self.get_vectors = get_vectors
+        self.get_text = get_text
+        self._title_to_id = None
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore, titles: List[str]):
+        """
+        Build the title -> rows map from the `title` metadata of a FAISS vectorstore
+
+        :param titles: Titles in the order of title ids, e.g. `TitleStore.titles`
+        """
+        titles = list(titles)
+        title_to_id = {title: i for i, title in enumerate(titles)}
+        chunk_title_ids = np.empty(
+            len(vectorstore.index_to_docstore_id), dtype=np.int64
+        )
+        for row, docstore_id in vectorstore.index_to_docstore_id.items():
+            title = vectorstore.docstore.search(docstore_id).metadata["title"]
+            if title not in title_to_id:
+                title_to_id[title] = len(titles)
+                titles.append(title)
+            chunk_title_ids[row] = title_to_id[title]
+
+        rows = np.argsort(chunk_title_ids, kind="stable")
+        counts = np.bincount(chunk_title_ids, minlength=len(titles))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        def get_text(row):
+            docstore_id = vectorstore.index_to_docstore_id[int(row)]
+            return vectorstore.docstore.search(docstore_id).page_content
+
+        return cls(
+            titles,
+            offsets,
+            rows,
+            get_vectors=lambda rows: vectorstore.index.reconstruct_batch(rows),
+            get_text=get_text,
+        )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def title_ids(self, titles: Sequence[str]) -> np.ndarray:
+        if self._title_to_id is None:
+            self._title_to_id = {title: i for i, title in enumerate(self.titles)}
+        return np.array(
+            [
+                self._title_to_id[title]
+                for title in titles
+                if title in self._title_to_id
+            ],
+            dtype=np.int64,
+        )
+
+    def gather(self, title_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows of the given titles and position of the title in `title_ids` for each row"""
+        starts = self.offsets[title_ids]
+        lengths = self.offsets[title_ids + 1] - starts
+        segments = np.repeat(np.arange(len(title_ids)), lengths)
+        segment_starts = np.cumsum(lengths) - lengths
+        positions = (
+            np.arange(lengths.sum()) - segment_starts[segments] + starts[segments]
+        )
+        return self.rows[positions], segments
+
+    def search(
+        self, query_vector: np.ndarray, title_ids: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Exact top-k chunks for every title in a single scoring pass
+
+        :return: rows, squared L2 distances and title ids of the found chunks,
+            grouped by title in the order of `title_ids`
+        """
+        rows, distances, title_ids, _ = self.search_many(
+            query_vector[None, :], title_ids[None, :], k
+        )
+        return rows, distances, title_ids
+
+    def search_many(
+        self, query_vectors: np.ndarray, title_ids: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Batched `search`, `title_ids` has a row of titles for every query, -1 is skipped
+
+        :return: rows, squared L2 distances, title ids and query numbers of the
+            found chunks, grouped by query and then by title in the order of `title_ids`
+        """
+        queries, columns = np.nonzero(title_ids >= 0)
+        title_ids = title_ids[queries, columns]
+        rows, segments = self.gather(title_ids)
+        if len(rows) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, np.empty(0, dtype=np.float32), empty, empty
+        row_queries = queries[segments]
+        vectors = self.get_vectors(rows)
+        distances = ((vectors - query_vectors[row_queries]) ** 2).sum(axis=1)
+
+        order = np.lexsort((distances, segments))
+        segment_starts = np.searchsorted(segments[order], np.arange(len(title_ids)))
+        ranks = np.arange(len(order)) - segment_starts[segments[order]]
+        order = order[ranks < k]
+        return (
+            rows[order],
+            distances[order],
+            title_ids[segments[order]],
+            row_queries[order],
+        )
+
+
+class ShardedChunkStore:
+    """
+    `ChunkStore` over several shards of the chunk index, with the same interface.
+
+    Rows are numbered across the shards: the rows of shard `s` follow the rows of
+    shards before it. Title ids are shared by all shards. A query is only sent to
+    the shards that hold chunks of its titles, the shards are searched in
+    `executor` and their top-k chunks per title are merged, so results are the
+    same as of one `ChunkStore` of all chunks.
+    """
+
+    def __init__(self, shards: Sequence[ChunkStore], executor=None):
+        """
+        :param shards: Chunk stores of the shards with the same `titles`
+        :param executor: `concurrent.futures` executor to search the shards in
+            parallel, they are searched one by one if None
+        """
+        self.shards = list(shards)
+        self.titles = self.shards[0].titles
+        self.executor = executor
+        sizes = [len(shard) for shard in self.shards]
+        self.bases = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        # has_title[s, t]: shard s holds chunks of title t
+        self.has_title = np.array([np.diff(shard.offsets) > 0 for shard in shards])
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore, titles: List[str], executor=None):
+        """:param vectorstore: `ShardedVectorStore`, its empty shards are skipped"""
+        shards = []
+        for shard in vectorstore.stores:
+            shards.append(ChunkStore.from_vectorstore(shard, titles))
+            # titles missing from the title index are appended, ids stay shared
+            titles = shards[-1].titles
+        for shard in shards:
+            missing = len(titles) - len(shard.offsets) + 1
+            shard.offsets = np.concatenate(
+                [shard.offsets, np.full(missing, shard.offsets[-1])]
+            )
+            shard.titles = titles
+        return cls(shards, executor)
+
+    def __len__(self):
+        return int(self.bases[-1])
+
+    def title_ids(self, titles: Sequence[str]) -> np.ndarray:
+        return self.shards[0].title_ids(titles)
+
+    def _locate(self, row):
+        shard = int(np.searchsorted(self.bases, row, side="right")) - 1
+        return self.shards[shard], row - self.bases[shard]
+
+    def get_text(self, row):
+        shard, row = self._locate(row)
+        return shard.get_text(row)
+
+    def search(
+        self, query_vector: np.ndarray, title_ids: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Same as `ChunkStore.search`"""
+        rows, distances, title_ids, _ = self.search_many(
+            query_vector[None, :], title_ids[None, :], k
+        )
+        return rows, distances, title_ids
+
+    def search_many(
+        self, query_vectors: np.ndarray, title_ids: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Same as `ChunkStore.search_many`, rows are numbered across the shards"""
+        found = title_ids >= 0
+        routed = []
+        for shard in range(len(self.shards)):
+            held = found & self.has_title[shard][np.where(found, title_ids, 0)]
+            if held.any():
+                routed.append((shard, np.where(held, title_ids, -1)))
+
+        def search_shard(args):
+            shard, shard_title_ids = args
+            rows, distances, found_ids, queries = self.shards[shard].search_many(
+                query_vectors, shard_title_ids, k
+            )
+            return rows + self.bases[shard], distances, found_ids, queries
+
+        if self.executor is not None and len(routed) > 1:
+            results = list(self.executor.map(search_shard, routed))
+        else:
+            results = [search_shard(args) for args in routed]
+        if not results:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, np.empty(0, dtype=np.float32), empty, empty
+        rows, distances, found_ids, queries = (
+            np.concatenate(parts) for parts in zip(*results)
+        )
+
+        # position of every found title in its row of `title_ids`
+        input_queries, columns = np.nonzero(found)
+        num_titles = len(self.titles)
+        keys = input_queries * num_titles + title_ids[input_queries, columns]
+        key_order = np.argsort(keys, kind="stable")
+        positions = np.searchsorted(keys[key_order], queries * num_titles + found_ids)
+        found_columns = columns[key_order[positions]]
+
+        # exact top-k per title, if the chunks of a title are in several shards
+        order = np.lexsort((distances, found_columns, queries))
+        groups = queries[order] * title_ids.shape[1] + found_columns[order]
+        group_starts = np.searchsorted(groups, groups)
+        order = order[np.arange(len(order)) - group_starts < k]
+        return rows[order], distances[order], found_ids[order], queries[order]
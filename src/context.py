@@ -0,0 +1,171 @@
+"""
+Prompt context assembly under a token budget.
+
+Retrieved chunks are grouped by title, overlapping chunks of the same title are
+merged back into one text, and if the context does not fit into the budget, the
+sentences least similar to the query are dropped.
+"""
+import itertools
+import re
+
+import numpy as np
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?…])\s+")
+
+
+def estimate_tokens(text, chars_per_token=4.0):
+    """Rough number of tokens of GigaChat, which takes about 4 characters of Russian text per token"""
+    return int(np.ceil(len(text) / chars_per_token))
+
+
+def merge_overlap(first, second, min_overlap=20):
+    """
+    :return: `first` continued by `second` if `second` starts with the end of `first`,
+        as neighbouring chunks of the text splitter do, None otherwise
+    """
+    for size in range(min(len(first), len(second)), min_overlap - 1, -1):
+        if first.endswith(second[:size]):
+            rest = second[size:]
+            # the splitter strips the whitespace between chunks, keep it if it is shared
+            return (first + (rest if rest[:1].isspace() else " " + rest)).strip()
+    return None
+
+
+def merge_chunks(chunks, min_overlap=20):
+    """Merge the chunks of one title that overlap, in any order"""
+    merged = list(chunks)
+    joined = True
+    while joined and len(merged) > 1:
+        joined = None
+        for i, j in itertools.permutations(range(len(merged)), 2):
+            joined = merge_overlap(merged[i], merged[j], min_overlap)
+            if joined is not None:
+                merged[i] = joined
+                del merged[j]
+                break
+    return merged
+
+
+class Context(list):
+    """
+    Retrieved chunks, best first, as passed around by `RAG`, with the prompt text
+    built from them and its token statistics
+    """
+
+    def __init__(self, chunks, prompt=None, stats=None):
+        super().__init__(chunks)
+        self.prompt = prompt
+        self.stats = stats or {}
+
+
+class ContextBuilder:
+    """Builds the prompt context from retrieved chunks within `token_budget` tokens"""
+
+    def __init__(
+        self,
+        embeddings,
+        token_budget=None,
+        min_similarity=None,
+        count_tokens=estimate_tokens,
+        min_overlap=20,
+    ):
+        """
+        :param embeddings: LangChain embeddings of the retriever, to compare
+            sentences with the query
+        :param token_budget: Maximal number of tokens of the context, None for no
+            limit. Sentences are embedded to compress the context, on the path of the
+            request, so the budget should be above the usual size of the context
+        :param min_similarity: Sentences less similar to the query are always
+            dropped. By default sentences are dropped only to fit into the budget
+        :param count_tokens: Number of tokens of a text, e.g. `llm.get_num_tokens`
+        :param min_overlap: Minimal number of characters shared by neighbouring
+            chunks to merge them
+        """
+        self.embeddings = embeddings
+        self.token_budget = token_budget
+        self.min_similarity = min_similarity
+        self.count_tokens = count_tokens
+        self.min_overlap = min_overlap
+
+    def group(self, chunks):
+        """:return: {title: merged texts} in the order of the best chunk of every title"""
+        grouped = {}
+        for title, chunk in chunks:
+            grouped.setdefault(title, []).append(chunk)
+        return {
+            title: merge_chunks(texts, self.min_overlap)
+            for title, texts in grouped.items()
+        }
+
+    def format(self, grouped):
+        return "\n\n".join(
+            f"[{title}]\n" + "\n".join(texts)
+            for title, texts in grouped.items()
+            if texts
+        )
+
+    def compress(self, grouped, query_vector):
+        """Keep the sentences most similar to the query that fit into the budget"""
+        sentences = [
+            (title, i, sentence)
+            for title, texts in grouped.items()
+            for i, text in enumerate(texts)
+            for sentence in SENTENCE_PATTERN.split(text)
+            if sentence
+        ]
+        vectors = np.asarray(
+            self.embeddings.embed_documents([sentence for _, _, sentence in sentences]),
+            dtype=np.float32,
+        )
+        similarities = vectors @ query_vector
+        keep = np.ones(len(sentences), dtype=bool)
+        if self.min_similarity is not None:
+            keep &= similarities >= self.min_similarity
+        if self.token_budget is not None:
+            # title headers and separators are counted with the sentences
+            used = self.count_tokens(self.format({t: [""] for t in grouped}))
+            for position in np.argsort(-similarities, kind="stable"):
+                if not keep[position]:
+                    continue
+                tokens = self.count_tokens(sentences[position][2] + " ")
+                keep[position] = used + tokens <= self.token_budget
+                used += tokens * keep[position]
+
+        compressed = {title: [[] for _ in texts] for title, texts in grouped.items()}
+        for (title, i, sentence), kept in zip(sentences, keep):
+            if kept:
+                compressed[title][i].append(sentence)
+        return {
+            title: [" ".join(text) for text in texts if text]
+            for title, texts in compressed.items()
+        }
+
+    def build(self, query_vector, chunks):
+        """
+        :param query_vector: Normalized query embedding
+        :param chunks: (title, chunk) pairs, best first
+        :return: `Context` of the chunks with the prompt text and
+            "raw_tokens", "prompt_tokens" and "saved_tokens" stats, where raw
+            tokens are of the list of chunks pasted as is, as the prompt had it
+            before. Title headers can make the prompt longer than that, then
+            nothing is saved
+        """
+        texts = [chunk for _, chunk in chunks]
+        grouped = self.group(chunks)
+        prompt = self.format(grouped)
+        if self.min_similarity is not None or (
+            self.token_budget is not None
+            and self.count_tokens(prompt) > self.token_budget
+        ):
+            prompt = self.format(self.compress(grouped, query_vector))
+        raw_tokens = self.count_tokens(str(texts))
+        prompt_tokens = self.count_tokens(prompt)
+        return Context(
+            texts,
+            prompt=prompt,
+            stats={
+                "raw_tokens": raw_tokens,
+                "prompt_tokens": prompt_tokens,
+                "saved_tokens": max(raw_tokens - prompt_tokens, 0),
+            },
+        )
@@ -1,20 +1,61 @@
-import json
-import re
+import itertools
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
-import requests
-from bs4 import BeautifulSoup
 from tqdm import tqdm
 import wikipediaapi
 
+sys.path.append("./")
+
+from src.data.fetching import Checkpoint, Fetcher, HttpCache
+from src.data.html_extraction import (
+    extract_fragments,
+    extract_table,
+    extract_wikivoyage,
+    find_nested_class,
+    parse_html,
+)
+
+# bump when parsing changes, so that pages cached by older parsers are parsed again
+PARSER_VERSION = 1
+# titles per request for revision ids, the API limit
+REVISIONS_BATCH_SIZE = 50
+
 
 class WikiParser:
-    def __init__(self, base_url="https://ru.wikipedia.org"):
+    def __init__(
+        self, base_url="https://ru.wikipedia.org", fetcher=None, source=None, cache=None
+    ):
+        """
+        :param fetcher: `Fetcher` with the concurrency, rate limit and retry settings
+        :param source: "wikipedia" or "wikivoyage" page layout, by `base_url` by default
+        :param cache: `HttpCache` of parsed pages, unchanged pages are not downloaded
+            again: HTTP pages are revalidated with ETag / Last-Modified and
+            Wikipedia pages by their last revision id
+        """
         self.base_url = base_url
-        self.wiki_html = wikipediaapi.Wikipedia(
-            "MyProjectName (merlin@example.com)",
-            "ru",
-            extract_format=wikipediaapi.ExtractFormat.HTML,
+        self.source = source or (
+            "wikivoyage" if "wikivoyage" in base_url else "wikipedia"
         )
+        self.fetcher = fetcher or Fetcher()
+        self.cache = cache
+        self.revisions = {}
+        self._local = threading.local()
+
+    @property
+    def wiki_html(self):
+        """Wikipedia API client of the calling thread, each has its own HTTP session"""
+        if not hasattr(self._local, "wiki_html"):
+            self._local.wiki_html = wikipediaapi.Wikipedia(
+                self.fetcher.user_agent,
+                "ru",
+                extract_format=wikipediaapi.ExtractFormat.HTML,
+            )
+        return self._local.wiki_html
 
     def get_page_url(self, page_name):
         if self.base_url in page_name:
@@ -23,42 +64,20 @@ class WikiParser:
             page_name = page_name.split("/")[0].replace(" ", "_")
         return f"{self.base_url}/wiki/{page_name.replace(' ', '_')}"
 
-    def get_name_link(self, div):
-        a = div.find("a")
-        if a:
-            return a.get_text().strip(), a.get("href")
-        return None, None
-
     def find_iter_class(self, wrapper, node_class, terminal_class):
-        result = []
-        for item in wrapper.find_all(node_class):
-            terminals = item.find_all(class_=terminal_class)
-            result.extend(terminals)
-            children = item.find_all(class_=node_class)
-            for child in children:
-                result.extend(self.find_iter_class(child, node_class, terminal_class))
-        return result
+        """Elements of class `terminal_class` inside `node_class` tags of an lxml element"""
+        return find_nested_class(wrapper, node_class, terminal_class)
 
     def get_pages_from_table(self, index_page_name, target_column):
         index_page_url = self.get_page_url(index_page_name)
-        response = requests.get(index_page_url)
-        soup = BeautifulSoup(response.text, "html.parser")
+        return self.fetcher.get_parsed(
+            index_page_url,
+            lambda response: self.parse_table(response.text, target_column),
+            self.cache,
+        )
 
-        pages = {}
-        # Find tables with city lists
-        tables = soup.find_all("table")
-        for table in tables:
-            rows = table.find_all("tr")
-            all_cols = [col.get_text().strip() for col in rows[0].find_all("th")]
-            if target_column in all_cols:
-                target_col_num = all_cols.index(target_column)
-                for row in rows[1:]:
-                    cols = row.find_all("td")
-                    if cols:
-                        name, link = self.get_name_link(cols[target_col_num])
-                        if name and link:
-                            pages[name] = link
-        return pages
+    def parse_table(self, html, target_column):
+        return extract_table(parse_html(html), target_column)
 
     def get_pages_from_category(self, index_page_name, max_pages=None):
         max_pages = max_pages or float("inf")
@@ -93,172 +112,180 @@ class WikiParser:
         pages = get_categorymembers(category_page.categorymembers)
         return pages
 
-    def validate_section_title(self, section_title):
-        if section_title.get("class") in ["mw-toc-heading", "vector-menu-heading"]:
-            return False
-        if section_title.get("id") in [
-            "mw-toc-heading",
-            "Ссылки",
-            "Литература",
-            "Примечания",
-            "См. также",
-            "Навигация",
-            "Прочее",
-        ]:
-            return False
-        if re.match(r"p(-.*)*", section_title.get("id")):
-            return False
-        return True
-
-    def validate_content(self, content):
-        if content.name not in ["p", "ul", "ol", "section", "div"]:
-            return False
-        if content.name == "div" and ("vcard" not in content.get("class")):
-            return False
-        if content.get("class") in ["reference"]:
-            return False
-        return True
-
-    def parse_page_wikipedia(self, name):
-        """Parse Wikipedia page for a specific city"""
+    def load_page_wikipedia(self, name):
         page = self.wiki_html.page(name)
-        page_info = {}
-        for section in page.sections:
-            title = section.title
-            page_info.update({title: []})
-            soup = BeautifulSoup(section.text, "html.parser")
-            for current in soup.find_all(["p", "ol", "ul"]):
-                page_info[title].append(current.text)
+        # sections are fetched lazily on first access
+        page.sections
+        return page
+
+    def get_revisions(self, names):
+        """:return: {page name: id of the last revision of the page}"""
+        api_url = f"{self.base_url}/w/api.php"
+        revisions = {}
+        for start in range(0, len(names), REVISIONS_BATCH_SIZE):
+            batch = names[start : start + REVISIONS_BATCH_SIZE]
+            params = {
+                "action": "query",
+                "prop": "info",
+                "titles": "|".join(batch),
+                "redirects": 1,
+                "format": "json",
+                "formatversion": 2,
+            }
+            query = self.fetcher.get(api_url, params=params).json().get("query", {})
+            # the API answers with normalized titles and redirect targets
+            requested = {name: name for name in batch}
+            for item in query.get("normalized", []) + query.get("redirects", []):
+                requested[item["to"]] = requested.get(item["from"], item["from"])
+            for page in query.get("pages", []):
+                if "lastrevid" in page and page["title"] in requested:
+                    revisions[requested[page["title"]]] = page["lastrevid"]
+        return revisions
 
+    def parse_page_wikipedia(self, name):
+        """Parse Wikipedia page for a specific city, unless its revision is cached"""
+        if self.cache is None:
+            return self.load_and_parse_wikipedia(name)
+        if name not in self.revisions:
+            self.revisions.update(self.get_revisions([name]))
+        revision = self.revisions.get(name)
+        key = self.get_page_url(name)
+        entry = self.cache.get(key)
+        if entry is not None and revision is not None and entry["revision"] == revision:
+            self.cache.record(hit=True)
+            return entry["parsed"]
+        page_info = self.load_and_parse_wikipedia(name)
+        self.cache.record(hit=False)
+        if revision is not None:
+            self.cache.put(key, page_info, revision=revision)
+        return page_info
+
+    def load_and_parse_wikipedia(self, name):
+        page = self.fetcher.call(
+            urlparse(self.base_url).netloc, lambda: self.load_page_wikipedia(name)
+        )
+        return self.parse_sections_wikipedia(page.sections)
+
+    def parse_sections_wikipedia(self, sections):
+        """Sections and subsections of a page with HTML extracts, parsed together"""
+        titles, fragments = [], []
+        for section in sections:
+            titles.append(section.title)
+            fragments.append(section.text)
             for subsection in section.sections:
-                subtitle = f"{title}: {subsection.title}"
-                page_info.update({subtitle: []})
-                soup = BeautifulSoup(subsection.text, "html.parser")
-                for current in soup.find_all(["p", "ol", "ul"]):
-                    page_info[subtitle].append(current.text)
+                titles.append(f"{section.title}: {subsection.title}")
+                fragments.append(subsection.text)
+        page_info = dict(zip(titles, extract_fragments(fragments)))
         return {k: " ".join(v) for k, v in page_info.items() if v}
 
     def parse_page_wikivoyage(self, name):
         """Parse Wikivoyage page for a specific city"""
         # Encode city name for URL
         url = self.get_page_url(name)
+        # network errors are raised, so that the page is retried on the next run
+        return self.fetcher.get_parsed(
+            url,
+            lambda response: self.parse_html_wikivoyage(response.text, name),
+            self.cache,
+        )
 
+    def parse_html_wikivoyage(self, html, name):
         try:
-            response = requests.get(url, timeout=20)
-            soup = BeautifulSoup(response.text, "html.parser")
-            # Initialize city data dictionary
-            page_info = {}
-            section_divs = soup.find_all("div", class_="mw-heading mw-heading2")
-            if not section_divs:
-                snak = soup.find(class_="wikidata-main-snak")
-                snak_name = snak.find("a").get_text().strip()
-                snak_link = snak.find("a").get("href")
-                if snak_name and snak_link:
-                    return self.parse_page_wikivoyage(snak_name, snak_link)
-                else:
-                    return {}
-
-            for section_div in section_divs:
-                section = section_div.find("h2")
-                title = section.get("id")
-                if self.validate_section_title(section) and title:
-                    section_content = {title: []}
-                    current = section_div.find_next_sibling()
-                    while (
-                        current
-                        and current.name not in ["h2"]
-                        and set(current.get("class", [])) & {"mw-heading2"} == set()
-                    ):
-                        if self.validate_content(current):
-                            if current.name in ["p", "ul", "ol"]:
-                                section_content[title].append(
-                                    current.get_text().strip()
-                                )
-                            if current.name == "div":
-                                section_content[title].append(
-                                    current.get_text().strip()
-                                )
-                            if current.name == "section":
-                                current_div = current.find("div")
-                                if "mw-heading3" in current_div.get("class", []):
-                                    subtitle = current_div.find("h3").get("id")
-                                    if (
-                                        self.validate_section_title(current_div)
-                                        and subtitle
-                                    ):
-                                        section_content[f"{title}: {subtitle}"] = []
-                                        current_div = current_div.find_next_sibling()
-                                        while (
-                                            current_div
-                                            and current_div.name not in ["h2", "h3"]
-                                            and set(current_div.get("class", []))
-                                            & {"mw-heading2", "mw-heading3"}
-                                            == set()
-                                        ):
-                                            if current_div.name in ["p", "ul", "ol"]:
-                                                section_content[
-                                                    f"{title}: {subtitle}"
-                                                ].append(current_div.get_text().strip())
-                                            else:
-                                                current_div_div = current_div.find_all(
-                                                    "div"
-                                                )
-                                                for d in current_div_div:
-                                                    section_content[
-                                                        f"{title}: {subtitle}"
-                                                    ].append(d.get_text().strip())
-                                            if current_div.find_next_sibling():
-                                                current_div = (
-                                                    current_div.find_next_sibling()
-                                                )
-                                            else:
-                                                current_div = current_div.parent
-                                                if current_div:
-                                                    current_div = (
-                                                        current_div.parent.parent
-                                                    )
-                                                break
-
-                        current = current.find_next_sibling()
-                    # Combine content if there's any
-                    section_content = {
-                        k: " ".join(v) for k, v in section_content.items()
-                    }
-                    page_info.update(section_content)
-
-            return page_info
-
+            # pages without sections are wikidata stubs
+            return extract_wikivoyage(parse_html(html)) or {}
         except Exception as e:
             print(f"Error parsing {name}: {e}")
             return {}
 
-    def scrape_pages(self, pages, limit=None):
-        if limit is not None:
-            pages = dict(list(pages.items())[:limit])
-        data = {}
-        pbar = tqdm(list(pages.items()))
-        for name, link in pbar:
-            pbar.set_description(name)
-            if self.base_url in ["https://ru.wikivoyage.org"]:
-                page_data = self.parse_page_wikivoyage(name)
-            else:
-                page_data = self.parse_page_wikipedia(name)
-            if page_data:
-                data[name] = page_data
-
-        return data
-
+    def parse_page(self, name):
+        if self.source == "wikivoyage":
+            return self.parse_page_wikivoyage(name)
+        return self.parse_page_wikipedia(name)
 
-def save_to_json(data, filename):
-    """Save collected data to JSON"""
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    print(f"Data saved to {filename}")
+    def scrape_pages(self, pages, limit=None, checkpoint_path=None):
+        """
+        Fetch and parse pages in `fetcher.max_workers` threads
 
-
-def get_whole_data(big_city_limit=None, russian_city_limit=None, tourism_limit=None):
-    wikipedia_parser = WikiParser()
-    wikivoyage_parser = WikiParser(base_url="https://ru.wikivoyage.org")
+        :param checkpoint_path: JSONL file where every parsed page is saved at once.
+            If the run is interrupted, the next run with the same file skips the
+            pages done before. Pages that failed are retried
+        """
+        if limit is not None:
+            pages = dict(list(pages.items())[:limit])
+        checkpoint = Checkpoint(checkpoint_path) if checkpoint_path else None
+        results = checkpoint.load() if checkpoint else {}
+        for name, data in self.iter_scraped(pages, done=results):
+            results[name] = data
+            if checkpoint:
+                checkpoint.add(name, data)
+        return {name: results[name] for name in pages if results.get(name)}
+
+    def scrape_to_jsonl(self, pages, path, limit=None):
+        """
+        Scrape pages into a JSONL file with a {"name", "data"} record per page,
+        written as soon as the page is done, so that the pages are never in memory
+        together. Records are in the order of `pages`, except that on resuming
+        the pages of the interrupted run come first. Records go to `{path}.part`,
+        which is renamed to `path` at the end, and an interrupted run is resumed
+        from it
+        """
+        if limit is not None:
+            pages = dict(list(pages.items())[:limit])
+        part = Checkpoint(f"{path}.part")
+        # an empty file if no page is done, e.g. of an empty category
+        open(part.path, "a").close()
+        for name, data in self.iter_scraped(pages, done=part.names()):
+            part.add(name, data)
+        os.replace(part.path, path)
+        print(f"Data saved to {path}")
+
+    def iter_scraped(self, pages, done=()):
+        """
+        Fetch and parse pages in `fetcher.max_workers` threads, yielding
+        (name, page data) in the order of `pages`, so that the output of a run is
+        the same every time. Pages that failed are skipped
+
+        :param done: Names of the pages done before, which are not fetched again
+        """
+        todo = [name for name in pages if name not in done]
+        if len(todo) < len(pages):
+            print(f"Resuming: {len(pages) - len(todo)} pages are already done")
+        if self.cache is not None and self.source == "wikipedia":
+            # one API request per batch of pages instead of one per page
+            self.revisions = self.get_revisions(todo)
+
+        names = iter(todo)
+        with ThreadPoolExecutor(self.fetcher.max_workers) as pool:
+            # a bounded window of pages in flight: pages done out of order wait
+            # for the earlier ones in memory, at most the window of them
+            pending = deque(
+                (name, pool.submit(self.parse_page, name))
+                for name in itertools.islice(names, 2 * self.fetcher.max_workers)
+            )
+            for _ in tqdm(range(len(todo))):
+                name, future = pending.popleft()
+                for next_name in itertools.islice(names, 1):
+                    pending.append((next_name, pool.submit(self.parse_page, next_name)))
+                try:
+                    data = future.result()
+                except Exception as e:
+                    print(f"Error fetching {name}: {e}")
+                    continue
+                yield name, data
+        if self.cache is not None:
+            print(self.cache.summary())
+
+
+def get_whole_data(
+    big_city_limit=None,
+    russian_city_limit=None,
+    tourism_limit=None,
+    cache_dir="scrape_cache",
+):
+    """:param cache_dir: Directory of `HttpCache`, pages unchanged since the last run are taken from it"""
+    cache = HttpCache(cache_dir, version=PARSER_VERSION)
+    wikipedia_parser = WikiParser(cache=cache)
+    wikivoyage_parser = WikiParser(base_url="https://ru.wikivoyage.org", cache=cache)
 
     russian_cities_pages = wikipedia_parser.get_pages_from_table(
         "Список городов России", "Город"
@@ -270,30 +297,30 @@ def get_whole_data(big_city_limit=None, russian_city_limit=None, tourism_limit=N
         "Категория:Туризм по странам", max_pages=tourism_limit
     )
 
-    russian_cities_data = wikipedia_parser.scrape_pages(
-        russian_cities_pages, russian_city_limit
+    wikipedia_parser.scrape_to_jsonl(
+        russian_cities_pages, "russian_cities_data.jsonl", russian_city_limit
+    )
+    wikipedia_parser.scrape_to_jsonl(
+        big_cities_pages, "big_cities_data.jsonl", big_city_limit
     )
-    save_to_json(russian_cities_data, "russian_cities_data.json")
-    big_cities_data = wikipedia_parser.scrape_pages(big_cities_pages, big_city_limit)
-    save_to_json(big_cities_data, "big_cities_data.json")
 
-    tourism_data = wikipedia_parser.scrape_pages(tourism_pages, tourism_limit)
-    save_to_json(tourism_data, "tourism_data.json")
+    wikipedia_parser.scrape_to_jsonl(tourism_pages, "tourism_data.jsonl", tourism_limit)
 
-    wikivoyage_russian_cities_data = wikivoyage_parser.scrape_pages(
-        russian_cities_pages, russian_city_limit
+    wikivoyage_parser.scrape_to_jsonl(
+        russian_cities_pages, "wikivoyage_russian_cities_data.jsonl", russian_city_limit
     )
-    save_to_json(wikivoyage_russian_cities_data, "wikivoyage_russian_cities_data.json")
 
-    wikivoyage_big_cities_data = wikivoyage_parser.scrape_pages(
-        big_cities_pages, big_city_limit
+    wikivoyage_parser.scrape_to_jsonl(
+        big_cities_pages, "wikivoyage_big_cities_data.jsonl", big_city_limit
     )
-    save_to_json(wikivoyage_big_cities_data, "wikivoyage_big_cities_data.json")
 
 
-def get_wikivoyage_data(big_city_limit=None, russian_city_limit=None):
-    wikipedia_parser = WikiParser()
-    wikivoyage_parser = WikiParser(base_url="https://ru.wikivoyage.org")
+def get_wikivoyage_data(
+    big_city_limit=None, russian_city_limit=None, cache_dir="scrape_cache"
+):
+    cache = HttpCache(cache_dir, version=PARSER_VERSION)
+    wikipedia_parser = WikiParser(cache=cache)
+    wikivoyage_parser = WikiParser(base_url="https://ru.wikivoyage.org", cache=cache)
 
     russian_cities_pages = wikipedia_parser.get_pages_from_table(
         "Список городов России", "Город"
@@ -302,14 +329,12 @@ def get_wikivoyage_data(big_city_limit=None, russian_city_limit=None):
         "Список городов с населением более миллиона человек", "Город"
     )
 
-    wikivoyage_russian_cities_data = wikivoyage_parser.scrape_pages(
-        russian_cities_pages, russian_city_limit
+    wikivoyage_parser.scrape_to_jsonl(
+        russian_cities_pages, "wikivoyage_russian_cities_data.jsonl", russian_city_limit
     )
-    save_to_json(wikivoyage_russian_cities_data, "wikivoyage_russian_cities_data.json")
-    wikivoyage_big_cities_data = wikivoyage_parser.scrape_pages(
-        big_cities_pages, big_city_limit
+    wikivoyage_parser.scrape_to_jsonl(
+        big_cities_pages, "wikivoyage_big_cities_data.jsonl", big_city_limit
     )
-    save_to_json(wikivoyage_big_cities_data, "wikivoyage_big_cities_data.json")
 
 
 if __name__ == "__main__":
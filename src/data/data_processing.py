@@ -1,9 +1,19 @@
+import hashlib
+import logging
+import multiprocessing
 import os
 import re
 import json
+from collections import deque
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from src.data.dedup import NearDuplicateFilter
+
+logger = logging.getLogger(__name__)
+# text splitter of a chunking worker process
+_worker_splitter = None
+
 
 def isvalid_text(text):
     return text and not re.match(r"^\s*$", text)
@@ -30,27 +40,85 @@ def get_section_name(page_name, section_name):
 
 
 def flatten_data(data):
+    """
+    :return: {section title: unique texts in the order they first appear},
+        `data` is not changed
+    """
     flat_data = {}
     if isinstance(data, dict):
         data = [data]
     for d in data:
         for page_name, page_data in d.items():
-            d[page_name] = remove_metadata(page_data)
+            page_data = remove_metadata(dict(page_data))
             for section_name, section_data in page_data.items():
                 if section_data:
                     section_name = get_section_name(page_name, section_name)
-                    if section_name not in flat_data:
-                        flat_data[section_name] = {section_data}
-                    else:
-                        flat_data[section_name].add(section_data)
-    return flat_data
+                    # a dict keeps unique texts in order, unlike a set
+                    flat_data.setdefault(section_name, {})[section_data] = None
+    return {title: list(texts) for title, texts in flat_data.items()}
+
+
+class FastTextSplitter(RecursiveCharacterTextSplitter):
+    """
+    Same chunks as `RecursiveCharacterTextSplitter`, but `_merge_splits` drops pieces
+    from the start of the current chunk by moving an index instead of copying the
+    list of pieces every time, and measures every piece once. Texts that fit into
+    one chunk are not split at all
+    """
+
+    def split_text(self, text):
+        if (
+            self._length_function is len
+            and self._keep_separator
+            and self._strip_whitespace
+            and len(text) <= self._chunk_size
+        ):
+            # pieces with the separators kept join back into the whole text
+            text = text.strip()
+            return [text] if text else []
+        return super().split_text(text)
+
+    def _merge_splits(self, splits, separator):
+        separator_len = self._length_function(separator)
+        splits = list(splits)
+        lengths = [self._length_function(split) for split in splits]
+        docs = []
+        # the current chunk is splits[start:end]
+        start = 0
+        total = 0
+        for end, length in enumerate(lengths):
+            if (
+                total + length + (separator_len if end > start else 0)
+                > self._chunk_size
+            ):
+                if total > self._chunk_size:
+                    logger.warning(
+                        f"Created a chunk of size {total}, "
+                        f"which is longer than the specified {self._chunk_size}"
+                    )
+                if end > start:
+                    doc = self._join_docs(splits[start:end], separator)
+                    if doc is not None:
+                        docs.append(doc)
+                    while total > self._chunk_overlap or (
+                        total + length + (separator_len if end > start else 0)
+                        > self._chunk_size
+                        and total > 0
+                    ):
+                        total -= lengths[start] + (
+                            separator_len if end - start > 1 else 0
+                        )
+                        start += 1
+            total += length + (separator_len if end > start else 0)
+        doc = self._join_docs(splits[start:], separator)
+        if doc is not None:
+            docs.append(doc)
+        return docs
 
 
 def make_chunks(data, chunk_size=1000, chunk_overlap=200):
     chunked_data = {}
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size, chunk_overlap=chunk_overlap
-    )
+    text_splitter = FastTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     for title, texts in data.items():
         if isinstance(texts, str):
             texts = [texts]
@@ -62,19 +130,206 @@ def make_chunks(data, chunk_size=1000, chunk_overlap=200):
             chunked_data[title] = chunks
     return chunked_data
 
-def load_and_preprocess_data(datadir=None, paths=[]):
+
+def list_data_files(datadir):
+    return [
+        os.path.join(datadir, fname)
+        for fname in sorted(os.listdir(datadir))
+        if fname.endswith((".json", ".jsonl"))
+    ]
+
+
+def iter_records(path):
+    """
+    Yields (page name, page data) of a data file: JSONL with a {"name", "data"}
+    record per page, read line by line, or legacy JSON {page name: page data},
+    which is loaded whole. A cut last line, of a scrape that was killed, is
+    skipped, other broken lines raise
+    """
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    if line.endswith("\n"):
+                        raise ValueError(f"Corrupt record at {path}:{number}")
+                    print(f"Skipping the cut last record of {path}")
+                    continue
+                yield record["name"], record["data"]
+        else:
+            data = json.load(f)
+            for d in [data] if isinstance(data, dict) else data:
+                yield from d.items()
+
+
+def iter_sections(records):
+    """
+    Yields (section title, text) of pages without metadata sections, same as
+    `flatten_data`. Repeated sections, e.g. of a page in several files, are
+    yielded once, only their hashes are kept
+    """
+    seen = set()
+    for page_name, page_data in records:
+        for section_name, section_data in remove_metadata(dict(page_data)).items():
+            if not section_data:
+                continue
+            section_name = get_section_name(page_name, section_name)
+            key = hashlib.sha1(
+                f"{section_name}\x1f{section_data}".encode("utf-8")
+            ).digest()
+            if key not in seen:
+                seen.add(key)
+                yield section_name, section_data
+
+
+def _init_splitter(chunk_size, chunk_overlap):
+    global _worker_splitter
+    _worker_splitter = FastTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+
+
+def _split_texts(texts):
+    return [_worker_splitter.split_text(text) for text in texts]
+
+
+def _batches(sections, batch_size):
+    titles, texts = [], []
+    for title, text in sections:
+        titles.append(title)
+        texts.append(text)
+        if len(texts) == batch_size:
+            yield titles, texts
+            titles, texts = [], []
+    if texts:
+        yield titles, texts
+
+
+def iter_chunks(
+    sections, chunk_size=1000, chunk_overlap=200, num_workers=1, batch_size=256
+):
+    """
+    Yields (title, chunks) of every section text, same as `make_chunks`
+
+    :param num_workers: Number of processes splitting batches of `batch_size`
+        sections. The output is the same and in the same order as with one process,
+        and at most two batches per process are in flight
+    """
+    if num_workers == 1:
+        text_splitter = FastTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+        for title, text in sections:
+            chunks = text_splitter.split_text(text)
+            if chunks:
+                yield title, chunks
+        return
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        num_workers, initializer=_init_splitter, initargs=(chunk_size, chunk_overlap)
+    ) as pool:
+        pending = deque()
+        for titles, texts in _batches(sections, batch_size):
+            pending.append((titles, pool.apply_async(_split_texts, (texts,))))
+            if len(pending) < 2 * num_workers:
+                continue
+            titles, result = pending.popleft()
+            for title, chunks in zip(titles, result.get()):
+                if chunks:
+                    yield title, chunks
+        for titles, result in pending:
+            for title, chunks in zip(titles, result.get()):
+                if chunks:
+                    yield title, chunks
+
+
+def stream_chunks(
+    datadir=None,
+    paths=[],
+    chunk_size=1000,
+    chunk_overlap=200,
+    num_workers=1,
+    dedup_threshold=None,
+):
+    """
+    Parse -> flatten -> chunk -> deduplicate pipeline over data files, one page at
+    a time. A title is yielded again if its sections come from several pages
+
+    :param num_workers: Number of chunking processes, see `iter_chunks`
+    :param dedup_threshold: Similarity of near-duplicate chunks, of which only the
+        first is kept, see `NearDuplicateFilter`. No deduplication by default
+    """
     assert datadir or paths, "Please provide `datadir` or List[str] of paths"
-    data = []
     if len(paths) == 0:
-        paths = [os.path.join(datadir, fname) for fname in os.listdir(datadir) if fname.endswith(".json")]
-    for path in paths:
-        with open(path) as f:
-            data.append(json.load(f))
+        paths = list_data_files(datadir)
+    records = (record for path in paths for record in iter_records(path))
+    chunks = iter_chunks(
+        iter_sections(records), chunk_size, chunk_overlap, num_workers=num_workers
+    )
+    if dedup_threshold is not None:
+        chunks = NearDuplicateFilter(threshold=dedup_threshold).filter(chunks)
+    return chunks
 
-    flat_data = flatten_data(data)
-    chunked_data = make_chunks(flat_data)
+
+def load_and_preprocess_data(
+    datadir=None, paths=[], num_workers=1, dedup_threshold=None
+):
+    """
+    :param num_workers: Number of chunking processes, the result does not depend on it
+    :param dedup_threshold: Similarity of near-duplicate chunks to remove
+    :return: {title: chunks} of all data files, streamed through `stream_chunks`
+    """
+    chunked_data = {}
+    for title, chunks in stream_chunks(
+        datadir=datadir,
+        paths=paths,
+        num_workers=num_workers,
+        dedup_threshold=dedup_threshold,
+    ):
+        chunked_data.setdefault(title, []).extend(chunks)
     return chunked_data
 
+
+class LazyChunkedData:
+    """Reads and chunks the corpus only when it is needed, e.g. for indexing"""
+
+    def __init__(self, datadir=None, paths=[], num_workers=1, dedup_threshold=None):
+        """
+        :param num_workers: Number of chunking processes
+        :param dedup_threshold: Similarity of near-duplicate chunks to remove
+        """
+        assert datadir or paths, "Please provide `datadir` or List[str] of paths"
+        self.datadir = datadir
+        self.paths = paths
+        self.num_workers = num_workers
+        self.dedup_threshold = dedup_threshold
+
+    def get_paths(self):
+        return self.paths or list_data_files(self.datadir)
+
+    def settings(self):
+        """Preprocessing settings that change the chunks, besides the data files"""
+        if self.dedup_threshold is None:
+            return {}
+        return {"dedup_threshold": self.dedup_threshold}
+
+    def load(self):
+        """
+        :return: {title: chunks}, read again on every call and not kept, so that
+            the corpus is freed once the stores are built
+        """
+        return load_and_preprocess_data(
+            datadir=self.datadir,
+            paths=self.paths,
+            num_workers=self.num_workers,
+            dedup_threshold=self.dedup_threshold,
+        )
+
+
 if __name__ == "__main__":
     paths = ["./data/big_cities_data.json"]
     chunked_data = load_and_preprocess_data(paths=paths)
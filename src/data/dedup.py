@@ -0,0 +1,120 @@
+"""
+Near-duplicate chunk removal with MinHash and LSH, between chunking and embedding.
+
+Chunks are sets of word shingles. Two chunks are near duplicates if the Jaccard
+similarity of their shingles, estimated by the share of equal MinHash values, is
+at least `threshold`. Candidates are only compared if some band of their
+signatures is the same, so every chunk is compared with a few others instead of
+all the chunks kept before.
+
+Memory grows with the number of kept chunks, not with their text: the MinHash
+signature of every kept chunk, `num_perm` 32-bit values in one array, and the
+hashes of its bands, under 2 KB per chunk with the defaults. A chunk is compared
+only with the first kept chunk of each of its bands.
+"""
+import re
+import zlib
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# largest prime below 2 ** 32, hash values and permutation parameters are below it
+PRIME = np.uint64(4294967291)
+# combines the hashes of the words of a shingle
+MULTIPLIER = np.uint64(1000003)
+
+
+class NearDuplicateFilter:
+    """Keeps the first of near-duplicate chunks, in the order they are seen"""
+
+    def __init__(self, threshold=0.8, num_perm=128, bands=16, shingle_size=3, seed=0):
+        """
+        :param threshold: Estimated Jaccard similarity of the shingles of duplicates
+        :param num_perm: Number of MinHash values of a chunk
+        :param bands: Number of LSH bands, `num_perm` must be divisible by it. More
+            bands find duplicates below the threshold more often, at the cost of
+            more candidates to compare
+        :param shingle_size: Number of words in a shingle
+        """
+        assert num_perm % bands == 0, "`num_perm` must be divisible by `bands`"
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # a < 2 ** 31, so that a * h + b of 32-bit hashes fits into uint64
+        self.a = rng.integers(1, 2**31, num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)[:, None]
+        # signatures of the kept chunks, rows after `kept` are free
+        self.signatures = np.empty((1024, num_perm), dtype=np.uint32)
+        self.kept = 0
+        # {hash of the band: first kept chunk with it} of every band
+        self.buckets = [{} for _ in range(bands)]
+        self.seen = 0
+        self.removed = 0
+
+    def shingles(self, text):
+        """32-bit hashes of the word n-grams of the text"""
+        tokens = TOKEN_PATTERN.findall(text.lower().replace("ё", "е"))
+        hashes = np.array(
+            [zlib.crc32(token.encode("utf-8")) for token in tokens], dtype=np.uint64
+        )
+        # a text shorter than a shingle is one shingle of all its words
+        n = max(len(hashes) - self.shingle_size + 1, min(len(hashes), 1))
+        shingles = np.zeros(n, dtype=np.uint64)
+        for i in range(min(self.shingle_size, len(hashes))):
+            shingles = (shingles * MULTIPLIER + hashes[i : i + n]) % PRIME
+        return shingles
+
+    def signature(self, text):
+        shingles = np.unique(self.shingles(text))
+        if not len(shingles):
+            return None
+        hashes = (self.a * shingles + self.b) % PRIME
+        return hashes.min(axis=1).astype(np.uint32)
+
+    def add(self, text):
+        """:return: False if the text is a near duplicate of a kept one, else keep it"""
+        self.seen += 1
+        signature = self.signature(text)
+        if signature is None:
+            return True
+        # a collision of band hashes only adds a candidate, compared by signature
+        keys = [hash(band.tobytes()) for band in signature.reshape(self.bands, -1)]
+        candidates = {
+            bucket[key] for bucket, key in zip(self.buckets, keys) if key in bucket
+        }
+        for candidate in candidates:
+            if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                self.removed += 1
+                return False
+        if self.kept == len(self.signatures):
+            self.signatures = np.concatenate(
+                [self.signatures, np.empty_like(self.signatures)]
+            )
+        self.signatures[self.kept] = signature
+        for bucket, key in zip(self.buckets, keys):
+            bucket.setdefault(key, self.kept)
+        self.kept += 1
+        return True
+
+    def filter(self, chunks):
+        """
+        Yields (title, chunks) pairs without near-duplicate chunks, titles left
+        without chunks are dropped
+
+        :param chunks: (title, chunks) pairs, e.g. from `stream_chunks`
+        """
+        for title, title_chunks in chunks:
+            kept = [chunk for chunk in title_chunks if self.add(chunk)]
+            if kept:
+                yield title, kept
+        print(self.summary())
+
+    def summary(self):
+        share = self.removed / self.seen if self.seen else 0.0
+        return (
+            f"Near duplicates: removed {self.removed} of {self.seen} chunks "
+            f"({share:.1%}, threshold {self.threshold})"
+        )
@@ -0,0 +1,288 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """Spaces out requests to the same host by at least 1 / `requests_per_second`"""
+
+    def __init__(self, requests_per_second=10.0):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self._next_time = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time.get(host, now))
+            self._next_time[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Fetcher:
+    """
+    HTTP client for scraping from several threads: a keep-alive session per thread,
+    a per-host rate limit and retries with exponential backoff
+    """
+
+    def __init__(
+        self,
+        max_workers=8,
+        requests_per_second=10.0,
+        retries=3,
+        backoff=1.0,
+        timeout=20,
+        user_agent="MyProjectName (merlin@example.com)",
+    ):
+        """
+        :param max_workers: Number of pages fetched at the same time
+        :param requests_per_second: Limit for every host
+        :param retries: Number of retries of failed requests, the n-th waits
+            `backoff * 2 ** n` seconds or as long as the server asks in Retry-After
+        """
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, "session"):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=self.max_workers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = self.user_agent
+            self._local.session = session
+        return self._local.session
+
+    def call(self, host, request):
+        """Run `request()` under the rate limit of `host`, retrying network errors"""
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait(host)
+            try:
+                response = request()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2**attempt
+            else:
+                status = getattr(response, "status_code", None)
+                if status not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
+                delay = (
+                    float(retry_after)
+                    if retry_after.isdigit()
+                    else self.backoff * 2**attempt
+                )
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        response = self.call(
+            urlparse(url).netloc,
+            lambda: self.session.get(url, timeout=self.timeout, **kwargs),
+        )
+        response.raise_for_status()
+        return response
+
+    def get_parsed(self, url, parse, cache=None):
+        """
+        `parse(response)` of the page at `url`. With an `HttpCache`, the page is
+        requested with the validators of the cached entry and neither downloaded nor
+        parsed again when the server answers 304 Not Modified
+        """
+        if cache is None:
+            return parse(self.get(url))
+        entry = cache.get(url)
+        headers = {}
+        if entry is not None and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        response = self.get(url, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            cache.record(hit=True)
+            return entry["parsed"]
+        parsed = parse(response)
+        cache.record(hit=False, downloaded_bytes=len(response.content))
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            cache.put(url, parsed, etag=etag, last_modified=last_modified)
+        return parsed
+
+
+class Checkpoint:
+    """
+    Scraped pages appended to a JSONL file as they are done, a {"name", "data"}
+    record per line, to resume interrupted runs
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def records(self):
+        """
+        Yields (page name, page data) of the pages done so far, reading line by line.
+        The last line is cut if the run was killed while writing it, it is removed
+        from the file, so that the page is scraped again. Other broken lines raise
+        """
+        if not os.path.exists(self.path):
+            return
+        line, cut = "", False
+        with open(self.path, encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    if line.endswith("\n"):
+                        raise ValueError(f"Corrupt record at {self.path}:{number}")
+                    cut = True
+                    break
+                yield record["name"], record["data"]
+        if cut:
+            print(f"Removing the cut last record of {self.path}")
+            size = os.path.getsize(self.path) - len(line.encode("utf-8"))
+            os.truncate(self.path, size)
+        elif line and not line.endswith("\n"):
+            # start the next record on a new line
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n")
+
+    def load(self):
+        """:return: {page name: page data} of the pages done so far"""
+        return dict(self.records())
+
+    def names(self):
+        """:return: names of the pages done so far, without keeping their data"""
+        return {name for name, _ in self.records()}
+
+    def add(self, name, data):
+        line = json.dumps({"name": name, "data": data}, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class HttpCache:
+    """
+    On-disk cache of parsed pages with the validators to check that a page did not
+    change: ETag / Last-Modified for HTTP pages, revision ids for wiki API pages.
+
+    Every entry is a json file named by the hash of its key. The least recently
+    used entries are evicted when the files take more than `max_size` bytes.
+    """
+
+    def __init__(self, path, max_size=2**30, version=1):
+        """
+        :param version: Version of the parsers, entries of other versions are ignored
+        """
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.downloaded_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._entries = {}  # file name -> (last access time, size)
+        for file_name in os.listdir(path):
+            if file_name.endswith(".json"):
+                stat = os.stat(os.path.join(path, file_name))
+                self._entries[file_name] = (stat.st_mtime, stat.st_size)
+
+    def _file_name(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json"
+
+    def get(self, key):
+        """:return: the entry saved by `put` or None"""
+        file_name = self._file_name(key)
+        file_path = os.path.join(self.path, file_name)
+        with self._lock:
+            if file_name not in self._entries:
+                return None
+            try:
+                with open(file_path, encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                return None
+            if entry.get("key") != key or entry.get("version") != self.version:
+                return None
+            now = time.time()
+            self._entries[file_name] = (now, self._entries[file_name][1])
+            os.utime(file_path, (now, now))
+        return entry
+
+    def put(self, key, parsed, etag=None, last_modified=None, revision=None):
+        file_name = self._file_name(key)
+        entry = {
+            "key": key,
+            "version": self.version,
+            "etag": etag,
+            "last_modified": last_modified,
+            "revision": revision,
+            "parsed": parsed,
+        }
+        content = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            tmp_path = os.path.join(self.path, file_name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, os.path.join(self.path, file_name))
+            self._entries[file_name] = (time.time(), len(content))
+            self._evict()
+
+    def _evict(self):
+        total = sum(size for _, size in self._entries.values())
+        if total <= self.max_size:
+            return
+        for file_name, (_, size) in sorted(
+            self._entries.items(), key=lambda item: item[1][0]
+        ):
+            os.remove(os.path.join(self.path, file_name))
+            del self._entries[file_name]
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def record(self, hit, downloaded_bytes=0):
+        with self._lock:
+            self.hits += int(hit)
+            self.misses += int(not hit)
+            self.downloaded_bytes += downloaded_bytes
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "downloaded_mb": self.downloaded_bytes / 2**20,
+            "entries": len(self._entries),
+            "size_mb": sum(size for _, size in self._entries.values()) / 2**20,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (
+            f"HTTP cache: {stats['hits']} unchanged, {stats['misses']} fetched "
+            f"(hit rate {stats['hit_rate']:.1%}), {stats['downloaded_mb']:.2f} MB "
+            f"of HTML downloaded, {stats['entries']} entries "
+            f"({stats['size_mb']:.1f} MB) in {self.path}"
+        )
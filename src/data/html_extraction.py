@@ -0,0 +1,213 @@
+"""
+Single-pass extraction of wiki pages with lxml.
+
+Every page is parsed once and walked element by element, instead of building a
+BeautifulSoup tree per section and searching it again for every heading. For the
+well-formed HTML that MediaWiki renders the output is the same as of the
+BeautifulSoup parsers these functions replaced, including the text of elements:
+text in script, style, template, rt and rp is skipped, and whitespace-only text
+outside pre and textarea becomes a single newline or space. Layouts the old
+parsers failed on raise here too, `WikiParser` turns them into empty pages.
+"""
+import re
+
+import lxml.html
+from lxml import etree
+
+NON_TEXT_TAGS = {"script", "style", "template", "rt", "rp"}
+PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+SKIPPED_SECTION_IDS = [
+    "mw-toc-heading",
+    "Ссылки",
+    "Литература",
+    "Примечания",
+    "См. также",
+    "Навигация",
+    "Прочее",
+]
+# ids of the navigation headings of the page, e.g. "p-lang"
+NAVIGATION_ID_PATTERN = re.compile(r"p(-.*)*")
+
+
+def parse_html(html):
+    return lxml.html.document_fromstring(html)
+
+
+def _normalize(text, preserve):
+    if preserve or text.strip(ASCII_SPACES):
+        return text
+    return "\n" if "\n" in text else " "
+
+
+def get_text(element):
+    """Text of the element, the same as BeautifulSoup's `get_text()`"""
+    ancestors = {ancestor.tag for ancestor in element.iterancestors()}
+    skipped = len(ancestors & NON_TEXT_TAGS)
+    preserved = len(ancestors & PRESERVE_WHITESPACE_TAGS)
+    parts = []
+    events = ("start", "end", "comment", "pi")
+    for event, node in etree.iterwalk(element, events=events):
+        if event == "start":
+            skipped += node.tag in NON_TEXT_TAGS
+            preserved += node.tag in PRESERVE_WHITESPACE_TAGS
+            if node.text and not skipped:
+                parts.append(_normalize(node.text, preserved))
+            continue
+        if event == "end":
+            skipped -= node.tag in NON_TEXT_TAGS
+            preserved -= node.tag in PRESERVE_WHITESPACE_TAGS
+        # text of comments and processing instructions is not text, their tails
+        # and the tails of elements are text of the parent
+        if node is not element and node.tail and not skipped:
+            parts.append(_normalize(node.tail, preserved))
+    return "".join(parts)
+
+
+def get_classes(element):
+    return (element.get("class") or "").split()
+
+
+def next_element(element):
+    """Next sibling that is an element, like BeautifulSoup's `find_next_sibling()`"""
+    element = element.getnext()
+    while element is not None and not isinstance(element.tag, str):
+        element = element.getnext()
+    return element
+
+
+def is_valid_section_id(section_id):
+    """Section is not metadata or navigation. Raises on headings without id"""
+    if section_id in SKIPPED_SECTION_IDS:
+        return False
+    return not NAVIGATION_ID_PATTERN.match(section_id)
+
+
+def is_valid_content(element):
+    """Paragraphs, lists, sections and listings (vcard divs) of a section"""
+    if element.tag not in ["p", "ul", "ol", "section", "div"]:
+        return False
+    if element.tag == "div" and "vcard" not in element.get("class").split():
+        return False
+    return True
+
+
+def find_nested_class(root, node_tag, terminal_class):
+    """
+    Elements of class `terminal_class` inside elements of tag `node_tag`, each
+    once and in document order, in one walk of the tree
+    """
+    result = []
+    open_nodes = 0
+    for event, element in etree.iterwalk(root, events=("start", "end")):
+        if not isinstance(element.tag, str):
+            continue
+        is_node = element.tag == node_tag
+        if event == "start":
+            if open_nodes and terminal_class in get_classes(element):
+                result.append(element)
+            open_nodes += is_node
+        else:
+            open_nodes -= is_node
+    return result
+
+
+def extract_table(root, target_column):
+    """{name: link} of the first link in `target_column` of every table with it"""
+    pages = {}
+    for table in root.iter("table"):
+        rows = list(table.iter("tr"))
+        all_cols = [get_text(col).strip() for col in rows[0].iter("th")]
+        if target_column in all_cols:
+            target_col_num = all_cols.index(target_column)
+            for row in rows[1:]:
+                cols = list(row.iter("td"))
+                if cols:
+                    a = next(cols[target_col_num].iter("a"), None)
+                    if a is not None:
+                        name, link = get_text(a).strip(), a.get("href")
+                        if name and link:
+                            pages[name] = link
+    return pages
+
+
+def extract_fragments(fragments):
+    """
+    Texts of the paragraphs and lists of every HTML fragment, e.g. sections of a
+    Wikipedia extract. The fragments are parsed as one document, one by one only
+    if a fragment leaves a tag open and so swallows the fragments after it
+    """
+    wrapped = "".join(f"<div>{fragment}</div>" for fragment in fragments)
+    root = lxml.html.fragment_fromstring(wrapped, create_parent="div")
+    wrappers = list(root)
+    if len(wrappers) != len(fragments) or any(
+        wrapper.tag != "div" for wrapper in wrappers
+    ):
+        wrappers = [
+            lxml.html.fragment_fromstring(fragment, create_parent="div")
+            for fragment in fragments
+        ]
+    return [
+        [get_text(element) for element in wrapper.iter("p", "ol", "ul")]
+        for wrapper in wrappers
+    ]
+
+
+def _extract_subsection(heading_div, title, section_content):
+    if "mw-heading3" not in get_classes(heading_div):
+        return
+    subtitle = heading_div.find(".//h3").get("id")
+    # heading divs of Parsoid pages have no id, this raises like the old parsers
+    if not (is_valid_section_id(heading_div.get("id")) and subtitle):
+        return
+    texts = section_content[f"{title}: {subtitle}"] = []
+    current = next_element(heading_div)
+    while (
+        current is not None
+        and current.tag not in ["h2", "h3"]
+        and not {"mw-heading2", "mw-heading3"} & set(get_classes(current))
+    ):
+        if current.tag in ["p", "ul", "ol"]:
+            texts.append(get_text(current).strip())
+        else:
+            texts.extend(
+                get_text(div).strip() for div in current.iterdescendants("div")
+            )
+        current = next_element(current)
+
+
+def extract_wikivoyage(root):
+    """
+    {section title: text} of a Wikivoyage page, "title: subtitle" for subsections.
+    Sections follow their heading divs, until the next second-level heading
+
+    :return: None if the page has no sections
+    """
+    heading_divs = [
+        div
+        for div in root.iter("div")
+        if " ".join(get_classes(div)) == "mw-heading mw-heading2"
+    ]
+    if not heading_divs:
+        return None
+    page_info = {}
+    for heading_div in heading_divs:
+        heading = heading_div.find(".//h2")
+        title = heading.get("id")
+        if not (is_valid_section_id(title) and title):
+            continue
+        section_content = {title: []}
+        current = next_element(heading_div)
+        while (
+            current is not None
+            and current.tag != "h2"
+            and "mw-heading2" not in get_classes(current)
+        ):
+            if is_valid_content(current):
+                if current.tag == "section":
+                    _extract_subsection(current.find(".//div"), title, section_content)
+                else:
+                    section_content[title].append(get_text(current).strip())
+            current = next_element(current)
+        page_info.update({k: " ".join(v) for k, v in section_content.items()})
+    return page_info
@@ -0,0 +1,257 @@
+import inspect
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from tqdm import tqdm
+
+EMBEDDING_BACKENDS = ("torch", "onnx")
+ONNX_MODEL_FILE = "model_quantized.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+
+_worker_model = None
+
+
+def _init_worker(model_name, device, num_threads, onnx_path=None):
+    global _worker_model
+    if onnx_path:
+        _worker_model = OnnxEmbeddings(onnx_path, num_threads=num_threads)
+        return
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(num_threads)
+    _worker_model = SentenceTransformer(model_name, device=device)
+
+
+def _encode_batch(batch):
+    positions, texts = batch
+    vectors = _worker_model.encode(
+        texts,
+        batch_size=len(texts),
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+    )
+    return positions, vectors.astype(np.float32)
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence-transformers model exported to ONNX (see `export_onnx_model`) and run
+    with ONNX Runtime: mean pooling of the token embeddings, L2 normalized.
+    Needs neither torch nor sentence-transformers at inference time.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        max_length: int = 128,
+        batch_size: int = 32,
+        num_threads: int = None,
+        pad_token: str = "<pad>",
+    ):
+        """
+        :param model_path: Directory with model_quantized.onnx and tokenizer.json
+        :param max_length: Texts are truncated to this number of tokens, like
+            `max_seq_length` of the sentence-transformers model
+        :param num_threads: ONNX Runtime intra-op threads, all cores by default
+        """
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_path, ONNX_MODEL_FILE),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding(
+            pad_id=self.tokenizer.token_to_id(pad_token), pad_token=pad_token
+        )
+        self.batch_size = batch_size
+
+    def encode(self, texts, batch_size=None, **kwargs):
+        """Same output as `SentenceTransformer.encode` with normalized numpy embeddings"""
+        batch_size = batch_size or self.batch_size
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start : start + batch_size])
+            inputs = {
+                "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+                "attention_mask": np.array(
+                    [e.attention_mask for e in encodings], dtype=np.int64
+                ),
+            }
+            if "token_type_ids" in self.input_names:
+                inputs["token_type_ids"] = np.zeros_like(inputs["input_ids"])
+            token_vectors = self.session.run(None, inputs)[0]
+            mask = inputs["attention_mask"][:, :, None].astype(np.float32)
+            pooled = (token_vectors * mask).sum(axis=1) / np.maximum(
+                mask.sum(axis=1), 1e-9
+            )
+            vectors.append(
+                pooled
+                / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            )
+        if not vectors:
+            return np.empty((0, self.session.get_outputs()[0].shape[-1]), np.float32)
+        return np.concatenate(vectors).astype(np.float32)
+
+    def embed_documents(self, texts):
+        return self.encode(list(texts)).tolist()
+
+    def embed_query(self, text):
+        return self.encode([text])[0].tolist()
+
+
+def export_onnx_model(model_name: str, path: str, opset: int = 14):
+    """
+    Export a sentence-transformers model to ONNX and quantize its weights to int8.
+    Needs torch and transformers, unlike inference with `OnnxEmbeddings`
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(path, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    inputs = tokenizer(["Что посмотреть в Казани?"], return_tensors="pt")
+    fp32_path = os.path.join(path, "model.onnx")
+    dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"}}
+    dynamic_axes["attention_mask"] = dynamic_axes["input_ids"]
+    dynamic_axes["last_hidden_state"] = dynamic_axes["input_ids"]
+    # the TorchScript exporter, newer torch defaults to dynamo, which needs onnxscript
+    options = (
+        {"dynamo": False}
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters
+        else {}
+    )
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (inputs["input_ids"], inputs["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            **options,
+        )
+    quantize_dynamic(
+        fp32_path, os.path.join(path, ONNX_MODEL_FILE), weight_type=QuantType.QInt8
+    )
+    tokenizer.save_pretrained(path)
+    print(f"Quantized ONNX model saved to {path}.")
+
+
+def load_embeddings(
+    model_name: str, device: str = "cpu", backend: str = "torch", onnx_path=None
+):
+    """
+    :param backend: "torch" -- `HuggingFaceEmbeddings` with sentence-transformers,
+        "onnx" -- `OnnxEmbeddings` with the int8 model exported to `onnx_path`
+    """
+    assert backend in EMBEDDING_BACKENDS, f"Unknown embedding backend {backend}"
+    if backend == "onnx":
+        return OnnxEmbeddings(onnx_path)
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": device},
+        encode_kwargs={"normalize_embeddings": True},
+    )
+
+
+class BatchEmbedder:
+    """
+    Embeds large collections of texts for indexing.
+
+    Texts are sorted by length so that every batch pads to a similar length,
+    and batches are spread over `num_workers` processes, each with its own
+    copy of the model and an equal share of the CPU threads.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        model_name: str = None,
+        device: str = "cpu",
+        batch_size: int = 64,
+        num_workers: int = 1,
+        onnx_path: str = None,
+    ):
+        """
+        :param embeddings: LangChain embeddings, used when `num_workers` is 1
+        :param model_name: sentence-transformers model loaded by worker processes
+        :param onnx_path: Exported ONNX model that worker processes load instead
+        """
+        assert (
+            num_workers == 1 or model_name
+        ), "Please provide `model_name` to embed in several processes."
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.onnx_path = onnx_path
+
+    def make_batches(self, texts, positions):
+        positions = sorted(positions, key=lambda i: len(texts[i]))
+        for start in range(0, len(positions), self.batch_size):
+            batch_positions = np.array(positions[start : start + self.batch_size])
+            yield batch_positions, [texts[i] for i in batch_positions]
+
+    def iter_embeddings(self, texts, positions=None):
+        """
+        Yields (positions, vectors) batches in no particular order
+
+        :param positions: Positions of `texts` to embed, all by default
+        """
+        if positions is None:
+            positions = range(len(texts))
+        batches = self.make_batches(texts, positions)
+        if self.num_workers == 1:
+            for batch_positions, batch_texts in batches:
+                vectors = self.embeddings.embed_documents(batch_texts)
+                yield batch_positions, np.asarray(vectors, dtype=np.float32)
+            return
+
+        num_threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(
+            self.num_workers,
+            initializer=_init_worker,
+            initargs=(self.model_name, self.device, num_threads, self.onnx_path),
+        ) as pool:
+            yield from pool.imap_unordered(_encode_batch, batches)
+
+    def embed(self, texts, positions=None, desc="Embedding"):
+        """Same as `iter_embeddings` with a progress bar and throughput summary"""
+        total = len(texts) if positions is None else len(positions)
+        start = time.perf_counter()
+        with tqdm(total=total, desc=desc, unit="chunk") as pbar:
+            for batch_positions, vectors in self.iter_embeddings(texts, positions):
+                pbar.update(len(batch_positions))
+                yield batch_positions, vectors
+        elapsed = time.perf_counter() - start
+        if total:
+            print(
+                f"{desc}: {total} texts in {elapsed:.1f} s "
+                f"({total / elapsed:.1f} chunks/sec, {self.num_workers} workers)"
+            )
+
+
+if __name__ == "__main__":
+    export_onnx_model(
+        "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+        "models/paraphrase-multilingual-MiniLM-L12-v2-onnx",
+    )
@@ -0,0 +1,72 @@
+import threading
+from collections import Counter
+
+from src.manifest import content_hash
+
+FALLBACK_MODES = ("serial", "predict", "hedge")
+
+
+class BlacklistPredictor:
+    """
+    Learns which retrieved chunks make GigaChat stop with the "blacklist" finish reason.
+
+    Every chunk has a smoothed blacklist rate, (blacklisted + prior) / (seen + 1),
+    and the risk of a context is the highest rate among its chunks, since a single
+    chunk is enough to trigger the filter. The predictor also counts which answer
+    path was taken, see `stats`.
+    """
+
+    def __init__(self, prior=0.05, min_seen=2):
+        """
+        :param prior: Risk of a chunk that was never seen
+        :param min_seen: Number of times a chunk must be seen before its rate is trusted
+        """
+        self.prior = prior
+        self.min_seen = min_seen
+        self.seen = Counter()
+        self.blacklisted = Counter()
+        self.paths = Counter()
+        self._lock = threading.Lock()
+
+    def risk(self, context):
+        """:return: probability that the prompt with these chunks is blacklisted"""
+        risk = 0.0
+        with self._lock:
+            for key in map(content_hash, context):
+                seen = self.seen[key]
+                if seen < self.min_seen:
+                    risk = max(risk, self.prior)
+                else:
+                    risk = max(risk, (self.blacklisted[key] + self.prior) / (seen + 1))
+        return risk
+
+    def update(self, context, blacklisted):
+        with self._lock:
+            for key in map(content_hash, context):
+                self.seen[key] += 1
+                self.blacklisted[key] += int(blacklisted)
+
+    def record_path(self, path):
+        """
+        :param path: "context" -- the answer with context was used,
+            "fallback" -- it was blacklisted and the general prompt was called after it,
+            "skipped" -- the call with context was skipped as too risky,
+            "hedged_context" / "hedged_general" -- both were called in parallel
+            and the one with context / the general one was used
+        """
+        with self._lock:
+            self.paths[path] += 1
+
+    def stats(self):
+        with self._lock:
+            total = sum(self.paths.values())
+            return {
+                "paths": dict(self.paths),
+                "path_rates": {
+                    path: count / total for path, count in self.paths.items()
+                },
+                "tracked_chunks": len(self.seen),
+                "blacklisted_chunks": sum(
+                    1 for count in self.blacklisted.values() if count
+                ),
+            }
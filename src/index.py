@@ -0,0 +1,171 @@
+import json
+import math
+import os
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from src.embeddings import BatchEmbedder
+
+INDEX_CONFIG_FILE = "index_config.json"
+
+# Named index types. Any other string is passed to `faiss.index_factory` as is,
+# e.g. "IVF1024,SQ8" or "HNSW32,PQ48".
+INDEX_TYPES = ("flat", "ivf", "hnsw", "sq8", "pq")
+# Chunks of the selected titles are scored exactly from their reconstructed vectors
+# and the chunk index is never searched, so only the vector codec matters for it
+CHUNK_INDEX_TYPES = ("flat", "sq8", "pq")
+
+DEFAULT_INDEX_PARAMS = {
+    "nlist": 1024,  # number of IVF cells
+    "nprobe": 16,  # number of IVF cells visited at search time
+    "hnsw_m": 32,  # number of HNSW neighbours per node
+    "ef_construction": 80,
+    "ef_search": 64,  # size of the HNSW candidate list at search time
+    "pq_m": 48,  # number of PQ sub-quantizers
+    "pq_nbits": 8,
+    "train_size": 50000,  # number of vectors to train IVF and quantizers on
+}
+
+
+def get_index_params(index_params=None):
+    return {**DEFAULT_INDEX_PARAMS, **(index_params or {})}
+
+
+def get_factory_string(index_type, dim, num_vectors, index_params=None):
+    """Turn a named index type into a `faiss.index_factory` description"""
+    params = get_index_params(index_params)
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf":
+        # FAISS wants ~39 training points per cell
+        nlist = max(1, min(params["nlist"], num_vectors // 39))
+        return f"IVF{nlist},Flat"
+    if index_type == "hnsw":
+        return f"HNSW{params['hnsw_m']},Flat"
+    if index_type == "sq8":
+        return "SQ8"
+    if index_type == "pq":
+        pq_m = max(m for m in range(1, params["pq_m"] + 1) if dim % m == 0)
+        # same ~39 training points per centroid for each of the 2 ** nbits centroids
+        max_nbits = int(math.log2(max(num_vectors // 39, 2)))
+        pq_nbits = max(1, min(params["pq_nbits"], max_nbits))
+        return f"PQ{pq_m}x{pq_nbits}"
+    return index_type
+
+
+def get_chunk_index_type(index_type):
+    """
+    Index type of the chunk store for the `index_type` of the retriever: its codec
+    without the search structure, e.g. "flat" for "ivf" and "hnsw", "PQ48" for
+    "IVF1024,PQ48". IVF and HNSW would only be built and trained for nothing
+    """
+    if index_type in CHUNK_INDEX_TYPES:
+        return index_type
+    if index_type in INDEX_TYPES:
+        return "flat"
+    codec = index_type.split(",")[-1]
+    if codec == "Flat" or codec.startswith(("IVF", "HNSW")):
+        return "flat"
+    return codec
+
+
+def configure_index(index, index_params=None):
+    """Apply search-time parameters and make vectors reconstructable by row"""
+    params = get_index_params(index_params)
+    ivf_index = faiss.try_extract_index_ivf(index)
+    if ivf_index is not None:
+        ivf_index.nprobe = min(params["nprobe"], ivf_index.nlist)
+        ivf_index.make_direct_map()
+    hnsw_index = faiss.downcast_index(index)
+    if isinstance(hnsw_index, faiss.IndexHNSW):
+        hnsw_index.hnsw.efSearch = params["ef_search"]
+    return index
+
+
+def create_index(index_type, dim, num_vectors, index_params=None):
+    """Create an empty, possibly untrained index of the given type"""
+    params = get_index_params(index_params)
+    factory_string = get_factory_string(index_type, dim, num_vectors, params)
+    index = faiss.index_factory(dim, factory_string, faiss.METRIC_L2)
+    hnsw_index = faiss.downcast_index(index)
+    if isinstance(hnsw_index, faiss.IndexHNSW):
+        hnsw_index.hnsw.efConstruction = params["ef_construction"]
+    return index
+
+
+def make_index(index_type, vectors, index_params=None):
+    """Create and train an empty index of the given type for `vectors`"""
+    num_vectors, dim = vectors.shape
+    index = create_index(index_type, dim, num_vectors, index_params)
+    if not index.is_trained:
+        index.train(vectors)
+    return index
+
+
+def add_batches(vectorstore, texts, batches, metadatas=None, ids=None):
+    """Add (positions, vectors) batches of embedded `texts` to the vectorstore"""
+    for positions, vectors in batches:
+        vectorstore.add_embeddings(
+            zip([texts[i] for i in positions], vectors),
+            metadatas=[metadatas[i] for i in positions] if metadatas else None,
+            ids=[ids[i] for i in positions] if ids else None,
+        )
+
+
+def build_vectorstore(
+    texts,
+    embeddings,
+    metadatas=None,
+    ids=None,
+    index_type="flat",
+    index_params=None,
+    embedder=None,
+):
+    """
+    Same as `FAISS.from_texts`, but with a configurable FAISS index.
+    Vectors are streamed into the index batch by batch, indexes that need
+    training are trained on a random sample of the texts, embedded first.
+    """
+    params = get_index_params(index_params)
+    embedder = embedder or BatchEmbedder(embeddings)
+    dim = len(embeddings.embed_documents(texts[:1])[0])
+    index = create_index(index_type, dim, len(texts), params)
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+    )
+    positions = np.arange(len(texts))
+    if not index.is_trained:
+        positions = np.random.default_rng(0).permutation(len(texts))
+        sample, positions = np.split(positions, [params["train_size"]])
+        batches = list(embedder.embed(texts, sample, desc="Embedding training sample"))
+        index.train(np.concatenate([vectors for _, vectors in batches]))
+        add_batches(vectorstore, texts, batches, metadatas, ids)
+    # Batches go into the index as soon as they are embedded
+    add_batches(vectorstore, texts, embedder.embed(texts, positions), metadatas, ids)
+    configure_index(vectorstore.index, index_params)
+    return vectorstore
+
+
+def save_index_config(path, index_type, index_params=None):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, INDEX_CONFIG_FILE), "w") as f:
+        json.dump(
+            {"index_type": index_type, "index_params": get_index_params(index_params)},
+            f,
+            indent=2,
+        )
+
+
+def load_index_config(path):
+    """Index config saved with the index. Indexes saved without it are flat"""
+    config_path = os.path.join(path, INDEX_CONFIG_FILE)
+    if not os.path.exists(config_path):
+        return {"index_type": "flat", "index_params": get_index_params()}
+    with open(config_path) as f:
+        return json.load(f)
@@ -2,6 +2,10 @@ import gradio as gr
 
 
 def create_interface(get_response):
+    """
+    :param get_response: Function from a query to the answer, or a generator function
+        yielding the answer generated so far, which updates the output as it goes
+    """
     description = "Ищете идеального спутника для своих путешествий? Наш AI гид — это ваш надежный источник информации о туристических направлениях, культурных традициях и исторических фактах. Он анализирует контекст и предоставляет вам персонализированные рекомендации, чтобы вы могли максимально насладиться своим путешествием. Просто задайте вопрос, и откройте для себя мир новых возможностей!"
 
     interface = gr.Blocks(title="🌏🧳🛩️  AI Travel Guide", theme="citrus")
@@ -0,0 +1,191 @@
+"""
+BM25 inverted indexes over titles and chunks, fused with dense retrieval.
+
+Postings are flat arrays: the documents with the term `t` are
+`doc_ids[offsets[t]:offsets[t + 1]]`, sorted by id, with precomputed BM25
+weights in `weights`. An index directory holds:
+
+- terms.json -- terms in the order of term ids
+- offsets.npy, doc_ids.npy, weights.npy -- postings
+- meta.json -- number of documents and tokenizer settings
+"""
+import json
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+META_FILE = "meta.json"
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text, stem_length=5):
+    """
+    Lowercased words cut to `stem_length` characters, a crude stemmer that makes
+    "Казани" and "Казань" or "Шанхае" and "Шанхай" the same term.
+    Tokens with digits are kept whole
+    """
+    text = text.lower().replace("ё", "е")
+    return [
+        token[:stem_length] if token.isalpha() else token
+        for token in TOKEN_PATTERN.findall(text)
+    ]
+
+
+def group_ranks(groups):
+    """Rank of every item within its group, `groups` must be sorted"""
+    return np.arange(len(groups)) - np.searchsorted(groups, groups)
+
+
+def reciprocal_rank_fusion(distances, lexical_scores, groups, k=60):
+    """
+    Fused scores of items ranked by distance and by BM25 score within their groups,
+    items without a lexical match get no lexical part
+
+    :param groups: Query number of every item
+    """
+    fused = np.zeros(len(groups))
+    order = np.lexsort((distances, groups))
+    fused[order] += 1 / (k + 1 + group_ranks(groups[order]))
+    order = np.lexsort((-lexical_scores, groups))
+    fused[order] += np.where(
+        lexical_scores[order] > 0, 1 / (k + 1 + group_ranks(groups[order])), 0
+    )
+    return fused
+
+
+class InvertedIndex:
+    """BM25 index with array-backed postings, document ids are positions of the texts"""
+
+    def __init__(self, terms, offsets, doc_ids, weights, num_docs, stem_length=5):
+        self.terms = terms
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.num_docs = num_docs
+        self.stem_length = stem_length
+
+    @classmethod
+    def from_texts(cls, texts, k1=1.2, b=0.75, stem_length=5):
+        term_ids = {}
+        posting_terms, posting_docs, posting_tfs = [], [], []
+        num_docs = 0
+        for doc_id, text in enumerate(texts):
+            for term, tf in Counter(tokenize(text, stem_length)).items():
+                posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+                posting_docs.append(doc_id)
+                posting_tfs.append(tf)
+            num_docs = doc_id + 1
+        posting_terms = np.array(posting_terms, dtype=np.int64)
+        posting_docs = np.array(posting_docs, dtype=np.int32)
+        posting_tfs = np.array(posting_tfs, dtype=np.float32)
+
+        doc_freqs = np.bincount(posting_terms, minlength=len(term_ids))
+        idf = np.log1p((num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        doc_lengths = np.bincount(posting_docs, weights=posting_tfs, minlength=num_docs)
+        average_length = doc_lengths.mean() if num_docs else 1.0
+        length_norm = 1 - b + b * doc_lengths / max(average_length, 1e-9)
+        weights = (
+            idf[posting_terms]
+            * posting_tfs
+            * (k1 + 1)
+            / (posting_tfs + k1 * length_norm[posting_docs])
+        )
+
+        order = np.lexsort((posting_docs, posting_terms))
+        offsets = np.concatenate([[0], np.cumsum(doc_freqs)])
+        return cls(
+            list(term_ids),
+            offsets,
+            posting_docs[order],
+            weights[order].astype(np.float32),
+            num_docs,
+            stem_length,
+        )
+
+    def score(self, query, doc_ids=None):
+        """:return: BM25 scores of all documents or of the given `doc_ids`"""
+        scores = np.zeros(
+            self.num_docs if doc_ids is None else len(doc_ids), dtype=np.float32
+        )
+        for term in set(tokenize(query, self.stem_length)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs, weights = self.doc_ids[start:end], self.weights[start:end]
+            if doc_ids is None:
+                scores[docs] += weights
+            else:
+                positions = np.minimum(np.searchsorted(docs, doc_ids), len(docs) - 1)
+                found = docs[positions] == doc_ids
+                scores[found] += weights[positions[found]]
+        return scores
+
+    def search(self, query, k):
+        """:return: ids and scores of the top k documents with any query term"""
+        scores = self.score(query)
+        doc_ids = np.flatnonzero(scores)
+        if len(doc_ids) > k:
+            doc_ids = doc_ids[np.argpartition(-scores[doc_ids], k - 1)[:k]]
+        doc_ids = doc_ids[np.lexsort((doc_ids, -scores[doc_ids]))]
+        return doc_ids, scores[doc_ids]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "terms.json"), "w", encoding="utf-8") as f:
+            json.dump(self.terms, f, ensure_ascii=False)
+        np.save(os.path.join(path, "offsets.npy"), self.offsets)
+        np.save(os.path.join(path, "doc_ids.npy"), self.doc_ids)
+        np.save(os.path.join(path, "weights.npy"), self.weights)
+        with open(os.path.join(path, META_FILE), "w") as f:
+            json.dump({"num_docs": self.num_docs, "stem_length": self.stem_length}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "terms.json"), encoding="utf-8") as f:
+            terms = json.load(f)
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        return cls(
+            terms,
+            np.load(os.path.join(path, "offsets.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "doc_ids.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "weights.npy"), mmap_mode="r"),
+            meta["num_docs"],
+            meta["stem_length"],
+        )
+
+
+def build_lexical_indexes(title_store, chunk_store):
+    """:return: indexes of titles by title id and of chunks by chunk store row"""
+    title_index = InvertedIndex.from_texts(title_store.titles)
+    chunk_index = InvertedIndex.from_texts(
+        chunk_store.get_text(row) for row in range(len(chunk_store))
+    )
+    return title_index, chunk_index
+
+
+def save_lexical_indexes(path, title_index, chunk_index, meta=None):
+    title_index.save(os.path.join(path, "titles"))
+    chunk_index.save(os.path.join(path, "chunks"))
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump(meta or {}, f, indent=2)
+    print(f"Lexical indexes saved to {path}.")
+
+
+def load_lexical_meta(path):
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def load_lexical_indexes(path):
+    return (
+        InvertedIndex.load(os.path.join(path, "titles")),
+        InvertedIndex.load(os.path.join(path, "chunks")),
+    )
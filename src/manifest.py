@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+
+import faiss
+
+
+def content_hash(*parts):
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def hash_data(data):
+    """
+    Content hashes of titles and chunks of chunked data
+
+    :return: {title_hash: title}, {chunk_hash: (title, chunk)}.
+        Repeated chunks of the same title share a hash and are kept once
+    """
+    titles = {}
+    chunks = {}
+    for title, title_chunks in data.items():
+        titles[content_hash(title)] = title
+        for chunk in title_chunks:
+            chunks.setdefault(content_hash(title, chunk), (title, chunk))
+    return titles, chunks
+
+
+def hash_vectorstore(vectorstore, with_title=False):
+    """{content_hash: docstore_id} for every document of a FAISS vectorstore"""
+    hashes = {}
+    for docstore_id in vectorstore.index_to_docstore_id.values():
+        doc = vectorstore.docstore.search(docstore_id)
+        if with_title:
+            hashes[content_hash(doc.metadata["title"], doc.page_content)] = docstore_id
+        else:
+            hashes[content_hash(doc.page_content)] = docstore_id
+    return hashes
+
+
+def file_sha256(path, block_size=2**20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def fingerprint_files(paths, previous=None):
+    """Size, mtime and sha256 of files. Hashes are reused for files whose size and mtime did not change"""
+    previous = previous or {}
+    fingerprints = {}
+    for path in sorted(paths):
+        stat = os.stat(path)
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        known = previous.get(path, {})
+        if all(known.get(key) == value for key, value in fingerprint.items()):
+            fingerprint["sha256"] = known["sha256"]
+        else:
+            fingerprint["sha256"] = file_sha256(path)
+        fingerprints[path] = fingerprint
+    return fingerprints
+
+
+def same_sources(old_sources, new_sources):
+    if old_sources.keys() != new_sources.keys():
+        return False
+    return all(
+        old_sources[path]["sha256"] == new_sources[path]["sha256"]
+        for path in new_sources
+    )
+
+
+def supports_removal(index):
+    """LangChain's FAISS.delete expects the index to close the gaps of removed rows"""
+    return isinstance(faiss.downcast_index(index), faiss.IndexFlatCodes)
+
+
+def build_manifest(
+    title_vectorstore,
+    chunk_vectorstore,
+    embedding_model,
+    sources,
+    embedding_backend="torch",
+):
+    return {
+        "embedding_model": embedding_model,
+        "embedding_backend": embedding_backend,
+        "sources": sources or {},
+        "titles": hash_vectorstore(title_vectorstore),
+        "chunks": hash_vectorstore(chunk_vectorstore, with_title=True),
+    }
+
+
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,200 @@
+"""
+Aggregated pipeline metrics in the Prometheus text format.
+
+`PipelineMetrics` turns request traces of `StageTimer` into latency histograms per
+stage, counters of LLM paths, answer cache hits and context tokens.
+`start_metrics_server` serves them at /metrics for Prometheus to scrape.
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, from a cached retrieval to a slow LLM answer
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in self.values.items():
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        # labels -> (counts per bucket, sum, count)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self.values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(counts):
+                counts[position] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    bucket_labels = labels + (("le", f"{bound:g}"),)
+                    lines.append(
+                        f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}"
+                    )
+                inf_labels = labels + (("le", "+Inf"),)
+                lines.append(f"{self.name}_bucket{_format_labels(inf_labels)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        return "\n".join(line for m in self.metrics for line in m.render()) + "\n"
+
+
+class PipelineMetrics:
+    """Metrics of RAG requests, recorded from their traces"""
+
+    def __init__(self, registry=None, prefix="rag"):
+        self.registry = registry or MetricsRegistry()
+        self.requests = self.registry.histogram(
+            f"{prefix}_request_duration_seconds", "Duration of RAG requests"
+        )
+        self.stages = self.registry.histogram(
+            f"{prefix}_stage_duration_seconds",
+            "Duration of the stages of RAG requests, see StageTimer",
+        )
+        self.llm_paths = self.registry.counter(
+            f"{prefix}_llm_path_total",
+            "LLM calls by path: context, skipped, fallback, hedged_context, hedged_general",
+        )
+        self.hedge_outcomes = self.registry.counter(
+            f"{prefix}_hedged_general_calls_total",
+            "Hedged general LLM calls by outcome: used, cancelled, wasted "
+            "(done before the answer with context, billed for nothing), failed",
+        )
+        self.cache_hits = self.registry.counter(
+            f"{prefix}_answer_cache_hits_total", "Answers taken from the answer cache"
+        )
+        self.tokens = self.registry.counter(
+            f"{prefix}_tokens_total",
+            "Tokens of the retrieved chunks (raw), of the prompt context and of LLM calls",
+        )
+
+    def record(self, trace):
+        """
+        :param trace: `StageTimer.trace()` of a request, with the "method",
+            "cache_hit", "llm_path" and token attributes set by `RAG`
+        """
+        attributes = trace["attributes"]
+        self.requests.observe(
+            trace["duration"],
+            method=attributes.get("method", ""),
+            cache_hit=str(bool(attributes.get("cache_hit"))).lower(),
+        )
+        for span in trace["spans"]:
+            if span["duration"] is not None:
+                self.stages.observe(span["duration"], stage=span["name"])
+        if attributes.get("cache_hit"):
+            self.cache_hits.inc()
+        if attributes.get("llm_path"):
+            self.llm_paths.inc(path=attributes["llm_path"])
+        if attributes.get("hedge_outcome"):
+            self.hedge_outcomes.inc(outcome=attributes["hedge_outcome"])
+        for kind in ["raw", "prompt", "llm_prompt", "llm_completion"]:
+            tokens = attributes.get(f"{kind}_tokens")
+            if tokens:
+                self.tokens.inc(tokens, kind=kind)
+
+
+def start_metrics_server(registry, port=9100, host="0.0.0.0"):
+    """
+    Serve `registry` at http://host:port/metrics from a daemon thread
+
+    :return: the server, `server.shutdown()` stops it
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes every few seconds would flood the app log
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics at http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,142 @@
+"""
+On-disk format of the title and chunk stores that worker processes can memory-map.
+
+Everything is a flat array, so N processes serving from the same directory share
+the pages through the OS page cache, and loading needs no unpickling:
+
+- title_index.faiss -- title index, row = title id
+- titles.bin, title_offsets.npy -- title texts
+- chunk_codec.faiss -- empty trained FAISS index that decodes chunk vectors
+- chunk_codes.npy -- chunk vectors encoded by the codec (raw float32 for Flat),
+  ordered by title, so chunks of a title are a contiguous range of rows
+- chunk_texts.bin, chunk_text_offsets.npy -- chunk texts, same order
+- title_chunk_offsets.npy -- rows of the title `t` are offsets[t]:offsets[t + 1]
+- meta.json -- format version, index config and hash of the manifest it was exported from
+"""
+import hashlib
+import json
+import os
+
+import faiss
+import numpy as np
+
+from src.chunk_store import ChunkStore, StringTable, TitleStore
+
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def read_index_mmap(path):
+    """Memory-map the index if FAISS can do it for this index type"""
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        return faiss.read_index(path)
+
+
+def save_string_table(table, path, offsets_path):
+    table.buffer.tofile(path)
+    np.save(offsets_path, table.offsets)
+
+
+def load_string_table(path, offsets_path):
+    offsets = np.load(offsets_path, mmap_mode="r")
+    if offsets[-1] == 0:
+        return StringTable(np.empty(0, dtype=np.uint8), offsets)
+    return StringTable(np.memmap(path, dtype=np.uint8, mode="r"), offsets)
+
+
+def make_codec(index):
+    """Empty copy of a flat-codes index (Flat, SQ, PQ) or a Flat codec for any other index"""
+    if isinstance(faiss.downcast_index(index), faiss.IndexFlatCodes):
+        codec = faiss.clone_index(index)
+        codec.reset()
+        return codec
+    return faiss.IndexFlatL2(index.d)
+
+
+def export_mmap_stores(
+    path, title_vectorstore, chunk_vectorstore, meta=None, batch_size=65536
+):
+    """Write vectorstores in the memory-mappable format, see the module docstring"""
+    os.makedirs(path, exist_ok=True)
+    title_store = TitleStore.from_vectorstore(title_vectorstore)
+    chunk_store = ChunkStore.from_vectorstore(chunk_vectorstore, title_store.titles)
+    assert len(chunk_store.titles) == len(
+        title_store.titles
+    ), "Every chunk title must be in the title index."
+
+    faiss.write_index(title_vectorstore.index, os.path.join(path, "title_index.faiss"))
+    save_string_table(
+        StringTable.from_strings(title_store.titles),
+        os.path.join(path, "titles.bin"),
+        os.path.join(path, "title_offsets.npy"),
+    )
+
+    codec = make_codec(chunk_vectorstore.index)
+    faiss.write_index(codec, os.path.join(path, "chunk_codec.faiss"))
+    codes = np.lib.format.open_memmap(
+        os.path.join(path, "chunk_codes.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(chunk_store), codec.sa_code_size()),
+    )
+    for start in range(0, len(chunk_store), batch_size):
+        rows = chunk_store.rows[start : start + batch_size]
+        codes[start : start + len(rows)] = codec.sa_encode(
+            chunk_store.get_vectors(rows)
+        )
+    codes.flush()
+    del codes
+    save_string_table(
+        StringTable.from_strings(chunk_store.get_text(row) for row in chunk_store.rows),
+        os.path.join(path, "chunk_texts.bin"),
+        os.path.join(path, "chunk_text_offsets.npy"),
+    )
+    np.save(os.path.join(path, "title_chunk_offsets.npy"), chunk_store.offsets)
+
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump({"format_version": FORMAT_VERSION, **(meta or {})}, f, indent=2)
+    print(f"Memory-mappable stores saved to {path}.")
+
+
+def load_mmap_meta(path):
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("format_version") != FORMAT_VERSION:
+        return None
+    return meta
+
+
+def load_mmap_stores(path):
+    """:return: TitleStore and ChunkStore backed by memory-mapped files"""
+    titles = load_string_table(
+        os.path.join(path, "titles.bin"), os.path.join(path, "title_offsets.npy")
+    )
+    title_store = TitleStore(
+        read_index_mmap(os.path.join(path, "title_index.faiss")), titles
+    )
+
+    codec = faiss.read_index(os.path.join(path, "chunk_codec.faiss"))
+    codes = np.load(os.path.join(path, "chunk_codes.npy"), mmap_mode="r")
+    texts = load_string_table(
+        os.path.join(path, "chunk_texts.bin"),
+        os.path.join(path, "chunk_text_offsets.npy"),
+    )
+    offsets = np.load(os.path.join(path, "title_chunk_offsets.npy"), mmap_mode="r")
+    chunk_store = ChunkStore(
+        titles,
+        offsets,
+        np.arange(len(codes)),
+        get_vectors=lambda rows: codec.sa_decode(np.ascontiguousarray(codes[rows])),
+        get_text=texts.__getitem__,
+    )
+    return title_store, chunk_store
@@ -0,0 +1,84 @@
+"""
+Sampling profiler for slow requests.
+
+While a request runs, a background thread takes the Python stacks of the threads
+every `interval` seconds. If the request takes longer than `threshold` seconds,
+the samples are written in the collapsed stack format ("frame;frame;frame count"
+per line), which flamegraph.pl and speedscope read. Faster requests are dropped.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class SlowRequestProfiler:
+    def __init__(
+        self, threshold=2.0, interval=0.01, output_dir="profiles", all_threads=True
+    ):
+        """
+        :param threshold: Seconds after which a request is slow and its profile is saved
+        :param interval: Seconds between samples
+        :param all_threads: Sample every thread, e.g. the retrieval thread pool and
+            the event loop of `arun`. Otherwise only the thread that started the
+            request, which is enough for `run`. Stacks of concurrent requests are
+            mixed in the profile of all threads
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.output_dir = output_dir
+        self.all_threads = all_threads
+        self.saved = []
+
+    def _sample(self, thread_id, samples, stop):
+        own_id = threading.get_ident()
+        while not stop.wait(self.interval):
+            for frame_thread_id, frame in sys._current_frames().items():
+                if frame_thread_id == own_id or (
+                    not self.all_threads and frame_thread_id != thread_id
+                ):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                        f":{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                samples[";".join(reversed(stack))] += 1
+
+    @contextmanager
+    def profile(self, name="request"):
+        """Sample the stacks while the block runs, save them if it is slow"""
+        samples = Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample,
+            args=(threading.get_ident(), samples, stop),
+            daemon=True,
+        )
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            sampler.join()
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.threshold and samples:
+                self.save(name, samples, elapsed)
+
+    def save(self, name, samples, elapsed):
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(
+            self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.collapsed"
+        )
+        with open(path, "w") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        self.saved.append(path)
+        print(f"Slow request ({elapsed:.1f} s), profile saved to {path}")
+        return path
@@ -1,5 +1,12 @@
+import asyncio
+import json
+import logging
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 
 sys.path.append("./")
 
@@ -10,25 +17,89 @@ from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 
-from src.data.data_processing import load_and_preprocess_data
+from src.data.data_processing import LazyChunkedData
 
+from src.cache import SemanticCache
+from src.context import Context, ContextBuilder
+from src.fallback import FALLBACK_MODES, BlacklistPredictor
+from src.manifest import content_hash
 from src.retriever import HierarchicalRetriever
+from src.timing import StageTimer
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 giga_key = os.getenv("API_KEY")
 
 
 class RAG:
-    def __init__(self, data, model_name="GigaChat"):
-        self.retriever = HierarchicalRetriever(data)
-        self.llm = GigaChat(
-            credentials=giga_key,
-            model=model_name,
-            timeout=30,
-            verify_ssl_certs=False,
-            profanity_check=False,
+    def __init__(
+        self,
+        data,
+        model_name="GigaChat",
+        retriever_kwargs=None,
+        answer_cache_size=1024,
+        answer_cache_threshold=0.95,
+        retrieval_workers=4,
+        fallback_mode="serial",
+        skip_threshold=0.8,
+        hedge_threshold=0.3,
+        context_token_budget=None,
+        context_min_similarity=None,
+        metrics=None,
+        profiler=None,
+    ):
+        """
+        :param answer_cache_size: Number of LLM answers to keep, 0 disables the cache
+        :param answer_cache_threshold: Minimal cosine similarity of a new query to
+            a cached one to reuse its answer. The retrieved chunks must be the same too
+        :param retrieval_workers: Number of threads that run retrieval for `arun`
+        :param fallback_mode: What to do about contexts that GigaChat may blacklist:
+            "serial" -- call the general prompt only after a blacklisted answer,
+            "predict" -- skip the call with context if the risk predicted from
+            earlier blacklisted chunks is at least `skip_threshold`,
+            "hedge" -- same, and call the general prompt in parallel with the one
+            with context if the risk is at least `hedge_threshold`. The general
+            call is cancelled as soon as the answer with context is not blacklisted
+        :param context_token_budget: Maximal number of tokens of the retrieved
+            context in the prompt, see `ContextBuilder`. None for no limit, the
+            default, as compressing the context embeds its sentences on the path
+            of the request. Set it above the usual context, `total_chunks`
+            chunks of the retriever, 5 chunks of up to 1000 characters (about
+            1300 tokens) by default
+        :param context_min_similarity: Drop context sentences less similar to the query
+        :param metrics: `PipelineMetrics` to record every request to
+        :param profiler: `SlowRequestProfiler` to sample the stacks of slow requests
+        """
+        assert fallback_mode in FALLBACK_MODES, f"Unknown fallback mode {fallback_mode}"
+        self.retriever = HierarchicalRetriever(data, **(retriever_kwargs or {}))
+        self.answer_cache = SemanticCache(
+            threshold=answer_cache_threshold, maxsize=answer_cache_size
+        )
+        self.last_timings = {}
+        self.executor = ThreadPoolExecutor(max_workers=retrieval_workers)
+        self.fallback_mode = fallback_mode
+        self.skip_threshold = skip_threshold
+        self.hedge_threshold = hedge_threshold
+        self.blacklist_predictor = BlacklistPredictor()
+        self.context_builder = ContextBuilder(
+            self.retriever.embeddings,
+            token_budget=context_token_budget,
+            min_similarity=context_min_similarity,
+        )
+        self.last_context_stats = {}
+        self.metrics = metrics
+        self.profiler = profiler
+        self.last_trace = None
+        self.llm = self.create_llm(model_name)
+        # Hedged calls of `generate` run in an event loop of their own, with their
+        # own LLM: the async HTTP client of an LLM is bound to its first event loop
+        self.hedge_llm = (
+            self.create_llm(model_name) if fallback_mode == "hedge" else None
         )
+        self._hedge_loop = None
+        self._hedge_loop_lock = threading.Lock()
 
         self.rag_system_prompt = """
             Ты - опытный туристический гид с обширными знаниями о путешествиях, культуре и истории разных мест.
@@ -59,11 +130,22 @@ class RAG:
             Вопрос пользователя: {question}
         """
 
-    def retrieve(self, query):
-        return self.retriever.retrieve(query)
+    def create_llm(self, model_name):
+        return GigaChat(
+            credentials=giga_key,
+            model=model_name,
+            timeout=30,
+            verify_ssl_certs=False,
+            profanity_check=False,
+        )
+
+    def retrieve(self, query, timer=None):
+        return self.retriever.retrieve(query, timer=timer)
 
     def create_prompt(self, query, context):
         if len(context) > 0:
+            if isinstance(context, Context):
+                context = context.prompt
             return [
                 SystemMessage(content=self.rag_system_prompt),
                 HumanMessage(
@@ -74,20 +156,420 @@ class RAG:
             ]
         return [SystemMessage(content=self.general_system_prompt), HumanMessage(query)]
 
-    def run(self, query):
-        context = self.retrieve(query)
-        prompt = self.create_prompt(query, context)
+    def _prepare(self, query, timer, use_cache=True):
+        """
+        Retrieval and answer cache lookup, the CPU-bound part of a request
 
-        response = self.llm.invoke(prompt)
-        if response.response_metadata["finish_reason"] == "blacklist":
-            prompt = self.create_prompt(query, [])
+        :return: retrieved chunks, cached answer or None and the answer cache key,
+            None if the cache is not used. Without a cached answer the chunks are
+            a `Context` with the prompt text built by `context_builder`
+        """
+        with timer("retrieve") as span:
+            chunks = self.retriever.retrieve(query, timer=timer, with_titles=True)
+            span["attributes"]["chunks"] = len(chunks)
+        context = [chunk for _, chunk in chunks]
+        cache_key = None
+        if use_cache and self.answer_cache.maxsize > 0:
+            with timer("answer_cache") as span:
+                cache_key = (self.retriever.embed_query(query), content_hash(*context))
+                result = self.answer_cache.get(*cache_key)
+                span["attributes"]["hit"] = result is not None
+            if result is not None:
+                return context, result, cache_key
+        with timer("build_context") as span:
+            context = self.context_builder.build(
+                self.retriever.embed_query(query), chunks
+            )
+            span["attributes"].update(context.stats)
+        timer.annotate(**context.stats)
+        return context, None, cache_key
+
+    def _result(
+        self, response, context, timer, cache_key, cache_hit=False, llm_path=None
+    ):
+        if cache_key is not None and not cache_hit:
+            self.answer_cache.put(*cache_key, response)
+        self.last_context_stats = getattr(context, "stats", {})
+        timer.annotate(cache_hit=cache_hit)
+        if llm_path is not None:
+            timer.annotate(
+                llm_path=llm_path,
+                blacklist_fallback=llm_path in ("fallback", "hedged_general"),
+            )
+        return {
+            "response": response,
+            "retrieved_chunks": list(context),
+            "timings": timer.timings,
+            "cache_hit": cache_hit,
+            "llm_path": llm_path,
+            "context_tokens": self.last_context_stats,
+        }
+
+    @contextmanager
+    def _observe(self, timer, method):
+        """
+        Store the trace of the request in `last_trace` and record it to `metrics`,
+        profile the request if `profiler` is set
+        """
+        timer.annotate(method=method)
+        profile = nullcontext()
+        if self.profiler is not None:
+            profile = self.profiler.profile(f"{method}-{timer.trace_id[:8]}")
+        try:
+            with profile:
+                yield
+        finally:
+            self.last_trace = timer.trace()
+            logger.debug(json.dumps(self.last_trace, ensure_ascii=False, default=str))
+            if self.metrics is not None:
+                self.metrics.record(self.last_trace)
+
+    def _invoke(self, prompt, timer, stage):
+        """LLM call traced as `stage` with the token usage, if the LLM reports it"""
+        with timer(stage) as span:
             response = self.llm.invoke(prompt)
-        result = response.content
-        return {"response": result, "retrieved_chunks": context}
+            span["attributes"].update(self._token_usage(response, timer))
+        return response
+
+    async def _ainvoke(self, prompt, timer, stage, llm=None, parent=None):
+        with timer(stage, parent=parent) as span:
+            try:
+                response = await (llm or self.llm).ainvoke(prompt)
+            except asyncio.CancelledError:
+                span["attributes"]["cancelled"] = True
+                raise
+            span["attributes"].update(self._token_usage(response, timer))
+        return response
+
+    def _token_usage(self, response, timer):
+        """Token counts of an LLM response, also summed over the request in `timer`"""
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            prompt_tokens, completion_tokens = (
+                usage["input_tokens"],
+                usage["output_tokens"],
+            )
+        else:
+            # GigaChat of langchain-community passes only the usage of the API response
+            usage = response.response_metadata.get("token_usage")
+            if not usage:
+                return {}
+            if not isinstance(usage, dict):
+                usage = vars(usage)
+            prompt_tokens, completion_tokens = (
+                usage["prompt_tokens"],
+                usage["completion_tokens"],
+            )
+        tokens = {
+            "llm_prompt_tokens": prompt_tokens,
+            "llm_completion_tokens": completion_tokens,
+        }
+        timer.annotate(
+            **{key: timer.attributes.get(key, 0) + n for key, n in tokens.items()}
+        )
+        return tokens
+
+    def _llm_plan(self, context):
+        """:return: "general" to skip the call with context, "hedge" or "context" """
+        if not context or self.fallback_mode == "serial":
+            return "context"
+        risk = self.blacklist_predictor.risk(context)
+        if risk >= self.skip_threshold:
+            return "general"
+        if self.fallback_mode == "hedge" and risk >= self.hedge_threshold:
+            return "hedge"
+        return "context"
+
+    def _is_blacklisted(self, response, context):
+        blacklisted = response.response_metadata["finish_reason"] == "blacklist"
+        self.blacklist_predictor.update(context, blacklisted)
+        return blacklisted
+
+    async def _ahedge(self, query, context, timer, llm=None, parent=None):
+        """
+        Call the general prompt in parallel with the one with context. The general
+        call is cancelled if the answer with context is not blacklisted, unless it
+        is already done: then it is wasted, its tokens are counted anyway.
+        The outcome of the general call ("used", "cancelled", "wasted" or
+        "failed") is stored as the "hedge_outcome" attribute of the trace
+
+        :param parent: Span of the calls, the innermost open span by default
+        :return: LLM response and the path taken
+        """
+        parent = parent or timer.current()
+        general = asyncio.create_task(
+            self._ainvoke(
+                self.create_prompt(query, []), timer, "llm_hedge", llm, parent
+            )
+        )
+        try:
+            response = await self._ainvoke(
+                self.create_prompt(query, context), timer, "llm_context", llm, parent
+            )
+        except BaseException:
+            general.cancel()
+            raise
+        if self._is_blacklisted(response, context):
+            timer.annotate(hedge_outcome="used")
+            return await general, "hedged_general"
+        general.cancel()
+        await asyncio.gather(general, return_exceptions=True)
+        if general.cancelled():
+            outcome = "cancelled"
+        elif general.exception() is not None:
+            outcome = "failed"
+        else:
+            outcome = "wasted"
+        timer.annotate(hedge_outcome=outcome)
+        return response, "hedged_context"
+
+    def _run_hedge(self, query, context, timer):
+        """`_ahedge` from sync code, in the event loop thread of the hedged calls"""
+        with self._hedge_loop_lock:
+            if self._hedge_loop is None:
+                self._hedge_loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._hedge_loop.run_forever, name="hedge", daemon=True
+                ).start()
+        return asyncio.run_coroutine_threadsafe(
+            self._ahedge(query, context, timer, self.hedge_llm, timer.current()),
+            self._hedge_loop,
+        ).result()
+
+    def _llm_calls(self, query, context, plan):
+        """
+        LLM calls of `generate` and `agenerate` without hedging: yields
+        (prompt, stage) of every call and is sent its response back
+
+        :return: the path taken
+        """
+        if plan == "general":
+            yield self.create_prompt(query, []), "llm_general"
+            return "skipped"
+        response = yield self.create_prompt(query, context), "llm_context"
+        if not self._is_blacklisted(response, context):
+            return "context"
+        yield self.create_prompt(query, []), "llm_general"
+        return "fallback"
+
+    def generate(self, query, context, timer=None):
+        """
+        Call the LLM with the context and fall back to the general prompt
+        as set by `fallback_mode`
+
+        :param timer: `StageTimer` to trace the calls in
+        :return: LLM response and the path taken, see `BlacklistPredictor.record_path`
+        """
+        timer = timer or StageTimer()
+        plan = self._llm_plan(context)
+        if plan == "hedge":
+            response, path = self._run_hedge(query, context, timer)
+        else:
+            calls, response = self._llm_calls(query, context, plan), None
+            try:
+                while True:
+                    prompt, stage = calls.send(response)
+                    response = self._invoke(prompt, timer, stage)
+            except StopIteration as stop:
+                path = stop.value
+        self.blacklist_predictor.record_path(path)
+        return response, path
+
+    async def agenerate(self, query, context, timer=None):
+        """Async version of `generate`"""
+        timer = timer or StageTimer()
+        plan = self._llm_plan(context)
+        if plan == "hedge":
+            response, path = await self._ahedge(query, context, timer)
+        else:
+            calls, response = self._llm_calls(query, context, plan), None
+            try:
+                while True:
+                    prompt, stage = calls.send(response)
+                    response = await self._ainvoke(prompt, timer, stage)
+            except StopIteration as stop:
+                path = stop.value
+        self.blacklist_predictor.record_path(path)
+        return response, path
+
+    def fallback_stats(self):
+        """How often each LLM path was taken, see `BlacklistPredictor.stats`"""
+        return self.blacklist_predictor.stats()
+
+    def run(self, query, use_cache=True):
+        """
+        :param use_cache: Reuse the answer to a similar earlier query with the same
+            retrieved chunks instead of calling the LLM
+        """
+        timer = StageTimer()
+        with self._observe(timer, "run"):
+            context, result, cache_key = self._prepare(query, timer, use_cache)
+            if result is not None:
+                return self._result(result, context, timer, cache_key, cache_hit=True)
+
+            with timer("llm"):
+                response, path = self.generate(query, context, timer)
+            return self._result(
+                response.content, context, timer, cache_key, llm_path=path
+            )
+
+    async def arun(self, query, use_cache=True):
+        """
+        Async version of `run` for serving concurrent requests.
+
+        Retrieval runs in a thread pool of `retrieval_workers` threads, so it does
+        not block the event loop, and the LLM is called through its async client.
+        """
+        timer = StageTimer()
+        with self._observe(timer, "arun"):
+            loop = asyncio.get_running_loop()
+            context, result, cache_key = await loop.run_in_executor(
+                self.executor, self._prepare, query, timer, use_cache
+            )
+            if result is not None:
+                return self._result(result, context, timer, cache_key, cache_hit=True)
+
+            with timer("llm"):
+                response, path = await self.agenerate(query, context, timer)
+            return self._result(
+                response.content, context, timer, cache_key, llm_path=path
+            )
+
+    def _stream_cache_hit(self, timer):
+        timer.annotate(cache_hit=True)
+        self.last_timings = timer.timings
+
+    def _finish_stream(self, answer, timer, cache_key):
+        self.blacklist_predictor.record_path(answer.path)
+        self._result(
+            answer.text, answer.context, timer, cache_key, llm_path=answer.path
+        )
+        timer.annotate(**answer.timings)
+        self.last_timings = {**timer.timings, **answer.timings}
+
+    def stream(self, query, use_cache=True):
+        """
+        Streaming version of `run`: yields the answer generated so far after every token.
+
+        If GigaChat stops with the "blacklist" finish reason, the partial answer is
+        dropped (an empty string is yielded) and the answer without context is
+        streamed from the start. Risky contexts are skipped as in `run`,
+        but the calls are never hedged. Timings, including time to the first token,
+        are stored in `self.last_timings`. Streamed requests report no token usage:
+        GigaChat sends none with the chunks.
+        """
+        start = time.perf_counter()
+        timer = StageTimer()
+        with self._observe(timer, "stream"):
+            context, result, cache_key = self._prepare(query, timer, use_cache)
+            if result is not None:
+                self._stream_cache_hit(timer)
+                yield result
+                return
+
+            answer = StreamedAnswer(self, query, context, start)
+            with timer("llm"):
+                for prompt, stage in answer.calls():
+                    with timer(stage):
+                        for chunk in self.llm.stream(prompt):
+                            if answer.add(chunk):
+                                yield answer.text
+                            elif answer.blacklisted:
+                                break
+                    if answer.done():
+                        break
+                    yield ""
+            self._finish_stream(answer, timer, cache_key)
+
+    async def astream(self, query, use_cache=True):
+        """Async version of `stream`, see `arun`"""
+        start = time.perf_counter()
+        timer = StageTimer()
+        with self._observe(timer, "astream"):
+            loop = asyncio.get_running_loop()
+            context, result, cache_key = await loop.run_in_executor(
+                self.executor, self._prepare, query, timer, use_cache
+            )
+            if result is not None:
+                self._stream_cache_hit(timer)
+                yield result
+                return
+
+            answer = StreamedAnswer(self, query, context, start)
+            with timer("llm"):
+                for prompt, stage in answer.calls():
+                    with timer(stage):
+                        async for chunk in self.llm.astream(prompt):
+                            if answer.add(chunk):
+                                yield answer.text
+                            elif answer.blacklisted:
+                                break
+                    if answer.done():
+                        break
+                    yield ""
+            self._finish_stream(answer, timer, cache_key)
+
+
+class StreamedAnswer:
+    """
+    Answer of `RAG.stream` and `RAG.astream` while it is generated: the prompts to
+    stream in order, the text so far, the path taken and the time to the first token
+    """
+
+    def __init__(self, rag, query, context, start):
+        """:param start: `time.perf_counter()` at the start of the request"""
+        self.rag = rag
+        self.query = query
+        self.context = context
+        self.start = start
+        skip = rag._llm_plan(context) == "general"
+        self.path = "skipped" if skip else "context"
+        self.prompt_contexts = [[]] if skip else [context, []]
+        self.with_context = False
+        self.text = ""
+        self.finish_reason = None
+        self.timings = {}
+
+    @property
+    def blacklisted(self):
+        return self.finish_reason == "blacklist"
+
+    def calls(self):
+        """(prompt, stage) of the calls, the next one only if `done()` is False"""
+        for prompt_context in self.prompt_contexts:
+            self.with_context = bool(prompt_context)
+            self.text, self.finish_reason = "", None
+            stage = "llm_context" if prompt_context else "llm_general"
+            yield self.rag.create_prompt(self.query, prompt_context), stage
+
+    def add(self, chunk):
+        """:return: True if the chunk added text to the answer"""
+        self.finish_reason = chunk.response_metadata.get(
+            "finish_reason", self.finish_reason
+        )
+        if self.blacklisted or not chunk.content:
+            return False
+        if not self.timings:
+            self.timings["time_to_first_token"] = time.perf_counter() - self.start
+        self.text += chunk.content
+        return True
+
+    def done(self):
+        """
+        End of a call: False if the answer was blacklisted and is dropped,
+        then the general prompt is streamed next
+        """
+        if self.with_context:
+            self.rag.blacklist_predictor.update(self.context, self.blacklisted)
+        if not self.blacklisted:
+            return True
+        self.path = "fallback"
+        self.timings.clear()
+        return False
 
 
 if __name__ == "__main__":
-    chunked_data = load_and_preprocess_data(datadir="./data")
+    chunked_data = LazyChunkedData(datadir="./data")
 
     rag = RAG(chunked_data)
     print(rag.run("Что посмотреть в Москве?"))
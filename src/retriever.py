@@ -1,12 +1,62 @@
+import atexit
+import json
 import os
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Union
+
+import numpy as np
 from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
-from src.data.data_processing import load_and_preprocess_data
+from src.cache import LRUCache, load_caches, normalize_query, save_caches
+from src.chunk_store import ChunkStore, ShardedChunkStore, TitleStore
+from src.embeddings import BatchEmbedder, load_embeddings
+from src.index import (
+    add_batches,
+    build_vectorstore,
+    configure_index,
+    get_chunk_index_type,
+    load_index_config,
+    save_index_config,
+)
+from src.lexical import (
+    build_lexical_indexes,
+    group_ranks,
+    load_lexical_indexes,
+    load_lexical_meta,
+    reciprocal_rank_fusion,
+    save_lexical_indexes,
+)
+from src.manifest import (
+    build_manifest,
+    content_hash,
+    fingerprint_files,
+    hash_data,
+    hash_vectorstore,
+    load_manifest,
+    same_sources,
+    save_manifest,
+    supports_removal,
+)
+from src.mmap_store import (
+    export_mmap_stores,
+    file_hash,
+    load_mmap_meta,
+    load_mmap_stores,
+)
+from src.sharding import (
+    ShardedVectorStore,
+    load_num_shards,
+    load_shards,
+    save_shards_meta,
+    shard_of,
+    shard_path,
+)
+from src.data.data_processing import LazyChunkedData, load_and_preprocess_data
+from src.timing import StageTimer
 
 
 def print_retrieved_items(results, prefix, crop_length=30):
-    def crop_text(text):
+    def crop_text(item):
+        text = getattr(item, "page_content", item)
         text = text.replace("\n", " ")
         if crop_length:
             return text[:crop_length] + "..."
@@ -15,16 +65,14 @@ def print_retrieved_items(results, prefix, crop_length=30):
 
     print(
         f"{prefix}: "
-        + ", ".join(
-            [f"{crop_text(item.page_content)}: {score:.2f}" for item, score in results]
-        )
+        + ", ".join([f"{crop_text(item)}: {score:.2f}" for item, score in results])
     )
 
 
 class HierarchicalRetriever:
     def __init__(
         self,
-        data: Dict[str, List[str]] = None,
+        data: Union[Dict[str, List[str]], LazyChunkedData] = None,
         embedding_model: str = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
         device: str = "cpu",
         title_top_n: int = 10,
@@ -33,79 +81,289 @@ class HierarchicalRetriever:
         max_distance: float = 1,
         title_index_path="vectorstores/title_index",
         chunk_index_path="vectorstores/chunk_index",
+        manifest_path="vectorstores/manifest.json",
+        store_format: str = "langchain",
+        mmap_path="vectorstores/mmap",
+        index_type: str = "flat",
+        index_params: dict = None,
+        embed_batch_size: int = 64,
+        embed_workers: int = 1,
+        cache_size: int = 1024,
+        cache_ttl: float = 3600,
+        cache_path: str = None,
+        lexical_top_n: int = 0,
+        lexical_path="vectorstores/lexical",
+        rrf_k: int = 60,
+        embedding_backend: str = "torch",
+        onnx_path="models/paraphrase-multilingual-MiniLM-L12-v2-onnx",
+        chunk_shards: int = 1,
+        shard_workers: int = 4,
     ):
         """
         :param data: Dictionary with titles as keys and text chunks as values
+            or `LazyChunkedData`, which is loaded only if indexing is needed
         :param title_top_n: Number of top titles to retrieve
         :param chunks_per_title: Number of chunks to retrieve per title
         :param total_chunks: Total number of chunks to return after ranking
+        :param index_type: FAISS index for titles: "flat", "ivf", "hnsw", "sq8", "pq"
+            or a `faiss.index_factory` string. Saved with the index. The chunk
+            index is never searched, chunks are scored exactly, so chunks get only
+            the codec of the type: "flat" for "ivf" and "hnsw" (see
+            `src.index.get_chunk_index_type`)
+        :param index_params: Index parameters, e.g. {"nprobe": 32} (see `src.index`)
+        :param embed_batch_size: Batch size for embedding chunks during indexing
+        :param embed_workers: Number of processes embedding chunks during indexing
+        :param manifest_path: Content hashes of the indexed titles and chunks, used
+            to update the vector stores incrementally when the data changes
+        :param cache_size: Number of query embeddings and retrieval results to cache
+        :param cache_ttl: Seconds after which cached items expire
+        :param cache_path: File to keep the caches in between restarts
+        :param store_format: "langchain" serves from the pickled FAISS vectorstores,
+            "mmap" additionally exports them to `mmap_path` and serves from
+            memory-mapped arrays shared between worker processes (see `src.mmap_store`)
+        :param lexical_top_n: Number of titles found by BM25 that are added to the top
+            `title_top_n` dense ones. Chunks are then ranked by reciprocal rank fusion
+            of dense and BM25 ranks. 0 disables the lexical indexes (see `src.lexical`)
+        :param lexical_path: Directory of the BM25 indexes of titles and chunks
+        :param rrf_k: Constant of the reciprocal rank fusion, larger values flatten the ranks
+        :param embedding_backend: "torch" runs `embedding_model` with sentence-transformers,
+            "onnx" runs its int8-quantized ONNX export from `onnx_path` with ONNX Runtime
+            (see `src.embeddings.export_onnx_model`). The int8 vectors are close to
+            the torch ones but not the same, so the backend is recorded in the
+            manifest and the stores are rebuilt when it changes
+        :param chunk_shards: Number of shards of the chunk vectorstore, by hash of the
+            title (see `src.sharding`). Shards are built, saved and loaded
+            independently, and a query is searched only in the shards of its titles.
+            Shards that get no chunks are left empty. The stores are rebuilt when
+            the number changes. Only for the "langchain" store format
+        :param shard_workers: Number of threads that load and search the shards
         """
+        assert (
+            chunk_shards == 1 or store_format == "langchain"
+        ), "Sharded chunk stores are served only from the langchain store format"
         self.data = data
         self.title_top_n = title_top_n
         self.chunks_per_title = chunks_per_title
         self.total_chunks = total_chunks
         self.max_distance = max_distance
         self.embedding_model = embedding_model
+        self.embedding_backend = embedding_backend
         self.device = device
         self.title_vectorstore = None
         self.chunk_vectorstore = None
+        self.title_store = None
+        self.chunk_store = None
         self.title_index_path = title_index_path
         self.chunk_index_path = chunk_index_path
+        self.manifest_path = manifest_path
+        self.store_format = store_format
+        self.mmap_path = mmap_path
+        self.sources = {}
+        self.index_type = index_type
+        self.index_params = index_params or {}
+        self.last_timings = {}
+        self.startup_timer = StageTimer()
+        self.index_version = None
+        self.query_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self.result_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self.cache_path = cache_path
+        self.lexical_top_n = lexical_top_n
+        self.lexical_path = lexical_path
+        self.rrf_k = rrf_k
+        self.title_lexical_index = None
+        self.chunk_lexical_index = None
+        self.chunk_shards = chunk_shards
+        self.shard_workers = shard_workers
+        self.shard_executor = (
+            ThreadPoolExecutor(max_workers=shard_workers) if chunk_shards > 1 else None
+        )
 
         # Initialize embeddings
-        self.embeddings = HuggingFaceEmbeddings(
+        with self.startup_timer("load_embedding_model"):
+            self.embeddings = load_embeddings(
+                embedding_model, device, backend=embedding_backend, onnx_path=onnx_path
+            )
+        self.embedder = BatchEmbedder(
+            self.embeddings,
             model_name=embedding_model,
-            model_kwargs={"device": device},
-            encode_kwargs={"normalize_embeddings": True},
+            device=device,
+            batch_size=embed_batch_size,
+            num_workers=embed_workers,
+            onnx_path=onnx_path if embedding_backend == "onnx" else None,
         )
 
         # Prepare title and chunk vector stores
         self.title_vectorstore, self.chunk_vectorstore = self.prepare_vector_stores()
+        print(f"Retriever startup: {self.startup_timer}")
+
+        if cache_path:
+            self.load_caches()
+            atexit.register(self.save_caches)
 
     def prepare_vector_stores(self, force_recreate=False, save=True):
-        """Prepare vector stores for titles and chunks"""
+        """Prepare vector stores for titles and chunks and the title -> chunks map"""
+        vectorstores = self._prepare_stores(force_recreate=force_recreate, save=save)
+        # Cached results are only valid for the stores they were retrieved from
+        self.result_cache.clear()
+        if os.path.exists(self.manifest_path):
+            self.index_version = file_hash(self.manifest_path)
+        else:
+            self.index_version = None
+        if self.lexical_top_n:
+            with self.startup_timer("lexical_index"):
+                self._prepare_lexical_indexes(save=save)
+        return vectorstores
+
+    def _prepare_lexical_indexes(self, save=True):
+        """Load BM25 indexes built for the current stores or build them"""
+        # chunk ids are rows of the chunk store, which depend on the store format:
+        # memory-mapped stores are in title order, the others in the order of the index
+        meta = {
+            "index_version": self.index_version,
+            "store_format": self.store_format,
+            "chunk_rows": "title" if self.store_format == "mmap" else "index",
+        }
+        if (
+            self.index_version is not None
+            and load_lexical_meta(self.lexical_path) == meta
+        ):
+            print(f"Loading lexical indexes from {self.lexical_path}...")
+            self.title_lexical_index, self.chunk_lexical_index = load_lexical_indexes(
+                self.lexical_path
+            )
+            return
+        print("Building lexical indexes...")
+        self.title_lexical_index, self.chunk_lexical_index = build_lexical_indexes(
+            self.title_store, self.chunk_store
+        )
+        if save:
+            save_lexical_indexes(
+                self.lexical_path,
+                self.title_lexical_index,
+                self.chunk_lexical_index,
+                meta=meta,
+            )
 
+    def _prepare_stores(self, force_recreate=False, save=True):
+        if (
+            self.store_format == "mmap"
+            and not force_recreate
+            and self._mmap_stores_up_to_date()
+        ):
+            print(f"Loading memory-mapped stores from {self.mmap_path}...")
+            with self.startup_timer("load_indexes"):
+                self._load_mmap_stores()
+            return None, None
+
+        title_vectorstore, chunk_vectorstore = self._load_or_build_vector_stores(
+            force_recreate=force_recreate, save=save
+        )
+        with self.startup_timer("build_title_map"):
+            self.title_store = TitleStore.from_vectorstore(title_vectorstore)
+            if isinstance(chunk_vectorstore, ShardedVectorStore):
+                self.chunk_store = ShardedChunkStore.from_vectorstore(
+                    chunk_vectorstore, self.title_store.titles, self.shard_executor
+                )
+            else:
+                self.chunk_store = ChunkStore.from_vectorstore(
+                    chunk_vectorstore, self.title_store.titles
+                )
+        if self.store_format == "mmap" and save:
+            with self.startup_timer("export_mmap"):
+                export_mmap_stores(
+                    self.mmap_path,
+                    title_vectorstore,
+                    chunk_vectorstore,
+                    meta={
+                        "manifest_sha256": file_hash(self.manifest_path),
+                        "index_type": self.index_type,
+                        "index_params": self.index_params,
+                    },
+                )
+                # serve the rows of the exported stores, as after a restart
+                self._load_mmap_stores()
+        return title_vectorstore, chunk_vectorstore
+
+    def _mmap_stores_up_to_date(self):
+        """Memory-mapped stores are exported from the current manifest and the data did not change"""
+        meta = load_mmap_meta(self.mmap_path)
+        manifest = load_manifest(self.manifest_path)
+        if meta is None or manifest is None:
+            return False
+        if meta["manifest_sha256"] != file_hash(self.manifest_path):
+            return False
+        if not self._same_embeddings(manifest):
+            return False
+        if isinstance(self.data, LazyChunkedData):
+            return same_sources(
+                manifest["sources"], self._fingerprint_sources(manifest)
+            )
+        if self.data is not None:
+            titles, chunks = hash_data(self.data)
+            return (
+                titles.keys() == manifest["titles"].keys()
+                and chunks.keys() == manifest["chunks"].keys()
+            )
+        return True
+
+    def _same_embeddings(self, manifest):
+        """The stores were embedded with the same model and backend, torch if not recorded"""
+        return (
+            manifest["embedding_model"] == self.embedding_model
+            and manifest.get("embedding_backend", "torch") == self.embedding_backend
+        )
+
+    def _load_mmap_stores(self):
+        meta = load_mmap_meta(self.mmap_path)
+        self.index_type = meta["index_type"]
+        self.title_store, self.chunk_store = load_mmap_stores(self.mmap_path)
+        configure_index(
+            self.title_store.index, {**meta["index_params"], **self.index_params}
+        )
+
+    def _load_or_build_vector_stores(self, force_recreate=False, save=True):
         if not force_recreate:
+            manifest = load_manifest(self.manifest_path)
             if not os.path.exists(self.title_index_path):
                 print(
                     f"Title vectorstore not found at {self.title_index_path}. Start indexing."
                 )
             elif not os.path.exists(self.chunk_index_path):
                 print(
-                    f"Chunk vectorstore not found at {self.title_index_path}. Start indexing."
+                    f"Chunk vectorstore not found at {self.chunk_index_path}. Start indexing."
+                )
+            elif manifest and not self._same_embeddings(manifest):
+                print(
+                    f"Vectorstores were built with {manifest['embedding_model']} "
+                    f"({manifest.get('embedding_backend', 'torch')} backend). "
+                    "Start indexing."
+                )
+            elif load_num_shards(self.chunk_index_path) != self.chunk_shards:
+                print(
+                    f"Chunk vectorstore has {load_num_shards(self.chunk_index_path)} "
+                    f"shards, not {self.chunk_shards}. Start indexing."
                 )
             else:
                 print("Loading existing vectorstores...")
-                title_vectorstore = FAISS.load_local(
-                    self.title_index_path,
-                    self.embeddings,
-                    allow_dangerous_deserialization=True,
+                with self.startup_timer("load_indexes"):
+                    title_vectorstore = self._load_vectorstore(self.title_index_path)
+                    chunk_vectorstore = self._load_chunk_vectorstore()
+                if self.data is None:
+                    return title_vectorstore, chunk_vectorstore
+                return self.update_vector_stores(
+                    title_vectorstore, chunk_vectorstore, manifest, save=save
                 )
-                chunk_vectorstore = FAISS.load_local(
-                    self.chunk_index_path,
-                    self.embeddings,
-                    allow_dangerous_deserialization=True,
-                )
-                return title_vectorstore, chunk_vectorstore
         else:
             print("Start indexing.")
 
         assert (
             self.data is not None
         ), "Data not provded. Please provide data (Dict[str, List[str]])."
-        title_texts = list(self.data.keys())
-        title_vectorstore = FAISS.from_texts(title_texts, self.embeddings)
-        # Chunks vector store
-        all_chunks = []
-        chunk_metadata = []
-        for title, chunks in self.data.items():
-            for chunk in chunks:
-                all_chunks.append(chunk)
-                chunk_metadata.append({"title": title})
-
-        chunk_vectorstore = FAISS.from_texts(
-            all_chunks, self.embeddings, metadatas=chunk_metadata
-        )
+        self.sources = self._fingerprint_sources()
+        with self.startup_timer("load_data"):
+            data = self.get_data()
+        with self.startup_timer("build_indexes"):
+            title_vectorstore, chunk_vectorstore = self._build_vector_stores(data)
         if save:
             self.save_vectorstores(
                 title_vectorstore=title_vectorstore,
@@ -115,49 +373,477 @@ class HierarchicalRetriever:
             )
         return title_vectorstore, chunk_vectorstore
 
-    def retrieve(self, query: str, verbose: bool = False) -> List[str]:
+    def update_vector_stores(
+        self, title_vectorstore, chunk_vectorstore, manifest=None, save=True
+    ):
+        """
+        Bring loaded vector stores in line with the data: embed and add only new
+        titles and chunks, delete the ones that are gone.
+        Data files that did not change since the manifest was saved are not read.
+        """
+        self.sources = self._fingerprint_sources(manifest)
+        if (
+            manifest
+            and self.sources
+            and same_sources(manifest["sources"], self.sources)
+        ):
+            return title_vectorstore, chunk_vectorstore
+
+        with self.startup_timer("load_data"):
+            data = self.get_data()
+        if manifest:
+            old_titles, old_chunks = manifest["titles"], manifest["chunks"]
+        else:
+            old_titles = hash_vectorstore(title_vectorstore)
+            old_chunks = hash_vectorstore(chunk_vectorstore, with_title=True)
+        new_titles, new_chunks = hash_data(data)
+
+        added_titles = [h for h in new_titles if h not in old_titles]
+        deleted_titles = [old_titles[h] for h in old_titles if h not in new_titles]
+        added_chunks = [h for h in new_chunks if h not in old_chunks]
+        deleted_chunks = [old_chunks[h] for h in old_chunks if h not in new_chunks]
+        print(
+            f"Data diff: +{len(added_titles)}/-{len(deleted_titles)} titles, "
+            f"+{len(added_chunks)}/-{len(deleted_chunks)} chunks."
+        )
+
+        if not (added_titles or deleted_titles or added_chunks or deleted_chunks):
+            if save:
+                save_manifest(
+                    self.manifest_path,
+                    {
+                        **manifest,
+                        "sources": self.sources,
+                        "embedding_backend": self.embedding_backend,
+                    }
+                    if manifest
+                    else build_manifest(
+                        title_vectorstore,
+                        chunk_vectorstore,
+                        self.embedding_model,
+                        self.sources,
+                        self.embedding_backend,
+                    ),
+                )
+            return title_vectorstore, chunk_vectorstore
+
+        if (deleted_titles and not supports_removal(title_vectorstore.index)) or (
+            deleted_chunks and not supports_removal(chunk_vectorstore.index)
+        ):
+            print(
+                f"{self.index_type!r} index does not support deletion. Start indexing."
+            )
+            with self.startup_timer("build_indexes"):
+                title_vectorstore, chunk_vectorstore = self._build_vector_stores(data)
+        else:
+            with self.startup_timer("update_indexes"):
+                for vectorstore, deleted in [
+                    (title_vectorstore, deleted_titles),
+                    (chunk_vectorstore, deleted_chunks),
+                ]:
+                    if deleted:
+                        vectorstore.delete(deleted)
+                title_texts = [new_titles[h] for h in added_titles]
+                add_batches(
+                    title_vectorstore,
+                    title_texts,
+                    self.embedder.embed(title_texts),
+                    ids=added_titles,
+                )
+                chunk_texts = [new_chunks[h][1] for h in added_chunks]
+                add_batches(
+                    chunk_vectorstore,
+                    chunk_texts,
+                    self.embedder.embed(chunk_texts),
+                    metadatas=[{"title": new_chunks[h][0]} for h in added_chunks],
+                    ids=added_chunks,
+                )
+        if save:
+            self.save_vectorstores(
+                title_vectorstore=title_vectorstore,
+                chunk_vectorstore=chunk_vectorstore,
+            )
+        return title_vectorstore, chunk_vectorstore
+
+    def _fingerprint_sources(self, manifest=None):
+        """Fingerprints of the data files, if the data is read from files"""
+        if not isinstance(self.data, LazyChunkedData):
+            return {}
+        previous = manifest["sources"] if manifest else None
+        sources = fingerprint_files(self.data.get_paths(), previous)
+        settings = self.data.settings()
+        if settings:
+            # other settings give other chunks from the same files
+            sources["preprocessing"] = {
+                "sha256": content_hash(json.dumps(settings, sort_keys=True))
+            }
+        return sources
+
+    def get_data(self) -> Dict[str, List[str]]:
+        if isinstance(self.data, LazyChunkedData):
+            return self.data.load()
+        return self.data
+
+    def _build_vector_stores(self, data):
+        titles, chunks = hash_data(data)
+        title_vectorstore = build_vectorstore(
+            list(titles.values()),
+            self.embeddings,
+            ids=list(titles.keys()),
+            index_type=self.index_type,
+            index_params=self.index_params,
+            embedder=self.embedder,
+        )
+        # Chunks vector store, one per shard
+        shards = [{} for _ in range(self.chunk_shards)]
+        for chunk_hash, (title, chunk) in chunks.items():
+            shards[shard_of(title, self.chunk_shards)][chunk_hash] = (title, chunk)
+        empty_shards = [i for i, shard in enumerate(shards) if not shard]
+        if empty_shards:
+            print(f"Chunk shards {empty_shards} get no chunks and are left empty.")
+        chunk_vectorstores = [
+            None
+            if not shard
+            else build_vectorstore(
+                [chunk for _, chunk in shard.values()],
+                self.embeddings,
+                metadatas=[{"title": title} for title, _ in shard.values()],
+                ids=list(shard.keys()),
+                index_type=get_chunk_index_type(self.index_type),
+                index_params=self.index_params,
+                embedder=self.embedder,
+            )
+            for shard in shards
+        ]
+        if self.chunk_shards == 1:
+            return title_vectorstore, chunk_vectorstores[0]
+        return title_vectorstore, ShardedVectorStore(chunk_vectorstores)
+
+    def _load_chunk_vectorstore(self):
+        if self.chunk_shards == 1:
+            return self._load_vectorstore(self.chunk_index_path)
+        return load_shards(
+            self.chunk_index_path,
+            self.chunk_shards,
+            self._load_vectorstore,
+            num_workers=self.shard_workers,
+        )
+
+    def _load_vectorstore(self, path):
+        """Load a vectorstore with the index type and parameters it was saved with"""
+        config = load_index_config(path)
+        if config["index_type"] != self.index_type:
+            print(
+                f"Index at {path} is {config['index_type']!r}, not {self.index_type!r}. "
+                "Use `force_recreate=True` to rebuild it."
+            )
+            self.index_type = config["index_type"]
+        vectorstore = FAISS.load_local(
+            path,
+            self.embeddings,
+            allow_dangerous_deserialization=True,
+        )
+        configure_index(
+            vectorstore.index, {**config["index_params"], **self.index_params}
+        )
+        return vectorstore
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """Compute the normalized query embedding once for all retrieval stages"""
+        key = normalize_query(query)
+        query_vector = self.query_cache.get(key)
+        if query_vector is None:
+            query_vector = np.asarray(
+                self.embeddings.embed_query(query), dtype=np.float32
+            )
+            self.query_cache.put(key, query_vector)
+        return query_vector
+
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Batched `embed_query`, only the queries missing from the cache are embedded"""
+        keys = [normalize_query(query) for query in queries]
+        vectors = [self.query_cache.get(key) for key in keys]
+        missing = {}
+        for query, key, vector in zip(queries, keys, vectors):
+            if vector is None:
+                missing.setdefault(key, query)
+        if missing:
+            embedded = np.asarray(
+                self.embeddings.embed_documents(list(missing.values())),
+                dtype=np.float32,
+            )
+            for key, vector in zip(missing, embedded):
+                self.query_cache.put(key, vector)
+            embedded = dict(zip(missing, embedded))
+            vectors = [
+                embedded[key] if vector is None else vector
+                for key, vector in zip(keys, vectors)
+            ]
+        return np.stack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+
+    def _result_key(self, query):
+        return (
+            f"{normalize_query(query)}|{self.title_top_n}|{self.chunks_per_title}"
+            f"|{self.total_chunks}|{self.max_distance}|{self.lexical_top_n}|{self.rrf_k}"
+        )
+
+    def cache_stats(self):
+        return {
+            "query_cache": self.query_cache.stats(),
+            "result_cache": self.result_cache.stats(),
+        }
+
+    def save_caches(self):
+        save_caches(
+            self.cache_path,
+            {"query_vectors": self.query_cache, "results": self.result_cache},
+            embedding_model=self.embedding_model,
+            embedding_backend=self.embedding_backend,
+            index_version=self.index_version,
+        )
+
+    def load_caches(self):
+        """Restore caches saved with the same embeddings (and the same stores for results)"""
+        meta, caches = load_caches(self.cache_path)
+        if meta is None or not self._same_embeddings(meta):
+            return
+        self.query_cache.load_json(
+            [
+                [key, expires_at, np.asarray(vector, dtype=np.float32)]
+                for key, expires_at, vector in caches["query_vectors"]
+            ]
+        )
+        if (
+            meta["index_version"] is not None
+            and meta["index_version"] == self.index_version
+        ):
+            self.result_cache.load_json(caches["results"])
+
+    def retrieve(
+        self,
+        query: str,
+        verbose: bool = False,
+        timer: StageTimer = None,
+        with_titles: bool = False,
+    ) -> List[str]:
         """
         Retrieve relevant chunks based on query
 
         1. First, find top N relevant titles
         2. Then, find M relevant chunks under each title
         3. Rank and return K total chunks
+
+        Durations of the stages are stored in `self.last_timings` and added
+        to `timer` if given, which is safe when called from several threads.
+        Results are cached by normalized query, see `cache_stats`.
+
+        :param with_titles: Return (title, chunk) pairs instead of chunks
         """
-        # Step 1: Retrieve top N titles
-        title_results = self.title_vectorstore.similarity_search_with_score(
-            query, k=self.title_top_n
+        timer = timer or StageTimer()
+        result_key = self._result_key(query) + ("|titles" if with_titles else "")
+        with timer("result_cache") as span:
+            results = self.result_cache.get(result_key)
+            span["attributes"]["hit"] = results is not None
+        if results is not None and not verbose:
+            self.last_timings = dict(timer.timings)
+            return [tuple(item) for item in results] if with_titles else list(results)
+
+        with timer("embed_query"):
+            query_vector = self.embed_query(query)
+        results = self.retrieve_by_vector(
+            query_vector,
+            verbose=verbose,
+            timer=timer,
+            query=query,
+            with_titles=with_titles,
         )
+        self.result_cache.put(result_key, results)
+        if verbose:
+            print(f"Cache: {self.cache_stats()}")
+        return list(results)
+
+    def retrieve_by_vector(
+        self,
+        query_vector: np.ndarray,
+        verbose: bool = False,
+        timer: StageTimer = None,
+        query: str = None,
+        with_titles: bool = False,
+    ) -> List[str]:
+        """
+        Same as `retrieve`, but takes an already computed query embedding.
+        The query text is needed only for the lexical indexes
+        """
+        timer = timer or StageTimer()
+
+        # Step 1: Retrieve top N titles
+        with timer("title_search") as span:
+            title_ids, title_distances = self.title_store.search(
+                query_vector[None, :], self.title_top_n
+            )
+            found = title_ids[0] >= 0
+            span["attributes"]["titles"] = int(found.sum())
 
-        # Collect relevant titles
         if verbose:
-            print_retrieved_items(title_results, "Relevant titles", crop_length=None)
-        relevant_titles = [result.page_content for result, _ in title_results]
+            print_retrieved_items(
+                [
+                    (self.title_store.titles[title_id], distance)
+                    for title_id, distance in zip(
+                        title_ids[0][found], title_distances[0][found]
+                    )
+                ],
+                "Relevant titles",
+                crop_length=None,
+            )
+
+        if self.lexical_top_n:
+            with timer("lexical_search"):
+                title_ids = self._add_lexical_titles(title_ids, [query])
+                found = title_ids[0] >= 0
+            if verbose:
+                lexical_ids = title_ids[0][self.title_top_n :]
+                lexical_ids = lexical_ids[lexical_ids >= 0]
+                print_retrieved_items(
+                    zip(
+                        [self.title_store.titles[title_id] for title_id in lexical_ids],
+                        self.title_lexical_index.score(query, lexical_ids),
+                    ),
+                    "Titles added by BM25",
+                    crop_length=None,
+                )
+        title_ids = title_ids[0][found]
 
-        # Step 2: Retrieve chunks for each title
-        all_relevant_chunks = []
-        for title in relevant_titles:
-            # Filter chunks by title metadata
-            title_chunks = self.chunk_vectorstore.similarity_search_with_score(
-                query, k=self.chunks_per_title, filter={"title": title}
+        # Step 2: Retrieve chunks for each title in a single scoring pass
+        with timer("chunk_search") as span:
+            rows, distances, chunk_title_ids = self.chunk_store.search(
+                query_vector, title_ids, self.chunks_per_title
             )
-            all_relevant_chunks.extend(title_chunks)
+            span["attributes"].update(titles=len(title_ids), chunks=len(rows))
 
         if verbose:
             print_retrieved_items(
-                all_relevant_chunks, "All relevant chunks", crop_length=30
+                self._with_texts(zip(rows, distances)),
+                "All relevant chunks",
+                crop_length=30,
             )
 
         # Step 3: Rank and return top K chunks
-        final_chunks = sorted(all_relevant_chunks, key=lambda x: x[1])[
-            : self.total_chunks
-        ]
-        final_chunks = [
-            chunk for chunk in final_chunks if chunk[1] <= self.max_distance
-        ]
+        with timer("rank"):
+            order = self._rank(
+                rows, distances, np.zeros(len(rows), dtype=np.int64), [query]
+            )
+            final_chunks = self._with_texts(zip(rows[order], distances[order]))
         if verbose:
             print_retrieved_items(final_chunks, "Final chunks", crop_length=30)
+            print(f"Retrieval timings: {timer}")
+        self.last_timings = dict(timer.timings)
+
+        if with_titles:
+            return [
+                (self.chunk_store.titles[title_id], text)
+                for title_id, (text, _) in zip(chunk_title_ids[order], final_chunks)
+            ]
+        return [text for text, _ in final_chunks]
+
+    def retrieve_many(
+        self, queries: List[str], batch_size: int = 256
+    ) -> List[List[str]]:
+        """
+        Same results as `retrieve` for every query, for evaluation and bulk workloads.
+
+        Queries missing from the result cache are embedded, searched in the title
+        index and scored against the chunks of their titles `batch_size` at a time.
+        """
+        timer = StageTimer()
+        keys = [self._result_key(query) for query in queries]
+        results = [None] * len(queries)
+        with timer("result_cache"):
+            for i, key in enumerate(keys):
+                cached = self.result_cache.get(key)
+                if cached is not None:
+                    results[i] = list(cached)
+        pending = [i for i, result in enumerate(results) if result is None]
+
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start : start + batch_size]
+            with timer("embed_query"):
+                query_vectors = self.embed_queries([queries[i] for i in batch])
+            batch_results = self.retrieve_by_vectors(
+                query_vectors, timer=timer, queries=[queries[i] for i in batch]
+            )
+            for i, chunks in zip(batch, batch_results):
+                self.result_cache.put(keys[i], chunks)
+                results[i] = list(chunks)
+        self.last_timings = dict(timer.timings)
+        return results
+
+    def retrieve_by_vectors(
+        self,
+        query_vectors: np.ndarray,
+        timer: StageTimer = None,
+        queries: List[str] = None,
+    ) -> List[List[str]]:
+        """Batched `retrieve_by_vector` for a (num_queries, dim) array of embeddings"""
+        timer = timer or StageTimer()
+        with timer("title_search"):
+            title_ids, _ = self.title_store.search(query_vectors, self.title_top_n)
 
-        return [chunk[0].page_content for chunk in final_chunks]
+        if self.lexical_top_n:
+            with timer("lexical_search"):
+                title_ids = self._add_lexical_titles(title_ids, queries)
+
+        with timer("chunk_search"):
+            rows, distances, _, query_ids = self.chunk_store.search_many(
+                query_vectors, title_ids, self.chunks_per_title
+            )
+
+        with timer("rank"):
+            order = self._rank(rows, distances, query_ids, queries)
+            results = [[] for _ in range(len(query_vectors))]
+            for row, query_id in zip(rows[order], query_ids[order]):
+                results[query_id].append(self.chunk_store.get_text(row))
+        return results
+
+    def _add_lexical_titles(self, title_ids: np.ndarray, queries: List[str]):
+        """Append the top `lexical_top_n` BM25 titles that dense search missed, -1 otherwise"""
+        lexical_ids = np.full((len(queries), self.lexical_top_n), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            found, _ = self.title_lexical_index.search(query, self.lexical_top_n)
+            lexical_ids[i, : len(found)] = found
+        duplicates = (lexical_ids[:, :, None] == title_ids[:, None, :]).any(axis=2)
+        lexical_ids[duplicates] = -1
+        return np.concatenate([title_ids, lexical_ids], axis=1)
+
+    def _rank(self, rows, distances, query_ids, queries):
+        """
+        Positions of the final chunks, best first within every query
+
+        Chunks are ranked by distance, or by reciprocal rank fusion of distance and
+        BM25 ranks with the lexical indexes, then cut to `total_chunks` and `max_distance`
+
+        :param query_ids: Query number of every chunk, sorted
+        """
+        if not self.lexical_top_n:
+            order = np.lexsort((distances, query_ids))
+        else:
+            lexical_scores = np.zeros(len(rows), dtype=np.float32)
+            bounds = np.searchsorted(query_ids, np.arange(len(queries) + 1))
+            for i, query in enumerate(queries):
+                start, end = bounds[i], bounds[i + 1]
+                lexical_scores[start:end] = self.chunk_lexical_index.score(
+                    query, rows[start:end]
+                )
+            fused = reciprocal_rank_fusion(
+                distances, lexical_scores, query_ids, k=self.rrf_k
+            )
+            order = np.lexsort((-fused, query_ids))
+        ranks = group_ranks(query_ids[order])
+        # compared as float64, like Python floats
+        close = distances[order].astype(np.float64) <= self.max_distance
+        return order[(ranks < self.total_chunks) & close]
+
+    def _with_texts(self, chunks):
+        return [(self.chunk_store.get_text(row), distance) for row, distance in chunks]
 
     def save_vectorstores(
         self,
@@ -171,16 +857,37 @@ class HierarchicalRetriever:
         title_index_path = title_index_path or self.title_index_path
         chunk_index_path = chunk_index_path or self.chunk_index_path
 
-        for name, path, vectorstore in [
-            ("Title", title_index_path, title_vectorstore),
-            ("Chunk", chunk_index_path, chunk_vectorstore),
-        ]:
+        stores = [("Title", title_index_path, title_vectorstore)]
+        num_shards, empty_shards = 1, []
+        if isinstance(chunk_vectorstore, ShardedVectorStore):
+            num_shards = len(chunk_vectorstore.shards)
+            empty_shards = chunk_vectorstore.empty_shards
+            stores += [
+                (f"Chunk shard {shard}", shard_path(chunk_index_path, shard), store)
+                for shard, store in enumerate(chunk_vectorstore.shards)
+                if store is not None
+            ]
+        else:
+            stores.append(("Chunk", chunk_index_path, chunk_vectorstore))
+        for name, path, vectorstore in stores:
             os.makedirs(os.path.dirname(path), exist_ok=True)
             assert (
                 vectorstore
             ), f"{name} vector store not found. Please call `prepare_vector_stores` method."
             vectorstore.save_local(path)
+            save_index_config(path, self.index_type, self.index_params)
             print(f"{name} saved to {path}.")
+        save_shards_meta(chunk_index_path, num_shards, empty_shards)
+        save_manifest(
+            self.manifest_path,
+            build_manifest(
+                title_vectorstore,
+                chunk_vectorstore,
+                self.embedding_model,
+                self.sources,
+                self.embedding_backend,
+            ),
+        )
 
 
 # Example usage
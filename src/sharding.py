@@ -0,0 +1,184 @@
+"""
+Sharding of the chunk vectorstore by hash of the title.
+
+All chunks of a title are in one shard, so the top chunks of a title are found in
+one shard and the title index tells which shards a query needs. Every shard is a
+FAISS vectorstore of its own, saved to `shard_XX` under the chunk index path, and
+is built, saved and loaded independently. Shards that get no chunks, e.g. of a
+small dataset, are None: they are not built, saved or searched, and are listed as
+"empty_shards" in the shards file.
+"""
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from src.manifest import content_hash
+
+SHARDS_FILE = "shards.json"
+SHARD_DIR_PATTERN = re.compile(r"shard_(\d+)")
+
+
+def shard_of(title, num_shards):
+    """Shard of the chunks of a title, stable between runs and machines"""
+    return int(content_hash(title)[:8], 16) % num_shards
+
+
+def shard_path(path, shard):
+    return os.path.join(path, f"shard_{shard:02d}")
+
+
+def save_shards_meta(path, num_shards, empty_shards=()):
+    """
+    Record the number of shards and the empty ones, and remove the shards left
+    from a larger number or from before the shards became empty
+    """
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        match = SHARD_DIR_PATTERN.fullmatch(name)
+        if match and (
+            num_shards == 1
+            or int(match.group(1)) >= num_shards
+            or int(match.group(1)) in empty_shards
+        ):
+            shutil.rmtree(os.path.join(path, name))
+    with open(os.path.join(path, SHARDS_FILE), "w") as f:
+        json.dump(
+            {
+                "num_shards": num_shards,
+                "shard_by": "title",
+                "empty_shards": sorted(empty_shards),
+            },
+            f,
+            indent=2,
+        )
+
+
+def load_num_shards(path):
+    """Number of shards of the chunk index at `path`, 1 if it is not sharded"""
+    meta_path = os.path.join(path, SHARDS_FILE)
+    if not os.path.exists(meta_path):
+        return 1
+    with open(meta_path) as f:
+        return json.load(f)["num_shards"]
+
+
+def load_empty_shards(path):
+    """Empty shards of the chunk index at `path`"""
+    meta_path = os.path.join(path, SHARDS_FILE)
+    if not os.path.exists(meta_path):
+        return []
+    with open(meta_path) as f:
+        return json.load(f).get("empty_shards", [])
+
+
+def load_shards(path, num_shards, load_vectorstore, num_workers=4):
+    """Load the non-empty shards in parallel with `load_vectorstore(shard_path)`"""
+    empty_shards = set(load_empty_shards(path))
+
+    def load_shard(shard):
+        if shard in empty_shards:
+            return None
+        return load_vectorstore(shard_path(path, shard))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return ShardedVectorStore(list(executor.map(load_shard, range(num_shards))))
+
+
+class ShardedDocstore:
+    def __init__(self, vectorstore):
+        self.vectorstore = vectorstore
+
+    def search(self, docstore_id):
+        shard = self.vectorstore.shards[self.vectorstore.id_to_shard[docstore_id]]
+        return shard.docstore.search(docstore_id)
+
+
+class ShardedVectorStore:
+    """
+    Chunk vectorstores of the shards behind the part of the LangChain FAISS
+    interface that the retriever and the manifest use: documents are added to the
+    shard of their "title" metadata, rows of `index_to_docstore_id` are numbered
+    across the non-empty shards, as in `ShardedChunkStore`
+    """
+
+    def __init__(self, shards):
+        """:param shards: Vectorstore of every shard, None for the empty ones"""
+        self.shards = shards
+        self.docstore = ShardedDocstore(self)
+        self.id_to_shard = {
+            docstore_id: shard
+            for shard, vectorstore in enumerate(shards)
+            if vectorstore is not None
+            for docstore_id in vectorstore.index_to_docstore_id.values()
+        }
+
+    @property
+    def stores(self):
+        """Vectorstores of the non-empty shards"""
+        return [vectorstore for vectorstore in self.shards if vectorstore is not None]
+
+    @property
+    def empty_shards(self):
+        return [shard for shard, store in enumerate(self.shards) if store is None]
+
+    @property
+    def index(self):
+        """Index of the first non-empty shard, all shards have the same index type"""
+        return self.stores[0].index
+
+    @property
+    def index_to_docstore_id(self):
+        mapping = {}
+        base = 0
+        for vectorstore in self.stores:
+            for row, docstore_id in vectorstore.index_to_docstore_id.items():
+                mapping[base + row] = docstore_id
+            base += len(vectorstore.index_to_docstore_id)
+        return mapping
+
+    def add_embeddings(self, text_embeddings, metadatas, ids=None):
+        """Same as `FAISS.add_embeddings`, `metadatas` with the titles are required"""
+        text_embeddings = list(text_embeddings)
+        groups = {}
+        for i, metadata in enumerate(metadatas):
+            shard = shard_of(metadata["title"], len(self.shards))
+            groups.setdefault(shard, []).append(i)
+        added = []
+        for shard, positions in groups.items():
+            if self.shards[shard] is None:
+                self.shards[shard] = self._new_shard()
+            shard_ids = self.shards[shard].add_embeddings(
+                [text_embeddings[i] for i in positions],
+                metadatas=[metadatas[i] for i in positions],
+                ids=[ids[i] for i in positions] if ids else None,
+            )
+            for docstore_id in shard_ids:
+                self.id_to_shard[docstore_id] = shard
+            added.extend(shard_ids)
+        return added
+
+    def delete(self, ids):
+        groups = {}
+        for docstore_id in ids:
+            shard = self.id_to_shard.pop(docstore_id)
+            groups.setdefault(shard, []).append(docstore_id)
+        for shard, shard_ids in groups.items():
+            self.shards[shard].delete(shard_ids)
+
+    def _new_shard(self):
+        """Empty vectorstore with the index of the other shards, trained if they are"""
+        template = self.stores[0]
+        index = faiss.clone_index(template.index)
+        index.reset()
+        return FAISS(
+            embedding_function=template.embedding_function,
+            index=index,
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={},
+        )
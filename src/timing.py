@@ -0,0 +1,90 @@
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    Collects wall-clock durations of named pipeline stages (in seconds) and the
+    spans of the trace of one request. Stages may be nested, the time of nested
+    stages is then counted in the outer stage too
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.spans = []
+        self.attributes = {}
+        self.trace_id = uuid.uuid4().hex
+        self.start = time.time()
+        self._lock = threading.Lock()
+        # open spans of every thread, the last one is the parent of a new span
+        self._local = threading.local()
+
+    @contextmanager
+    def __call__(self, stage, parent=None, **attributes):
+        """
+        Time a stage: `with timer("stage") as span: ...`
+
+        :param parent: Parent span, for stages that run in another thread or
+            concurrently with their siblings. The innermost open span of the
+            thread by default
+        :param attributes: Attributes of the span, more can be added to
+            `span["attributes"]` inside the block
+        """
+        stack = self._local.__dict__.setdefault("stack", [])
+        parent = parent or self.current()
+        span = {
+            "name": stage,
+            "id": None,
+            "parent": parent["id"] if parent else None,
+            "thread": threading.current_thread().name,
+            "start": time.time() - self.start,
+            "duration": None,
+            "attributes": attributes,
+        }
+        with self._lock:
+            span["id"] = len(self.spans)
+            self.spans.append(span)
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            elapsed = time.perf_counter() - start
+            # concurrent stages of one thread, e.g. asyncio tasks, end in any order
+            stack.remove(span)
+            span["duration"] = elapsed
+            with self._lock:
+                self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+
+    def current(self):
+        """The innermost open span of the calling thread"""
+        stack = self._local.__dict__.get("stack")
+        return stack[-1] if stack else None
+
+    def annotate(self, **attributes):
+        """Attributes of the whole request, e.g. token counts or the LLM path"""
+        self.attributes.update(attributes)
+
+    def total(self):
+        """Time of the outermost stages"""
+        return sum(
+            span["duration"] or 0.0 for span in self.spans if span["parent"] is None
+        )
+
+    def trace(self):
+        """The request as a JSON-serializable trace"""
+        return {
+            "trace_id": self.trace_id,
+            "start": self.start,
+            "duration": time.time() - self.start,
+            "attributes": dict(self.attributes),
+            "spans": list(self.spans),
+        }
+
+    def __str__(self):
+        return ", ".join(
+            f"{stage}: {seconds * 1000:.1f} ms"
+            for stage, seconds in self.timings.items()
+        )
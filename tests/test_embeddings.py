@@ -0,0 +1,60 @@
+"""
+The int8 ONNX backend against the torch one, on a tiny BERT model built in place,
+so that nothing is downloaded. Needs torch, transformers and sentence-transformers
+for the export and the reference vectors, and is skipped without them.
+
+Usage:
+    python -m pytest tests
+"""
+import sys
+
+import pytest
+
+sys.path.append("./")
+
+from src.embeddings import OnnxEmbeddings, export_onnx_model
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+sentence_transformers = pytest.importorskip("sentence_transformers")
+
+WORDS = "что посмотреть в казани москва кремль музей театр парк река".split()
+TEXTS = [
+    "что посмотреть в казани",
+    "кремль",
+    "музей театр парк река москва кремль",
+    "слово не из словаря",
+]
+
+
+@pytest.fixture(scope="module")
+def model_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("tiny_bert")
+    vocab_path = path / "vocab.txt"
+    vocab_path.write_text(
+        "\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS)
+    )
+    tokenizer = transformers.BertTokenizerFast(str(vocab_path))
+    tokenizer.save_pretrained(path)
+    torch.manual_seed(0)
+    config = transformers.BertConfig(
+        vocab_size=tokenizer.vocab_size,
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=128,
+        max_position_embeddings=128,
+    )
+    transformers.BertModel(config).save_pretrained(path)
+    return str(path)
+
+
+def test_int8_onnx_close_to_torch(model_path, tmp_path):
+    export_onnx_model(model_path, str(tmp_path))
+    onnx_vectors = OnnxEmbeddings(str(tmp_path), pad_token="[PAD]").encode(TEXTS)
+    torch_vectors = sentence_transformers.SentenceTransformer(model_path).encode(
+        TEXTS, normalize_embeddings=True, convert_to_numpy=True
+    )
+    assert onnx_vectors.shape == torch_vectors.shape
+    similarities = (onnx_vectors * torch_vectors).sum(axis=1)
+    assert similarities.min() > 0.99
@@ -0,0 +1,80 @@
+"""
+The lxml extraction of `WikiParser` against the BeautifulSoup parsers it replaced,
+on the pages in benchmarks/fixtures. Wikivoyage pages are in the Parsoid layout of
+the site: every section is a <section> element and heading divs have no id.
+
+Usage:
+    python -m pytest tests
+"""
+import sys
+
+import pytest
+
+sys.path.append("./")
+
+from benchmarks.html_parsing_benchmark import (
+    FIXTURES_DIR,
+    LegacyWikiParser,
+    load_pages,
+    parse,
+)
+from src.data.data_parsing import WikiParser
+
+PAGES = [
+    (kind, name, page)
+    for kind, kind_pages in load_pages([FIXTURES_DIR]).items()
+    for name, page in kind_pages
+]
+
+
+def parse_fixture(name):
+    kind, name, page = next(page for page in PAGES if page[1] == name)
+    return parse(WikiParser(), kind, name, page)
+
+
+@pytest.mark.parametrize("kind, name, page", PAGES, ids=[name for _, name, _ in PAGES])
+def test_same_as_legacy(kind, name, page):
+    expected = parse(LegacyWikiParser(), kind, name, page)
+    assert parse(WikiParser(), kind, name, page) == expected
+
+
+def test_wikivoyage_sections():
+    assert parse_fixture("wikivoyage_elabuga.html") == {
+        "Понимание": "Город известен с XVI века. Чёртово городище стоит\n"
+        "над рекой Тоймой. Летом    здесь тепло,   зимой — морозно. "
+        "Население: 74 тыс.\nЧасовой пояс: MSK",
+        "Как_добраться": "Автобусы из Казани и Набережных Челнов. Автовокзал\n"
+        "Рейсы каждый час,касса с 6:00. Речная пристань — летом теплоходы по Каме.",
+        "Что_посмотреть": "",
+        "Развлечения": "Музей-заповедник, 茶 и парки.",
+    }
+
+
+def test_wikivoyage_subsections_fail_the_page():
+    # the heading divs of subsections have no id, the old parsers failed on them
+    assert parse_fixture("wikivoyage_kazan.html") == {}
+
+
+def test_table():
+    assert parse_fixture("city_table.html") == {
+        "Абаза": "/wiki/Абаза",
+        "Абакан": "/wiki/Абакан",
+        "Великий Новгород": "/wiki/Великий_Новгород",
+        "Казань": "/wiki/Казань",
+    }
+
+
+def test_wikipedia_sections():
+    page_info = parse_fixture("wikipedia_kazan.json")
+    # sections without paragraphs or lists are dropped
+    assert list(page_info) == [
+        "Этимология",
+        "География",
+        "География: Климат",
+        "География: Гидрография",
+        "История",
+        "История: Основание",
+    ]
+    assert page_info["География: Климат"] == (
+        "Умеренно континентальный.Зима холодная. Январь: −10 °CИюль: +20 °C"
+    )
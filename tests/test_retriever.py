@@ -0,0 +1,79 @@
+"""
+`HierarchicalRetriever` restarts: stores and indexes loaded from disk must rank
+the same as the freshly built ones. A hashed bag of words stands in for the
+embedding model, so that the tests run without downloading it.
+
+Usage:
+    python -m pytest tests
+"""
+import hashlib
+import random
+import sys
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+
+sys.path.append("./")
+
+import src.retriever
+from src.retriever import HierarchicalRetriever
+
+WORDS = "москва казань музей театр парк река собор улица площадь кремль мост".split()
+
+
+class HashedWordEmbeddings(Embeddings):
+    def __init__(self, dim=32):
+        self.dim = dim
+
+    def embed_query(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dim] += 1
+        return (vector / (np.linalg.norm(vector) or 1)).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def hashed_embeddings(monkeypatch):
+    monkeypatch.setattr(
+        src.retriever, "load_embeddings", lambda *args, **kwargs: HashedWordEmbeddings()
+    )
+
+
+def make_data(num_titles=60, seed=0):
+    rng = random.Random(seed)
+    words = WORDS + [f"слово{i}" for i in range(200)]
+    # chunks of different lengths, so that the embedding batches reorder them
+    return {
+        f"Город {i}: раздел {j}": [
+            " ".join(rng.choices(words, k=rng.randint(5, 60)))
+            for _ in range(rng.randint(1, 5))
+        ]
+        for i in range(num_titles // 3)
+        for j in range(3)
+    }
+
+
+@pytest.mark.parametrize("store_format", ["langchain", "mmap"])
+def test_lexical_ranking_after_restart(tmp_path, store_format):
+    data = make_data()
+    rng = random.Random(1)
+    queries = [" ".join(rng.choices(WORDS, k=3)) for _ in range(30)]
+    kwargs = dict(
+        title_index_path=str(tmp_path / "title_index"),
+        chunk_index_path=str(tmp_path / "chunk_index"),
+        manifest_path=str(tmp_path / "manifest.json"),
+        mmap_path=str(tmp_path / "mmap"),
+        lexical_path=str(tmp_path / "lexical"),
+        store_format=store_format,
+        lexical_top_n=5,
+        max_distance=10,
+        cache_size=0,
+    )
+    fresh = HierarchicalRetriever(data, **kwargs)
+    expected = [fresh.retrieve(query) for query in queries]
+    reloaded = HierarchicalRetriever(data, **kwargs)
+    assert [reloaded.retrieve(query) for query in queries] == expected